@@ -7,8 +7,11 @@ from lightning import LightningDataModule
 from PIL import Image
 from torch.utils.data import DataLoader, Dataset
 
-from src.data.transforms import transform_test, transform_train
-from src.data.utils import pre_caption
+from src.data.my_utils import collate_fn
+from src.data.quarantine import get_quarantine
+from src.data.txt_store import TextEmbStore
+from src.data.transforms import BatchAugmentCollate, transform_test, transform_train
+from src.data.utils import load_image, pre_caption
 from src.data.webvid_covr import WebVidCoVRDataset
 from src.tools.files import write_txt
 from src.tools.utils import print_dist
@@ -27,6 +30,9 @@ class CCCoIRDataModule(LightningDataModule):
         emb_dirs: dict = {"train": "", "val": ""},
         image_size: int = 384,
         si_tc_weight=0,
+        batch_aug: bool = False,
+        quarantine: str = None,
+        txt_store: str = None,
         **kwargs,  # type: ignore
     ) -> None:
         super().__init__()
@@ -35,9 +41,11 @@ class CCCoIRDataModule(LightningDataModule):
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.pin_memory = pin_memory
+        self.batch_aug = batch_aug
 
-        self.transform_train = transform_train(image_size)
+        self.transform_train = transform_train(image_size, batch_aug=batch_aug)
         self.transform_test = transform_test(image_size)
+        self.quarantine = get_quarantine(quarantine)
 
         self.data_train = CCCoIRDataset(
             transform=self.transform_train,
@@ -47,6 +55,8 @@ class CCCoIRDataModule(LightningDataModule):
             split="train",
             si_tc_weight=si_tc_weight,
             image_size=image_size,
+            quarantine=self.quarantine,
+            txt_store=txt_store,
         )
 
         self.data_val = WebVidCoVRDataset(
@@ -59,6 +69,7 @@ class CCCoIRDataModule(LightningDataModule):
             iterate="pth2",
             vid_query_method="middle",
             vid_frames=1,
+            quarantine=self.quarantine,
         )
 
     def prepare_data(self):
@@ -72,6 +83,9 @@ class CCCoIRDataModule(LightningDataModule):
             batch_size=self.batch_size,
             num_workers=self.num_workers,
             pin_memory=self.pin_memory,
+            collate_fn=(
+                BatchAugmentCollate(collate_fn) if self.batch_aug else collate_fn
+            ),
             shuffle=True,
             drop_last=True,
         )
@@ -82,6 +96,7 @@ class CCCoIRDataModule(LightningDataModule):
             batch_size=self.batch_size,
             num_workers=self.num_workers,
             pin_memory=self.pin_memory,
+            collate_fn=collate_fn,
             shuffle=False,
             drop_last=False,
         )
@@ -117,6 +132,7 @@ class CCCoIRTestDataModule(LightningDataModule):
             emb_dir=emb_dir,
             split="test",
             iterate=self.iterate,
+            image_size=image_size,
         )
 
     def test_dataloader(self):
@@ -142,6 +158,8 @@ class CCCoIRDataset(Dataset):
         iterate: str = "pth2",
         si_tc_weight=0,
         image_size: int = 384,
+        quarantine=None,
+        txt_store=None,
     ) -> None:
         super().__init__()
 
@@ -230,6 +248,15 @@ class CCCoIRDataset(Dataset):
         self.df = self.df[self.df["path2"].notna()]
         self.df.reset_index(drop=True, inplace=True)
 
+        # Remove triplets whose image or embedding already failed to load
+        self.quarantine = quarantine
+        if quarantine is not None:
+            self.df, n_quarantined = quarantine.filter(self.df)
+            if n_quarantined > 0:
+                print_dist(
+                    f"Skipping {n_quarantined} triplets with quarantined files ({len(quarantine)} in {quarantine.quarantine_pth})"
+                )
+
         self.max_words = max_words
 
         if iterate in ["idx", "triplets"]:
@@ -269,7 +296,10 @@ class CCCoIRDataset(Dataset):
 
         # Check if text embeddings exist
         self.txt2emb = None
-        if si_tc_weight > 0:
+        if si_tc_weight > 0 and txt_store is not None:
+            txt2s = self.df["txt2"].unique().tolist()
+            self.txt2emb = TextEmbStore(txt_store).lookup(txt2s)
+        elif si_tc_weight > 0:
             txt2emb_pth = Path(emb_dir) / f"../txt2_{self.annotation_pth.stem}.pth"
             if "blip2" in str(txt2emb_pth):
                 model = "blip2"
@@ -304,20 +334,40 @@ class CCCoIRDataset(Dataset):
             ann = ann.iloc[0]
 
         reference_img_pth = str(ann["path1"])
+        target_pth = str(ann["path2"])
+        if self.quarantine is not None and (
+            reference_img_pth in self.quarantine or target_pth in self.quarantine
+        ):
+            return None
         try:
-            reference_img = Image.open(reference_img_pth).convert("RGB")
+            reference_img = load_image(reference_img_pth, self.image_size)
             reference_img = self.transform(reference_img)
         except Exception as e:
             print(f"Error opening {reference_img_pth}: {e}")
-            reference_img = torch.zeros(3, self.image_size, self.image_size)
+            if self.quarantine is not None:
+                self.quarantine.add(reference_img_pth, f"{type(e).__name__}: {e}")
+                return None
+            batch_aug = getattr(self.transform, "batch_aug", False)
+            dtype = torch.uint8 if batch_aug else torch.float32
+            reference_img = torch.zeros(
+                3, self.image_size, self.image_size, dtype=dtype
+            )
 
         edit = ann["edit"]
         if isinstance(edit, list):
             edit = random.choice(edit)
         caption = pre_caption(edit, self.max_words)
 
-        target_pth = str(ann["path2"])
-        target_feat = torch.load(target_pth, weights_only=True).cpu()
+        try:
+            target_feat = (
+                torch.load(target_pth, weights_only=True).cpu().to(torch.float32)
+            )
+        except Exception as e:
+            if self.quarantine is None:
+                raise
+            print(f"Error loading {target_pth}: {e}")
+            self.quarantine.add(target_pth, f"{type(e).__name__}: {e}")
+            return None
 
         return_dict = {
             "ref_img": reference_img,
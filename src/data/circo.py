@@ -9,7 +9,7 @@ from torch.utils.data import DataLoader, Dataset
 from tqdm import tqdm
 
 from src.data.transforms import transform_test
-from src.data.utils import pre_caption
+from src.data.utils import load_image, pre_caption
 
 Image.MAX_IMAGE_PIXELS = None  # Disable DecompressionBombWarning
 
@@ -40,6 +40,7 @@ class CIRCOTestDataModule(LightningDataModule):
             data_path=data_path,
             emb_dir=emb_dir,
             split=split,
+            image_size=image_size,
         )
 
     def test_dataloader(self):
@@ -65,15 +66,18 @@ class CIRCODataset(Dataset):
         emb_dir: str,
         split: Literal["val", "test"],
         max_words: int = 30,
+        image_size: int = 384,
     ) -> None:
         """
         Args:
             transform (callable): function which preprocesses the image
             data_path (Union[str, Path]): path to CIRCO dataset
             split (str): dataset split, should be in ['test', 'val']
+            image_size (int): size the JPEGs are draft-decoded to
         """
 
         self.transform = transform
+        self.image_size = image_size
         data_path = Path(data_path)
         assert data_path.exists(), f"Annotation file {data_path} does not exist"
         self.split = split
@@ -117,7 +121,8 @@ class CIRCODataset(Dataset):
         emb_pth = self.emb_dir / "all_embs.pt"
         if emb_pth.exists():
             embs_dict = torch.load(emb_pth, weights_only=True)
-            self.embs = embs_dict["embs"]
+            # fp16 stores (save_blip2_embs.py) are cast back to fp32
+            self.embs = embs_dict["embs"].float()
             assert self.img_ids == embs_dict["ids"], "Image IDs do not match"
         else:
             emb_pths = list(self.emb_dir.glob("*.pth"))
@@ -130,7 +135,7 @@ class CIRCODataset(Dataset):
                 torch.load(img_id2emb_pth[img_id], weights_only=True)
                 for img_id in tqdm(self.img_ids)
             ]
-            self.embs = torch.stack(embs)
+            self.embs = torch.stack(embs).float()
             embs_dict = {
                 "ids": self.img_ids,
                 "embs": self.embs,
@@ -180,7 +185,7 @@ class CIRCODataset(Dataset):
         # Get the reference image
         reference_img_id = str(self.annotations[index]["reference_img_id"])
         reference_img_path = self.img_paths[self.img_ids_indexes_map[reference_img_id]]
-        reference_img = Image.open(reference_img_path).convert("RGB")
+        reference_img = load_image(reference_img_path, self.image_size)
         reference_img = self.transform(reference_img)
 
         if self.split == "test":
@@ -196,7 +201,7 @@ class CIRCODataset(Dataset):
         target_img_id = str(self.annotations[index]["target_img_id"])
         gt_img_ids = [str(x) for x in self.annotations[index]["gt_img_ids"]]
         target_img_path = self.img_paths[self.img_ids_indexes_map[target_img_id]]
-        target_img = Image.open(target_img_path).convert("RGB")
+        target_img = load_image(target_img_path, self.image_size)
         target_img = self.transform(target_img)
 
         # Pad ground truth image IDs with zeros for collate_fn
@@ -6,8 +6,8 @@ from lightning import LightningDataModule
 from PIL import Image
 from torch.utils.data import DataLoader, Dataset
 
-from src.data.transforms import transform_test, transform_train
-from src.data.utils import pre_caption
+from src.data.transforms import BatchAugmentCollate, transform_test, transform_train
+from src.data.utils import load_image, pre_caption
 
 Image.MAX_IMAGE_PIXELS = None  # Disable DecompressionBombWarning
 
@@ -22,6 +22,7 @@ class CIRRDataModule(LightningDataModule):
         img_dirs: dict = {"train": "", "val": ""},
         emb_dirs: dict = {"train": "", "val": ""},
         image_size: int = 384,
+        batch_aug: bool = False,
         **kwargs,  # type: ignore
     ) -> None:
         super().__init__()
@@ -30,8 +31,9 @@ class CIRRDataModule(LightningDataModule):
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.pin_memory = pin_memory
+        self.batch_aug = batch_aug
 
-        self.transform_train = transform_train(image_size)
+        self.transform_train = transform_train(image_size, batch_aug=batch_aug)
         self.transform_test = transform_test(image_size)
 
         self.data_train = CIRRDataset(
@@ -40,6 +42,7 @@ class CIRRDataModule(LightningDataModule):
             img_dir=img_dirs["train"],
             emb_dir=emb_dirs["train"],
             split="train",
+            image_size=image_size,
         )
         self.data_val = CIRRDataset(
             transform=self.transform_test,
@@ -47,6 +50,7 @@ class CIRRDataModule(LightningDataModule):
             img_dir=img_dirs["val"],
             emb_dir=emb_dirs["val"],
             split="val",
+            image_size=image_size,
         )
 
     def prepare_data(self):
@@ -60,6 +64,7 @@ class CIRRDataModule(LightningDataModule):
             batch_size=self.batch_size,
             num_workers=self.num_workers,
             pin_memory=self.pin_memory,
+            collate_fn=BatchAugmentCollate() if self.batch_aug else None,
             shuffle=True,
             drop_last=True,
         )
@@ -103,6 +108,7 @@ class CIRRTestDataModule(LightningDataModule):
             img_dir=img_dirs,
             emb_dir=emb_dirs,
             split=split,
+            image_size=image_size,
         )
 
     def test_dataloader(self):
@@ -125,10 +131,12 @@ class CIRRDataset(Dataset):
         emb_dir: str,
         split: str,
         max_words: int = 30,
+        image_size: int = 384,
     ) -> None:
         super().__init__()
 
         self.transform = transform
+        self.image_size = image_size
         self.annotation_pth = annotation
         assert Path(annotation).exists(), f"Annotation file {annotation} does not exist"
         self.annotation = json.load(open(annotation, "r"))
@@ -144,6 +152,10 @@ class CIRRDataset(Dataset):
         assert self.img_dir.exists(), f"Image directory {img_dir} does not exist"
         assert self.emb_dir.exists(), f"Embedding directory {emb_dir} does not exist"
 
+        if split != "train":
+            # 同一参考图的query相邻, 评测时同一个batch里只编码一次参考图
+            self.annotation.sort(key=lambda ann: ann["reference"])
+
         self.pairid2ref = {ann["pairid"]: ann["reference"] for ann in self.annotation}
         self.pairid2members = {
             ann["pairid"]: ann["img_set"]["members"] for ann in self.annotation
@@ -189,7 +201,7 @@ class CIRRDataset(Dataset):
         ann = self.annotation[index]
 
         reference_img_pth = self.id2imgpth[ann["reference"]]
-        reference_img = Image.open(reference_img_pth).convert("RGB")
+        reference_img = load_image(reference_img_pth, self.image_size)
         reference_img = self.transform(reference_img)
 
         caption = pre_caption(ann["caption"], self.max_words)
@@ -202,7 +214,8 @@ class CIRRDataset(Dataset):
             }
 
         target_emb_pth = self.id2embpth[ann["target_hard"]]
-        target_feat = torch.load(target_emb_pth, weights_only=True).cpu()
+        # fp16 stores (save_blip2_embs.py) are cast back to fp32
+        target_feat = torch.load(target_emb_pth, weights_only=True).cpu().float()
 
         return_dict = {
             "ref_img": reference_img,
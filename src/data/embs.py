@@ -8,7 +8,8 @@ from torch.utils.data import Dataset
 from torchvision import transforms
 from torchvision.transforms.functional import InterpolationMode
 
-from src.data.utils import pre_caption
+from src.data.embs_pipeline import get_done_ids
+from src.data.utils import load_image, pre_caption
 from src.tools.files import read_txt
 
 normalize = transforms.Normalize(
@@ -58,9 +59,7 @@ class ImageDataset(Dataset):
         )
 
         if save_dir is not None:
-            save_dir = Path(save_dir)
-            done_paths = list(save_dir.glob("*.pth"))
-            done_paths = {p.stem for p in done_paths}
+            done_paths = get_done_ids(save_dir, "*.pth")
             print(f"video_ids: {len(self.video_ids)} - {len(done_paths)} = ", end="")
             self.video_ids = list(set(self.video_ids) - done_paths)
             print(len(self.video_ids))
@@ -77,7 +76,7 @@ class ImageDataset(Dataset):
 
         img_pth = self.id2pth[video_id]
         try:
-            img = Image.open(img_pth).convert("RGB")
+            img = load_image(img_pth, self.image_size)
             img = self.transform(img)
         except:  # noqa: E722
             print(f"Image {img_pth} is corrupted")
@@ -98,6 +97,8 @@ class VideoDataset(Dataset):
         extension="mp4",
         save_dir=None,
         image_size=384,
+        frame_selection="uniform",
+        scene_threshold=0.1,
     ):
         self.video_dir = Path(video_dir)
 
@@ -116,9 +117,7 @@ class VideoDataset(Dataset):
         self.video_ids.sort()
 
         if save_dir is not None:
-            save_dir = Path(save_dir)
-            done_paths = list(save_dir.glob("*/*.pth"))
-            done_paths = {p.parent.name + "/" + p.stem for p in done_paths}
+            done_paths = get_done_ids(save_dir, "*/*.pth")
             print(f"video_ids: {len(self.video_ids)} - {len(done_paths)} = ", end="")
             self.video_ids = list(set(self.video_ids) - done_paths)
             print(len(self.video_ids))
@@ -137,6 +136,12 @@ class VideoDataset(Dataset):
 
         self.frames_video = frames_video
         self.image_size = image_size
+        assert frame_selection in [
+            "uniform",
+            "adaptive",
+        ], f"Invalid frame_selection: {frame_selection}, must be uniform or adaptive"
+        self.frame_selection = frame_selection
+        self.scene_threshold = scene_threshold
 
         self.transform = transforms.Compose(
             [
@@ -155,9 +160,14 @@ class VideoDataset(Dataset):
     def __getitem__(self, index):
         video_id = self.video_ids[index]
         video_path = self.id2path[video_id]
-        frames, f_idxs = get_video_frames(
-            video_path, self.frames_video, self.image_size
-        )
+        if self.frame_selection == "adaptive":
+            frames, f_idxs = get_video_frames_adaptive(
+                video_path, self.frames_video, self.image_size, self.scene_threshold
+            )
+        else:
+            frames, f_idxs = get_video_frames(
+                video_path, self.frames_video, self.image_size
+            )
         frames = [self.transform(frame) for frame in frames]
         frames = torch.stack(frames, dim=0)
         f_idxs = torch.tensor(f_idxs)
@@ -170,17 +180,22 @@ class TextDataset(Dataset):
         self,
         csv_path,
         max_words=30,
+        column="edit",
+        txt_processor=None,
     ):
         self.df = pd.read_csv(csv_path)
-        self.texts = list(set(self.df["edit"].unique().tolist()))
+        self.texts = list(set(self.df[column].unique().tolist()))
         self.texts.sort()
         self.max_words = max_words
+        self.txt_processor = txt_processor
 
     def __len__(self):
         return len(self.texts)
 
     def __getitem__(self, index):
         txt = self.texts[index]
+        if self.txt_processor is not None:
+            return self.txt_processor(txt)
         txt = pre_caption(txt, self.max_words)
 
         return txt
@@ -229,6 +244,75 @@ def get_video_frames(video_pth, frames_video=15, image_size=384):
     return frames, f_idxs
 
 
+def get_video_frames_adaptive(
+    video_pth, frames_video=15, image_size=384, threshold=0.1, thumb_size=16
+):
+    """
+    Read the video sequentially and keep only the frames that differ from the
+    last kept frame. The signature of a frame is a thumb_size x thumb_size
+    grayscale thumbnail, and a frame is kept when the mean absolute difference
+    of the signatures (in [0, 1]) is above threshold. At most frames_video
+    frames are returned, uniformly spread over the kept ones, padded like
+    get_video_frames so that videos can be batched.
+    """
+    import cv2
+
+    video_pth = str(video_pth)
+    cap = cv2.VideoCapture(video_pth)
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    # only compare a few frames per uniform interval, grab() skips the others
+    stride = max(total_frames // (4 * frames_video), 1)
+
+    kept_frames = []
+    kept_idxs = []
+    last_sig = None
+    frame_idx = 0
+    while cap.grab():
+        if frame_idx % stride == 0:
+            ret, frame = cap.retrieve()
+            if not ret or frame is None:
+                break
+            sig = cv2.resize(
+                cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY),
+                (thumb_size, thumb_size),
+                interpolation=cv2.INTER_AREA,
+            )
+            sig = sig.astype(np.float32) / 255
+            if last_sig is None or np.abs(sig - last_sig).mean() > threshold:
+                kept_frames.append(frame)
+                kept_idxs.append(frame_idx)
+                last_sig = sig
+        frame_idx += 1
+    cap.release()
+
+    if len(kept_frames) == 0:
+        print(f"Video {video_pth} is corrupted")
+        frames = [
+            Image.fromarray(np.zeros((image_size, image_size, 3)).astype(np.uint8))
+        ] * frames_video
+        f_idxs = [-1] * frames_video
+        return frames, f_idxs
+
+    if len(kept_frames) > frames_video:
+        selected = sample_frames(len(kept_frames), frames_video)
+        kept_frames = [kept_frames[i] for i in selected]
+        kept_idxs = [kept_idxs[i] for i in selected]
+
+    frames = [Image.fromarray(frame) for frame in kept_frames]
+    f_idxs = kept_idxs
+
+    # pad frames to have the same number of frames
+    n_frames = len(frames)
+    if n_frames < frames_video:
+        frames += [
+            Image.fromarray(np.zeros((image_size, image_size, 3)).astype(np.uint8))
+        ] * (frames_video - n_frames)
+    f_idxs += [-1] * (frames_video - len(f_idxs))
+
+    return frames, f_idxs
+
+
 def sample_frames(vlen, frames_per_video=15):
     acc_samples = min(vlen, frames_per_video)
     intervals = np.linspace(start=0, stop=vlen, num=acc_samples + 1).astype(int)
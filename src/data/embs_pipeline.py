@@ -0,0 +1,307 @@
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import torch
+
+
+class StageTimer:
+    """
+    Busy time and item count of each stage of the extraction pipeline.
+
+    The stages run concurrently, so the one with the lowest throughput
+    (items / busy time) is the bottleneck. decode_wait (main loop waiting for
+    the DataLoader workers) and writer_wait (main loop blocked on a full write
+    queue) are large when decoding or writing is the bottleneck.
+    """
+
+    def __init__(self):
+        self.busy = defaultdict(float)
+        self.items = defaultdict(int)
+        self.lock = threading.Lock()
+        self.start = time.time()
+
+    def add(self, stage: str, seconds: float, items: int = 0):
+        with self.lock:
+            self.busy[stage] += seconds
+            self.items[stage] += items
+
+    def summary(self) -> str:
+        elapsed = time.time() - self.start
+        with self.lock:
+            parts = []
+            for stage, busy in self.busy.items():
+                rate = self.items[stage] / busy if busy > 0 else float("inf")
+                parts.append(
+                    f"{stage}: {rate:.1f} it/s ({100 * busy / max(elapsed, 1e-6):.0f}% busy)"
+                )
+        return " | ".join(parts)
+
+
+class Journal:
+    """
+    Append-only list of the embedding ids that are completely written.
+
+    Each shard appends to its own journal_dir/<name>.txt, one id per line, only
+    after the embedding file was fsync'ed and renamed to its final path. Resuming
+    reads the journals instead of globbing the output tree, and a file without a
+    journal entry (e.g. interrupted write) is computed again.
+    """
+
+    def __init__(self, journal_dir, name: str = "shard0"):
+        self.journal_dir = Path(journal_dir)
+        self.journal_dir.mkdir(parents=True, exist_ok=True)
+        self.journal_pth = self.journal_dir / f"{name}.txt"
+        self.lock = threading.Lock()
+
+    def add(self, emb_ids):
+        lines = "".join(f"{emb_id}\n" for emb_id in emb_ids)
+        with self.lock:
+            fd = os.open(self.journal_pth, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+            try:
+                os.write(fd, lines.encode())
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+
+def get_done_ids(save_dir, pattern: str) -> set:
+    """
+    Ids already extracted in save_dir, read from save_dir/journal. Output trees
+    written before the journals existed are globbed once with pattern, and the
+    found ids are recorded in the journal.
+    """
+    save_dir = Path(save_dir)
+    journal_dir = save_dir / "journal"
+    if journal_dir.exists():
+        return read_journals(journal_dir)
+    print(f"No journal in {save_dir}, globbing {pattern}")
+    done_pths = save_dir.glob(pattern)
+    if pattern.startswith("*/"):
+        done_ids = {p.parent.name + "/" + p.stem for p in done_pths}
+    else:
+        done_ids = {p.stem for p in done_pths}
+    # seed the journal so that the next runs do not glob again
+    Journal(journal_dir, "legacy").add(sorted(done_ids))
+    return done_ids
+
+
+def read_journals(journal_dir) -> set:
+    """Ids completed by every shard, an incomplete last line is ignored."""
+    done_ids = set()
+    for journal_pth in Path(journal_dir).glob("*.txt"):
+        with open(journal_pth) as f:
+            for line in f:
+                if line.endswith("\n"):
+                    done_ids.add(line[:-1])
+    return done_ids
+
+
+def atomic_save(obj, save_pth: Path):
+    """
+    torch.save to a temporary file, fsync it, then rename it to save_pth. The
+    temporary file is unique, so concurrent writers of save_pth do not mix.
+    """
+    save_pth = Path(save_pth)
+    fd, tmp_pth = tempfile.mkstemp(
+        dir=save_pth.parent, prefix=f"{save_pth.name}.", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            torch.save(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates the file 0600, keep the permissions of open()
+        os.chmod(tmp_pth, 0o644)
+        os.replace(tmp_pth, save_pth)
+    except BaseException:
+        if os.path.exists(tmp_pth):
+            os.remove(tmp_pth)
+        raise
+
+
+class DevicePrefetcher:
+    """
+    Iterate over a loader and copy the next batch to the device on a side CUDA
+    stream while the current one is being processed (double buffering). The
+    loader should use pin_memory=True for the copies to be asynchronous. On CPU
+    the batches are returned as is.
+    """
+
+    def __init__(self, loader, device, timer: StageTimer = None):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.timer = timer
+        self.stream = torch.cuda.Stream() if self.device.type == "cuda" else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def to_device(self, batch):
+        if isinstance(batch, torch.Tensor):
+            return batch.to(self.device, non_blocking=True)
+        if isinstance(batch, (list, tuple)):
+            return type(batch)(self.to_device(b) for b in batch)
+        if isinstance(batch, dict):
+            return {k: self.to_device(v) for k, v in batch.items()}
+        return batch
+
+    def record_stream(self, batch, stream):
+        """The batch memory is used by stream: not reused before its work is done."""
+        if isinstance(batch, torch.Tensor):
+            if batch.is_cuda:
+                batch.record_stream(stream)
+        elif isinstance(batch, (list, tuple)):
+            for b in batch:
+                self.record_stream(b, stream)
+        elif isinstance(batch, dict):
+            for b in batch.values():
+                self.record_stream(b, stream)
+
+    def load(self, it):
+        start = time.time()
+        try:
+            batch = next(it)
+        except StopIteration:
+            return None
+        if self.timer is not None:
+            self.timer.add("decode_wait", time.time() - start, len(batch[0]))
+        if self.stream is None:
+            return batch
+        with torch.cuda.stream(self.stream):
+            return self.to_device(batch)
+
+    def __iter__(self):
+        it = iter(self.loader)
+        next_batch = self.load(it)
+        while next_batch is not None:
+            if self.stream is not None:
+                current_stream = torch.cuda.current_stream()
+                current_stream.wait_stream(self.stream)
+                # allocated on the side stream, read on the current one
+                self.record_stream(next_batch, current_stream)
+            batch = next_batch
+            next_batch = self.load(it)
+            yield batch
+
+
+class EmbWriter:
+    """
+    Background thread pool writing the embeddings while the next batch runs.
+
+    With shard_size=0 every embedding is saved to save_dir/<id>.pth, which is
+    the layout read by the datasets. Otherwise embeddings are packed in
+    save_dir/shards/<prefix>_<n>.pth files of shard_size items (see
+    load_emb_shard). At most max_pending writes are queued, so a slow disk
+    applies back-pressure instead of accumulating batches in memory.
+
+    Files are written atomically, and with a journal the ids of every written
+    file (or shard) are appended to it afterwards, for resuming.
+    """
+
+    def __init__(
+        self,
+        save_dir,
+        num_writers: int = 4,
+        max_pending: int = 64,
+        dtype=torch.float16,
+        shard_size: int = 0,
+        shard_prefix: str = "shard",
+        timer: StageTimer = None,
+        journal: Journal = None,
+    ):
+        self.save_dir = Path(save_dir)
+        self.dtype = dtype
+        self.shard_size = shard_size
+        self.shard_prefix = shard_prefix
+        self.timer = timer
+        self.journal = journal
+        self.executor = ThreadPoolExecutor(num_writers)
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.errors = []
+
+        self.shard = []
+        self.n_shards = 0
+        if shard_size > 0:
+            (self.save_dir / "shards").mkdir(parents=True, exist_ok=True)
+            # continue the numbering of a previous run with the same prefix
+            self.n_shards = len(
+                list((self.save_dir / "shards").glob(f"{shard_prefix}_*.pth"))
+            )
+
+    def submit(self, emb_id: str, feat: torch.Tensor):
+        # clone so that the file does not store the storage of the whole batch
+        feat = feat.to("cpu", self.dtype).clone()
+        if self.shard_size > 0:
+            self.shard.append((emb_id, feat))
+            if len(self.shard) >= self.shard_size:
+                self.flush_shard()
+            return
+        self.enqueue(self.write_file, emb_id, feat)
+
+    def enqueue(self, fn, *args):
+        start = time.time()
+        self.pending.acquire()
+        if self.timer is not None:
+            self.timer.add("writer_wait", time.time() - start)
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(self.done)
+
+    def done(self, future):
+        self.pending.release()
+        if future.exception() is not None:
+            self.errors.append(future.exception())
+
+    def write_file(self, emb_id, feat):
+        start = time.time()
+        save_pth = self.save_dir / f"{emb_id}.pth"
+        save_pth.parent.mkdir(parents=True, exist_ok=True)
+        atomic_save(feat, save_pth)
+        if self.journal is not None:
+            self.journal.add([emb_id])
+        if self.timer is not None:
+            self.timer.add("write", time.time() - start, 1)
+
+    def flush_shard(self):
+        if len(self.shard) == 0:
+            return
+        shard_pth = (
+            self.save_dir / "shards" / f"{self.shard_prefix}_{self.n_shards:05d}.pth"
+        )
+        self.enqueue(self.write_shard, shard_pth, self.shard)
+        self.shard = []
+        self.n_shards += 1
+
+    def write_shard(self, shard_pth, items):
+        start = time.time()
+        ids = [emb_id for emb_id, _ in items]
+        feats = [feat for _, feat in items]
+        atomic_save(
+            {
+                "ids": ids,
+                "lengths": torch.tensor([len(feat) for feat in feats]),
+                "feats": torch.cat(feats, dim=0),
+            },
+            shard_pth,
+        )
+        if self.journal is not None:
+            self.journal.add(ids)
+        if self.timer is not None:
+            self.timer.add("write", time.time() - start, len(items))
+
+    def close(self):
+        self.flush_shard()
+        self.executor.shutdown(wait=True)
+        if len(self.errors) > 0:
+            raise RuntimeError(f"{len(self.errors)} writes failed") from self.errors[0]
+
+
+def load_emb_shard(shard_pth):
+    """Read a shard written by EmbWriter as a dict id -> embedding."""
+    shard = torch.load(shard_pth, weights_only=True)
+    feats = shard["feats"].split(shard["lengths"].tolist())
+    return dict(zip(shard["ids"], feats))
@@ -6,8 +6,8 @@ from lightning import LightningDataModule
 from PIL import Image
 from torch.utils.data import DataLoader, Dataset
 
-from src.data.transforms import transform_test, transform_train
-from src.data.utils import pre_caption
+from src.data.transforms import BatchAugmentCollate, transform_test, transform_train
+from src.data.utils import load_image, pre_caption
 
 Image.MAX_IMAGE_PIXELS = None  # Disable DecompressionBombWarning
 
@@ -23,6 +23,7 @@ class FashionIQDataModule(LightningDataModule):
         img_dirs: dict = {"train": "", "val": ""},
         emb_dirs: dict = {"train": "", "val": ""},
         image_size: int = 384,
+        batch_aug: bool = False,
         **kwargs,  # type: ignore
     ) -> None:
         super().__init__()
@@ -31,8 +32,9 @@ class FashionIQDataModule(LightningDataModule):
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.pin_memory = pin_memory
+        self.batch_aug = batch_aug
 
-        self.transform_train = transform_train(image_size)
+        self.transform_train = transform_train(image_size, batch_aug=batch_aug)
         self.transform_test = transform_test(image_size)
 
         self.data_train = FashionIQDataset(
@@ -42,6 +44,7 @@ class FashionIQDataModule(LightningDataModule):
             img_dir=img_dirs["train"],
             emb_dir=emb_dirs["train"],
             split="train",
+            image_size=image_size,
         )
         self.data_val = FashionIQDataset(
             transform=self.transform_test,
@@ -50,6 +53,7 @@ class FashionIQDataModule(LightningDataModule):
             img_dir=img_dirs["val"],
             emb_dir=emb_dirs["val"],
             split="val",
+            image_size=image_size,
         )
 
     def train_dataloader(self):
@@ -58,6 +62,7 @@ class FashionIQDataModule(LightningDataModule):
             batch_size=self.batch_size,
             num_workers=self.num_workers,
             pin_memory=self.pin_memory,
+            collate_fn=BatchAugmentCollate() if self.batch_aug else None,
             shuffle=True,
             drop_last=True,
         )
@@ -102,6 +107,7 @@ class FashionIQTestDataModule(LightningDataModule):
             img_dir=img_dirs,
             emb_dir=emb_dirs,
             split="test",
+            image_size=image_size,
         )
 
     def test_dataloader(self):
@@ -125,10 +131,12 @@ class FashionIQDataset(Dataset):
         emb_dir: str,
         split: str,
         max_words: int = 30,
+        image_size: int = 384,
     ) -> None:
         super().__init__()
 
         self.transform = transform
+        self.image_size = image_size
         self.annotation_pth = annotation
         assert Path(annotation).exists(), f"Annotation file {annotation} does not exist"
         self.annotation = json.load(open(annotation, "r"))
@@ -152,6 +160,10 @@ class FashionIQDataset(Dataset):
         self.id2int = {id: i for i, id in enumerate(self.target_ids)}
         self.int2id = {i: id for i, id in enumerate(self.target_ids)}
 
+        if split != "train":
+            # 同一参考图的query相邻, 评测时同一个batch里只编码一次参考图
+            self.annotation.sort(key=lambda ann: ann["candidate"])
+
         self.pairid2ref = {
             id: self.id2int[ann["candidate"]] for id, ann in enumerate(self.annotation)
         }
@@ -185,7 +197,7 @@ class FashionIQDataset(Dataset):
         ann = self.annotation[index]
 
         reference_img_pth = self.id2imgpth[ann["candidate"]]
-        reference_img = Image.open(reference_img_pth).convert("RGB")
+        reference_img = load_image(reference_img_pth, self.image_size)
         reference_img = self.transform(reference_img)
 
         cap1, cap2 = ann["captions"]
@@ -193,7 +205,8 @@ class FashionIQDataset(Dataset):
         caption = pre_caption(caption, self.max_words)
 
         target_emb_pth = self.id2embpth[ann["target"]]
-        target_feat = torch.load(target_emb_pth, weights_only=True).cpu()
+        # fp16 stores (save_blip2_embs.py) are cast back to fp32
+        target_feat = torch.load(target_emb_pth, weights_only=True).cpu().float()
 
         return {
             "ref_img": reference_img,
@@ -5,6 +5,9 @@ from lightning import LightningDataModule
 from omegaconf import OmegaConf
 from torch.utils.data import ConcatDataset, DataLoader
 
+from src.data.my_utils import collate_fn
+from src.data.transforms import BatchAugmentCollate
+
 
 class MergedDataModule(LightningDataModule):
     def __init__(
@@ -13,6 +16,7 @@ class MergedDataModule(LightningDataModule):
         num_workers: int = 4,
         pin_memory: bool = True,
         sampler_weights: str = "uniform",
+        batch_aug: bool = False,
         **kwargs,  # type: ignore
     ):
         super().__init__()
@@ -21,6 +25,7 @@ class MergedDataModule(LightningDataModule):
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.pin_memory = pin_memory
+        self.batch_aug = batch_aug
 
         datasets_cfg = [kwargs[k] for k in kwargs if "dataset-" in k]
         assert len(datasets_cfg) > 0, "No datasets found"
@@ -31,6 +36,8 @@ class MergedDataModule(LightningDataModule):
             assert "dataname" in dataset_cfg, "Dataset must have a dataname"
             print(f"Loading {dataset_cfg.dataname}")
             dataset_cfg = OmegaConf.create(dataset_cfg)
+            # all datasets must return uint8 images for the batched augmentation
+            dataset_cfg.batch_aug = batch_aug
             dataset = instantiate(dataset_cfg)
             datasets_train.append(dataset.data_train)
             datasets_val.append(dataset.data_val)
@@ -46,6 +53,9 @@ class MergedDataModule(LightningDataModule):
             batch_size=self.batch_size,
             num_workers=self.num_workers,
             pin_memory=self.pin_memory,
+            collate_fn=(
+                BatchAugmentCollate(collate_fn) if self.batch_aug else collate_fn
+            ),
             shuffle=False,
             drop_last=True,
             sampler=self.sampler,
@@ -57,6 +67,7 @@ class MergedDataModule(LightningDataModule):
             batch_size=self.batch_size,
             num_workers=self.num_workers,
             pin_memory=self.pin_memory,
+            collate_fn=collate_fn,
             shuffle=False,
             drop_last=False,
         )
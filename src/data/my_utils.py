@@ -1,5 +1,7 @@
 import torch
 import os
+
+from src.data.text_tokens import pad_tokens
 #改动
 #因为这里有些pth文件加载不出来，报错了,所以我要调试一下
 def load_target_embedding(target_pth):
@@ -24,9 +26,17 @@ def collate_fn(batch):
     # 如果过滤后批次为空，返回 None（需配合 DataLoader 的 drop_last=True）
     if len(batch) == 0:
         return None
-    
+
+    # 预先tokenize的修改文本长度不一, 在worker里按batch内最长的补齐
+    edit_ids = None
+    if "edit_ids" in batch[0]:
+        edit_ids = [item.pop("edit_ids") for item in batch]
+
     # 将有效样本组合成张量
-    return torch.utils.data.dataloader.default_collate(batch)
+    batch = torch.utils.data.dataloader.default_collate(batch)
+    if edit_ids is not None:
+        batch["edit_ids"], batch["edit_atts"] = pad_tokens(edit_ids)
+    return batch
 
 
 #调试哪些文件损坏了
@@ -0,0 +1,71 @@
+import json
+import os
+import time
+from pathlib import Path
+from typing import Union
+
+
+class Quarantine:
+    """
+    Registry of media files that failed to decode or load.
+
+    Entries are appended as JSON lines ({"path", "reason", "time"}) to a single file,
+    so every dataloader worker, rank and later run sees the failures found by the
+    others. Datasets drop the triplets pointing to a quarantined file when they
+    build their index, instead of rediscovering the failure on every epoch.
+    """
+
+    def __init__(self, quarantine_pth: Union[Path, str]):
+        self.quarantine_pth = Path(quarantine_pth)
+        self.quarantine_pth.parent.mkdir(parents=True, exist_ok=True)
+        self.reasons = {}
+        self._offset = 0
+        self.refresh()
+
+    def refresh(self):
+        """Read the entries appended (by any process) since the last refresh."""
+        if not self.quarantine_pth.exists():
+            return
+        if self.quarantine_pth.stat().st_size == self._offset:
+            return
+        with open(self.quarantine_pth) as f:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith("\n"):
+                    # entry still being written, read it on the next refresh
+                    break
+                self._offset += len(line.encode())
+                entry = json.loads(line)
+                self.reasons[entry["path"]] = entry["reason"]
+
+    def add(self, pth, reason: str):
+        pth = str(pth)
+        if pth in self.reasons:
+            return
+        self.reasons[pth] = reason
+        line = json.dumps({"path": pth, "reason": reason, "time": time.time()}) + "\n"
+        # a single write on an O_APPEND descriptor is atomic across processes
+        fd = os.open(self.quarantine_pth, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+
+    def __contains__(self, pth) -> bool:
+        self.refresh()
+        return str(pth) in self.reasons
+
+    def __len__(self) -> int:
+        return len(self.reasons)
+
+    def filter(self, df, columns=["path1", "path2"]):
+        """Drop the rows of df whose files in columns are quarantined."""
+        self.refresh()
+        keep = ~df[columns].astype(str).isin(self.reasons.keys()).any(axis=1)
+        return df[keep].reset_index(drop=True), int((~keep).sum())
+
+
+def get_quarantine(quarantine_pth):
+    if quarantine_pth is None:
+        return None
+    return Quarantine(quarantine_pth)
@@ -2,6 +2,8 @@
 
 import cv2
 import numpy as np
+import torch
+import torch.nn.functional as F
 
 
 ## aug functions
@@ -343,7 +345,322 @@ class RandomAugment(object):
         return img
 
 
+## batched tensor versions of the aug functions
+# Images are float tensors (B, C, H, W) holding integer values in [0, 255], args
+# are per-image tensors of shape (B,). Every op quantizes its output the same way
+# the uint8 numpy version does, so ops can be chained.
+def _per_image(arg, imgs):
+    return arg.to(imgs.device, imgs.dtype).view(-1, 1, 1, 1)
+
+
+def identity_batch(imgs):
+    return imgs
+
+
+def autocontrast_batch(imgs):
+    """
+    same output as autocontrast_func (cutoff=0), per image and channel
+    """
+    low = imgs.amin(dim=(2, 3), keepdim=True)
+    high = imgs.amax(dim=(2, 3), keepdim=True)
+    scale = 255.0 / (high - low).clamp(min=1)
+    out = ((imgs - low) * scale).clamp(0, 255).floor()
+    return torch.where(high > low, out, imgs)
+
+
+def equalize_batch(imgs):
+    """
+    same output as equalize_func, histograms of all channels in one bincount
+    """
+    B, C, H, W = imgs.shape
+    n_bins = 256
+    flat = imgs.reshape(B * C, H * W).long()
+    offsets = torch.arange(B * C, device=imgs.device).view(-1, 1) * n_bins
+    hist = torch.bincount((flat + offsets).view(-1), minlength=B * C * n_bins)
+    hist = hist.view(B * C, n_bins)
+    # count of the last non-zero bin, i.e. of the max value
+    last = hist.gather(1, flat.amax(dim=1, keepdim=True))
+    step = (H * W - last) // (n_bins - 1)
+    n = torch.cat([step // 2, hist[:, :-1]], dim=1)
+    table = (n.cumsum(dim=1) // step.clamp(min=1)).clamp(0, 255)
+    out = torch.where(step > 0, table.gather(1, flat), flat)
+    return out.view(B, C, H, W).to(imgs.dtype)
+
+
+def solarize_batch(imgs, thresh):
+    thresh = _per_image(thresh, imgs)
+    return torch.where(imgs < thresh, imgs, 255 - imgs)
+
+
+def color_batch(imgs, factor):
+    """
+    same output as color_func
+    """
+    M = torch.tensor(
+        [[0.886, -0.114, -0.114], [-0.587, 0.413, -0.587], [-0.299, -0.299, 0.701]],
+        dtype=imgs.dtype,
+        device=imgs.device,
+    )
+    offset = torch.tensor([[0.114], [0.587], [0.299]], dtype=imgs.dtype, device=imgs.device)
+    M = M * _per_image(factor, imgs).view(-1, 1, 1) + offset  # (B, 3, 3)
+    out = torch.einsum("bchw,bcd->bdhw", imgs, M)
+    return out.clamp(0, 255).floor()
+
+
+def contrast_batch(imgs, factor):
+    """
+    same output as contrast_func
+    """
+    weights = torch.tensor([0.114, 0.587, 0.299], dtype=imgs.dtype, device=imgs.device)
+    mean = (imgs.mean(dim=(2, 3)) * weights).sum(dim=1).view(-1, 1, 1, 1)
+    out = (imgs - mean) * _per_image(factor, imgs) + mean
+    return out.clamp(0, 255).floor()
+
+
+def brightness_batch(imgs, factor):
+    """
+    same output as brightness_func
+    """
+    return (imgs * _per_image(factor, imgs)).clamp(0, 255).floor()
+
+
+def sharpness_batch(imgs, factor):
+    """
+    same output as sharpness_func, borders are left untouched
+    """
+    C = imgs.size(1)
+    kernel = torch.ones((3, 3), dtype=imgs.dtype, device=imgs.device)
+    kernel[1][1] = 5
+    kernel /= 13
+    kernel = kernel.expand(C, 1, 3, 3)
+    # cv2.filter2D defaults to BORDER_REFLECT_101, which is torch's "reflect"
+    degenerate = F.conv2d(F.pad(imgs, (1, 1, 1, 1), mode="reflect"), kernel, groups=C)
+    degenerate = degenerate.round().clamp(0, 255)
+
+    factor = _per_image(factor, imgs)
+    out = imgs.clone()
+    inner = degenerate[..., 1:-1, 1:-1]
+    out[..., 1:-1, 1:-1] = inner + factor * (imgs[..., 1:-1, 1:-1] - inner)
+    out = out.clamp(0, 255).floor()
+    return torch.where(factor == 0, degenerate, out)
+
+
+def posterize_batch(imgs, bits):
+    shift = 2.0 ** (8 - _per_image(bits, imgs))
+    return (imgs / shift).floor() * shift
+
+
+## affine matrices (same convention as the cv2.warpAffine calls above)
+def _affine(n, device):
+    return torch.eye(3, device=device).repeat(n, 1, 1)
+
+
+def shear_x_matrix(factor, H, W):
+    M = _affine(len(factor), factor.device)
+    M[:, 0, 1] = factor
+    return M
+
+
+def shear_y_matrix(factor, H, W):
+    M = _affine(len(factor), factor.device)
+    M[:, 1, 0] = factor
+    return M
+
+
+def translate_x_matrix(offset, H, W):
+    M = _affine(len(offset), offset.device)
+    M[:, 0, 2] = -offset
+    return M
+
+
+def translate_y_matrix(offset, H, W):
+    M = _affine(len(offset), offset.device)
+    M[:, 1, 2] = -offset
+    return M
+
+
+def rotate_matrix(degree, H, W):
+    """
+    like cv2.getRotationMatrix2D((W / 2, H / 2), degree, 1)
+    """
+    M = _affine(len(degree), degree.device)
+    rad = torch.deg2rad(degree)
+    alpha, beta = torch.cos(rad), torch.sin(rad)
+    cx, cy = W / 2, H / 2
+    M[:, 0, 0] = alpha
+    M[:, 0, 1] = beta
+    M[:, 0, 2] = (1 - alpha) * cx - beta * cy
+    M[:, 1, 0] = -beta
+    M[:, 1, 1] = alpha
+    M[:, 1, 2] = beta * cx + (1 - alpha) * cy
+    return M
+
+
+def warp_affine_batch(imgs, M, fill=(0, 0, 0)):
+    """
+    cv2.warpAffine(img, M[:2], (W, H), borderValue=fill) for a whole batch with a
+    single affine_grid / grid_sample call. M: (B, 3, 3) forward maps in pixels.
+    """
+    B, C, H, W = imgs.shape
+    # pixel -> normalized coordinates (align_corners=False)
+    N = torch.tensor(
+        [[2.0 / W, 0, 1.0 / W - 1], [0, 2.0 / H, 1.0 / H - 1], [0, 0, 1]],
+        dtype=imgs.dtype,
+        device=imgs.device,
+    )
+    theta = N @ torch.linalg.inv(M.to(imgs.dtype)) @ torch.linalg.inv(N)
+    grid = F.affine_grid(theta[:, :2], (B, C, H, W), align_corners=False)
+    fill = torch.tensor(fill, dtype=imgs.dtype, device=imgs.device).view(1, -1, 1, 1)
+    out = F.grid_sample(
+        imgs - fill, grid, mode="bilinear", padding_mode="zeros", align_corners=False
+    )
+    return (out + fill).round().clamp(0, 255)
+
+
+batch_func_dict = {
+    "Identity": identity_batch,
+    "AutoContrast": autocontrast_batch,
+    "Equalize": equalize_batch,
+    "Solarize": solarize_batch,
+    "Color": color_batch,
+    "Contrast": contrast_batch,
+    "Brightness": brightness_batch,
+    "Sharpness": sharpness_batch,
+    "Posterize": posterize_batch,
+}
+
+affine_matrix_dict = {
+    "Rotate": rotate_matrix,
+    "ShearX": shear_x_matrix,
+    "TranslateX": translate_x_matrix,
+    "TranslateY": translate_y_matrix,
+    "ShearY": shear_y_matrix,
+}
+
+
+### level to per-image args
+def _random_sign(n):
+    return torch.where(torch.rand(n) < 0.5, -1.0, 1.0)
+
+
+def batch_level_to_args(name, level, n):
+    if name in ["Identity", "AutoContrast", "Equalize"]:
+        return ()
+    if name in ["Color", "Contrast", "Brightness", "Sharpness"]:
+        return (torch.full((n,), (level / MAX_LEVEL) * 1.8 + 0.1),)
+    if name in ["ShearX", "ShearY"]:
+        return ((level / MAX_LEVEL) * 0.3 * _random_sign(n),)
+    if name in ["TranslateX", "TranslateY"]:
+        return ((level / MAX_LEVEL) * float(translate_const) * _random_sign(n),)
+    if name == "Rotate":
+        return ((level / MAX_LEVEL) * 30 * _random_sign(n),)
+    if name == "Solarize":
+        return (torch.full((n,), float(int((level / MAX_LEVEL) * 256))),)
+    if name == "Posterize":
+        return (torch.full((n,), float(int((level / MAX_LEVEL) * 4))),)
+    raise ValueError(f"Invalid aug: {name}")
+
+
+class BatchRandomAugment(object):
+    """
+    Tensor version of RandomAugment for uint8 batches (B, C, H, W) after collate.
+    Ops are sampled per image like RandomAugment; each op then runs once on all the
+    images that drew it, and the affine ops of a round share one grid_sample.
+    """
+
+    def __init__(self, N=2, M=10, augs=[]):
+        self.N = N
+        self.M = M
+        if augs:
+            self.augs = augs
+        else:
+            self.augs = list(arg_dict.keys())
+        for aug in self.augs:
+            assert (
+                aug in batch_func_dict or aug in affine_matrix_dict
+            ), f"Invalid aug: {aug}"
+
+    def __call__(self, imgs):
+        assert imgs.dtype == torch.uint8, f"Expected uint8 images, got {imgs.dtype}"
+        assert imgs.dim() == 4, f"Expected (B, C, H, W) images, got {imgs.shape}"
+        B, _, H, W = imgs.shape
+        imgs = imgs.float()
+
+        for _ in range(self.N):
+            sampled_ops = torch.randint(len(self.augs), (B,))
+            # RandomAugment skips an op if np.random.random() > prob (0.5)
+            keep = torch.rand(B) <= 0.5
+            M = _affine(B, imgs.device)
+            warp = torch.zeros(B, dtype=torch.bool)
+            for op_id, name in enumerate(self.augs):
+                idxs = torch.nonzero(keep & (sampled_ops == op_id)).view(-1)
+                if len(idxs) == 0:
+                    continue
+                args = batch_level_to_args(name, self.M, len(idxs))
+                if name in affine_matrix_dict:
+                    M[idxs] = affine_matrix_dict[name](*args, H, W).to(imgs.device)
+                    warp[idxs] = True
+                else:
+                    imgs[idxs] = batch_func_dict[name](imgs[idxs], *args)
+            if warp.any():
+                idxs = torch.nonzero(warp).view(-1)
+                imgs[idxs] = warp_affine_batch(imgs[idxs], M[idxs], replace_value)
+
+        return imgs.to(torch.uint8)
+
+
 if __name__ == "__main__":
     a = RandomAugment()
     img = np.random.randn(32, 32, 3)
     a(img)
+
+    # Per-op parity of the batched ops with the numpy ones, at fixed magnitudes.
+    # The point ops match up to float rounding (off by one on a few pixels);
+    # the affine ops differ from cv2's fixed-point bilinear interpolation by a
+    # few levels at most, while a wrong warp or op ordering moves whole pixels
+    # of the noisy images and fails by tens of levels.
+    B, H, W = 8, 96, 128
+    ramp = np.linspace(0, 255, W)[None, :, None] * np.linspace(0.3, 1, H)[:, None, None]
+    imgs = (ramp + np.random.randint(0, 60, (B, H, W, 3))).clip(0, 255).astype(np.uint8)
+    imgs_t = torch.from_numpy(imgs).permute(0, 3, 1, 2).float()
+
+    for level in [3, 5, 9]:
+        for name in BatchRandomAugment().augs:
+            if name == "Sharpness" and level > 5:
+                # factor > 1: sharpness_func casts to uint8 without clipping (wraps)
+                continue
+            args = batch_level_to_args(name, level, B)
+            if name in affine_matrix_dict:
+                out = warp_affine_batch(
+                    imgs_t, affine_matrix_dict[name](*args, H, W), replace_value
+                )
+            else:
+                out = batch_func_dict[name](imgs_t, *args)
+            out = out.permute(0, 2, 3, 1).numpy()
+
+            ref = []
+            for i in range(B):
+                img_args = tuple(arg[i].item() for arg in args)
+                if name in ["Solarize", "Posterize"]:
+                    img_args = tuple(int(arg) for arg in img_args)
+                if name in affine_matrix_dict:
+                    img_args = img_args + (replace_value,)
+                ref.append(func_dict[name](imgs[i], *img_args))
+            ref = np.stack(ref).astype(np.float32)
+
+            diff = np.abs(out - ref)
+            print(
+                f"{name:<12} level {level}  |diff| mean {diff.mean():.3f}"
+                f" max {diff.max():.0f}  >1: {(diff > 1).mean():.4f}"
+            )
+            if name in affine_matrix_dict:
+                assert diff.mean() < 0.5, f"{name} level {level}: {diff.mean()}"
+                assert (diff > 4).mean() < 0.01, f"{name} level {level}: {diff.max()}"
+            else:
+                assert diff.max() <= 1, f"{name} level {level}: {diff.max()}"
+                assert (diff > 0).mean() < 0.01, f"{name} level {level}"
+
+    batch_aug = BatchRandomAugment(2, 5)
+    out = batch_aug(torch.from_numpy(imgs).permute(0, 3, 1, 2).contiguous())
+    assert out.shape == (B, 3, H, W) and out.dtype == torch.uint8
+    print("BatchRandomAugment matches RandomAugment")
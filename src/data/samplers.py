@@ -0,0 +1,230 @@
+import itertools
+import math
+import random
+from collections import defaultdict
+
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+
+def get_dist_info(num_replicas=None, rank=None):
+    if dist.is_available() and dist.is_initialized():
+        num_replicas = dist.get_world_size() if num_replicas is None else num_replicas
+        rank = dist.get_rank() if rank is None else rank
+    return num_replicas or 1, rank or 0
+
+
+class RefGroupBatchSampler(Sampler):
+    """
+    Batches of WebVidCoVRDataset items where up to group_size edits of the same
+    reference video are packed together, so that BLIP2Cir.forward runs the ViT
+    once per reference. Every target is used at most once per epoch, so the
+    triplets of a batch stay distinct for the contrastive loss.
+
+    Items are (index, pth1) tuples: the dataset samples the triplet of the target
+    among the ones with this reference. The batches are sharded over the ranks
+    here (distributed = True), the loader must be set up without a
+    DistributedSampler.
+    """
+
+    distributed = True
+
+    def __init__(
+        self,
+        dataset,
+        batch_size: int,
+        group_size: int = 4,
+        drop_last: bool = True,
+        seed: int = 0,
+        num_replicas: int = None,
+        rank: int = None,
+    ):
+        self.batch_size = batch_size
+        self.group_size = max(group_size, 1)
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        # batches of the epoch to skip, set by skip_batches to resume mid-epoch
+        self.start_batch = 0
+
+        target2idx = {target: i for i, target in enumerate(dataset.target_txts)}
+        ref2idxs = defaultdict(set)
+        for target, ref in zip(dataset.df[dataset.iterate], dataset.df["pth1"]):
+            ref2idxs[ref].add(target2idx[target])
+        self.ref2idxs = {ref: sorted(idxs) for ref, idxs in sorted(ref2idxs.items())}
+        self.n_items = len(target2idx)
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def get_groups(self, rng):
+        refs = list(self.ref2idxs.keys())
+        rng.shuffle(refs)
+        used = set()
+        groups = []
+        for ref in refs:
+            idxs = [idx for idx in self.ref2idxs[ref] if idx not in used]
+            rng.shuffle(idxs)
+            used.update(idxs)
+            for start in range(0, len(idxs), self.group_size):
+                group = idxs[start : start + self.group_size]
+                groups.append([(idx, ref) for idx in group])
+        rng.shuffle(groups)
+        return groups
+
+    def __iter__(self):
+        # same permutation on every rank, a new one every epoch (set_epoch is
+        # called by the Fabric dataloader wrapper)
+        rng = random.Random(self.seed + self.epoch)
+
+        items = [item for group in self.get_groups(rng) for item in group]
+        batches = [
+            items[start : start + self.batch_size]
+            for start in range(0, len(items), self.batch_size)
+        ]
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+
+        num_replicas, rank = get_dist_info(self.num_replicas, self.rank)
+        n_batches = len(batches) // num_replicas
+        batches = batches[rank : n_batches * num_replicas : num_replicas]
+        return iter(batches[self.start_batch :])
+
+    def __len__(self):
+        if self.drop_last:
+            n_batches = self.n_items // self.batch_size
+        else:
+            n_batches = math.ceil(self.n_items / self.batch_size)
+        num_replicas, _ = get_dist_info(self.num_replicas, self.rank)
+        return n_batches // num_replicas
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batches of items with similar caption lengths, so that padding to the
+    longest caption of the batch adds few tokens. The items are shuffled, split
+    in buckets of bucket_size batches, sorted by length inside each bucket, and
+    the resulting batches are shuffled again.
+
+    The batches are sharded over the ranks here (distributed = True), as in
+    RefGroupBatchSampler.
+    """
+
+    distributed = True
+
+    def __init__(
+        self,
+        lengths,
+        batch_size: int,
+        bucket_size: int = 50,
+        drop_last: bool = True,
+        seed: int = 0,
+        num_replicas: int = None,
+        rank: int = None,
+    ):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_size = max(bucket_size, 1)
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        # batches of the epoch to skip, set by skip_batches to resume mid-epoch
+        self.start_batch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+        idxs = list(range(len(self.lengths)))
+        rng.shuffle(idxs)
+
+        batches = []
+        items_bucket = self.batch_size * self.bucket_size
+        for start in range(0, len(idxs), items_bucket):
+            bucket = sorted(
+                idxs[start : start + items_bucket], key=lambda i: self.lengths[i]
+            )
+            batches.extend(
+                bucket[i : i + self.batch_size]
+                for i in range(0, len(bucket), self.batch_size)
+            )
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        rng.shuffle(batches)
+
+        num_replicas, rank = get_dist_info(self.num_replicas, self.rank)
+        n_batches = len(batches) // num_replicas
+        batches = batches[rank : n_batches * num_replicas : num_replicas]
+        return iter(batches[self.start_batch :])
+
+    def __len__(self):
+        items_bucket = self.batch_size * self.bucket_size
+        if self.drop_last:
+            # only the last bucket can end with an incomplete batch
+            n_batches = (len(self.lengths) // items_bucket) * self.bucket_size
+            n_batches += (len(self.lengths) % items_bucket) // self.batch_size
+        else:
+            n_batches = (len(self.lengths) // items_bucket) * self.bucket_size
+            n_batches += math.ceil((len(self.lengths) % items_bucket) / self.batch_size)
+        num_replicas, _ = get_dist_info(self.num_replicas, self.rank)
+        return n_batches // num_replicas
+
+
+class SkipSampler(Sampler):
+    """The indices of sampler after the first n_skip ones."""
+
+    def __init__(self, sampler, n_skip: int):
+        self.sampler = sampler
+        self.n_skip = n_skip
+
+    def __iter__(self):
+        return itertools.islice(iter(self.sampler), self.n_skip, None)
+
+    def __len__(self):
+        return max(len(self.sampler) - self.n_skip, 0)
+
+
+def skip_batches(loader, n_batches: int):
+    """
+    Skip the first n_batches of the next epoch of loader at the sampler level,
+    so that they are not loaded (mid-epoch resume). The order of the remaining
+    batches is unchanged. Returns a function undoing it, for the next epochs.
+    """
+    batch_sampler = loader.batch_sampler
+    if hasattr(batch_sampler, "start_batch"):
+        batch_sampler.start_batch = n_batches
+
+        def undo():
+            batch_sampler.start_batch = 0
+
+    else:
+        # torch BatchSampler around a (Distributed/Random/Sequential) sampler
+        sampler = batch_sampler.sampler
+        n_skip = n_batches * batch_sampler.batch_size
+        batch_sampler.sampler = SkipSampler(sampler, n_skip)
+
+        def undo():
+            batch_sampler.sampler = sampler
+
+    return undo
+
+
+def set_epoch(loader, epoch: int):
+    """
+    Sampler epoch of the next iteration over the Fabric loader loader. Fabric
+    calls set_epoch on the samplers with its own count of the iterations over
+    the loader (_num_iter_calls), so that count is set too; it must exist, else
+    a resumed run would silently get the order of epoch 0 again.
+    """
+    assert hasattr(loader, "_num_iter_calls"), (
+        "Fabric loader without _num_iter_calls: the sampler epoch cannot be set"
+    )
+    loader._num_iter_calls = epoch
+    for sampler in (loader.sampler, loader.batch_sampler):
+        if callable(getattr(sampler, "set_epoch", None)):
+            sampler.set_epoch(epoch)
@@ -0,0 +1,106 @@
+from functools import lru_cache
+from pathlib import Path
+
+import torch
+import torch.distributed as dist
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer():
+    """Same tokenizer as Blip2Base.init_tokenizer, without importing the model."""
+    from transformers import BertTokenizer
+
+    tokenizer = BertTokenizer.from_pretrained(
+        "bert-base-uncased", truncation_side="right"
+    )
+    tokenizer.add_special_tokens({"bos_token": "[DEC]"})
+    return tokenizer
+
+
+class CaptionTokens:
+    """
+    Token ids of the captions of an annotation file, computed once and cached in
+    cache_pth as {"max_length", "texts", "lengths", "ids"}, the unpadded int32
+    ids of all the captions concatenated.
+
+    The datasets return the ids of their caption, and collate_fn pads them to
+    the longest caption of the batch in the DataLoader workers, so that the
+    tokenizer does not run in the training loop. Under DDP, rank 0 builds the
+    cache and the other ranks load it.
+    """
+
+    def __init__(self, captions, cache_pth, max_length: int = 32):
+        self.cache_pth = Path(cache_pth)
+        self.max_length = max_length
+        captions = sorted(set(captions))
+
+        self.txt2ids = {}
+        distributed = dist.is_available() and dist.is_initialized()
+        rank = dist.get_rank() if distributed else 0
+
+        # 冷缓存时只由rank 0分词并写盘, 其他rank在barrier之后读取
+        if rank == 0:
+            todo = self.load(captions)
+            if len(todo) > 0:
+                self.add(todo)
+                self.save()
+        if distributed:
+            dist.barrier()
+        if rank != 0:
+            todo = self.load(captions)
+            if len(todo) > 0:
+                self.add(todo)
+
+    def load(self, captions):
+        """Load the cache (if any), return the captions it does not hold."""
+        if self.cache_pth.exists():
+            cache = torch.load(self.cache_pth, weights_only=True)
+            if cache["max_length"] == self.max_length:
+                ids = cache["ids"].split(cache["lengths"].tolist())
+                self.txt2ids = dict(zip(cache["texts"], ids))
+        return [caption for caption in captions if caption not in self.txt2ids]
+
+    def add(self, captions, batch_size: int = 4096):
+        tokenizer = get_tokenizer()
+        for start in range(0, len(captions), batch_size):
+            texts = captions[start : start + batch_size]
+            ids = tokenizer(
+                texts, truncation=True, max_length=self.max_length
+            ).input_ids
+            for text, text_ids in zip(texts, ids):
+                self.txt2ids[text] = torch.tensor(text_ids, dtype=torch.int32)
+
+    def save(self):
+        from src.data.embs_pipeline import atomic_save
+
+        texts = sorted(self.txt2ids.keys())
+        ids = [self.txt2ids[text] for text in texts]
+        atomic_save(
+            {
+                "max_length": self.max_length,
+                "texts": texts,
+                "lengths": torch.tensor([len(x) for x in ids]),
+                "ids": torch.cat(ids),
+            },
+            self.cache_pth,
+        )
+
+    def __getitem__(self, caption) -> torch.Tensor:
+        return self.txt2ids[caption].long()
+
+    def __len__(self) -> int:
+        return len(self.txt2ids)
+
+    def length(self, caption) -> int:
+        return len(self.txt2ids[caption])
+
+
+def pad_tokens(ids, pad_token_id: int = 0):
+    """Pad a list of 1D token ids to the longest one: (input_ids, attention_mask)."""
+    max_len = max(len(x) for x in ids)
+    input_ids = torch.full((len(ids), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(ids), max_len), dtype=torch.long)
+    for i, x in enumerate(ids):
+        input_ids[i, : len(x)] = x
+        attention_mask[i, : len(x)] = 1
+    return input_ids, attention_mask
@@ -1,44 +1,53 @@
+from torch.utils.data.dataloader import default_collate
 from torchvision import transforms
 from torchvision.transforms.functional import InterpolationMode
 
-from src.data.randaugment import RandomAugment
+from src.data.randaugment import BatchRandomAugment, RandomAugment
 
 normalize = transforms.Normalize(
     (0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711)
 )
 
+train_augs = [
+    "Identity",
+    "AutoContrast",
+    "Brightness",
+    "Sharpness",
+    "Equalize",
+    "ShearX",
+    "ShearY",
+    "TranslateX",
+    "TranslateY",
+    "Rotate",
+]
+
 
 class transform_train:
-    def __init__(self, image_size=384, min_scale=0.5):
-        self.transform = transforms.Compose(
-            [
-                transforms.RandomResizedCrop(
-                    image_size,
-                    scale=(min_scale, 1.0),
-                    interpolation=InterpolationMode.BICUBIC,
-                ),
-                transforms.RandomHorizontalFlip(),
-                RandomAugment(
-                    2,
-                    5,
-                    isPIL=True,
-                    augs=[
-                        "Identity",
-                        "AutoContrast",
-                        "Brightness",
-                        "Sharpness",
-                        "Equalize",
-                        "ShearX",
-                        "ShearY",
-                        "TranslateX",
-                        "TranslateY",
-                        "Rotate",
-                    ],
-                ),
-                transforms.ToTensor(),
-                normalize,
-            ]
-        )
+    def __init__(self, image_size=384, min_scale=0.5, batch_aug=False):
+        """
+        With batch_aug=True images are returned as uint8 tensors without RandomAugment
+        and normalization; BatchAugmentCollate applies both on the collated batch.
+        """
+        self.batch_aug = batch_aug
+        crop_flip = [
+            transforms.RandomResizedCrop(
+                image_size,
+                scale=(min_scale, 1.0),
+                interpolation=InterpolationMode.BICUBIC,
+            ),
+            transforms.RandomHorizontalFlip(),
+        ]
+        if batch_aug:
+            self.transform = transforms.Compose(crop_flip + [transforms.PILToTensor()])
+        else:
+            self.transform = transforms.Compose(
+                crop_flip
+                + [
+                    RandomAugment(2, 5, isPIL=True, augs=train_augs),
+                    transforms.ToTensor(),
+                    normalize,
+                ]
+            )
 
     def __call__(self, img):
         return self.transform(img)
@@ -59,3 +68,27 @@ class transform_test(transforms.Compose):
 
     def __call__(self, img):
         return self.transform(img)
+
+
+class BatchAugmentCollate:
+    """
+    Collate function running the train-time RandomAugment on the whole uint8
+    "ref_img" batch, followed by the usual ToTensor scaling and normalization.
+    """
+
+    def __init__(self, collate_fn=default_collate, N=2, M=5, augs=train_augs):
+        self.collate_fn = collate_fn
+        self.augment = BatchRandomAugment(N, M, augs=augs)
+
+    def __call__(self, batch):
+        batch = self.collate_fn(batch)
+        if batch is None:
+            return batch
+
+        ref_img = batch["ref_img"]
+        shape = ref_img.shape
+        # multi-frame references (B, F, C, H, W) are augmented frame by frame
+        ref_img = self.augment(ref_img.reshape(-1, *shape[-3:]))
+        ref_img = normalize(ref_img.float() / 255)
+        batch["ref_img"] = ref_img.reshape(shape)
+        return batch
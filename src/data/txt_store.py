@@ -0,0 +1,78 @@
+import hashlib
+from pathlib import Path
+from typing import Union
+
+import torch
+
+from src.data.utils import pre_caption
+
+
+def caption_key(caption: str) -> str:
+    """
+    Hash of the caption as processed before embedding. pre_caption with the
+    default max_words=50 is what the BLIP-2 eval text processor of LAVIS applies,
+    so captions that only differ by case or punctuation share one row.
+    """
+    return hashlib.sha1(pre_caption(str(caption)).encode()).hexdigest()
+
+
+class TextEmbStore:
+    """
+    Content-addressed text embeddings: {"keys": [caption_key], "feats": (N, D)}.
+
+    Extraction only embeds the captions whose key is not in the store yet and
+    appends them, so new splits or annotation edits do not re-embed the others.
+    Datasets resolve their captions against the same store with lookup().
+    """
+
+    def __init__(self, store_pth: Union[Path, str]):
+        self.store_pth = Path(store_pth)
+        self.keys = []
+        self.feats = None
+        if self.store_pth.exists():
+            store = torch.load(self.store_pth, weights_only=True)
+            self.keys = list(store["keys"])
+            self.feats = store["feats"]
+        self.key2row = {key: row for row, key in enumerate(self.keys)}
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, caption) -> bool:
+        return caption_key(caption) in self.key2row
+
+    def __getitem__(self, caption) -> torch.Tensor:
+        return self.feats[self.key2row[caption_key(caption)]]
+
+    def missing(self, captions) -> list:
+        """Captions to embed, one per key not in the store."""
+        todo = {}
+        for caption in captions:
+            key = caption_key(caption)
+            if key not in self.key2row and key not in todo:
+                todo[key] = caption
+        return sorted(todo.values())
+
+    def add(self, captions, feats: torch.Tensor):
+        assert len(captions) == len(feats), "captions and feats do not match"
+        new_keys = [caption_key(caption) for caption in captions]
+        for key in new_keys:
+            assert key not in self.key2row, f"{key} is already in the store"
+            self.key2row[key] = len(self.keys)
+            self.keys.append(key)
+        feats = feats.cpu()
+        self.feats = feats if self.feats is None else torch.cat([self.feats, feats])
+
+    def save(self):
+        from src.data.embs_pipeline import atomic_save
+
+        self.store_pth.parent.mkdir(parents=True, exist_ok=True)
+        atomic_save({"keys": self.keys, "feats": self.feats}, self.store_pth)
+
+    def lookup(self, captions) -> dict:
+        """Dict caption -> embedding, raises if a caption is not in the store."""
+        missing = [caption for caption in set(captions) if caption not in self]
+        assert (
+            len(missing) == 0
+        ), f"{len(missing)} captions are not in {self.store_pth}, e.g. {missing[:3]}"
+        return {caption: self[caption] for caption in set(captions)}
@@ -37,7 +37,26 @@ def remove_non_digits(string, sub: str = ""):
     return int(re.sub(r"\D", sub, string))
 
 
-def get_middle_frame(reference_vid_pth):
+class CorruptedMediaError(ValueError):
+    """Raised by the strict frame readers when a video cannot be decoded."""
+
+
+def load_image(img_pth, image_size=None):
+    """
+    Open an image as RGB. With image_size, JPEGs are decoded in draft mode: libjpeg
+    downscales in the DCT domain (1/2, 1/4 or 1/8) to the smallest size whose sides
+    are still >= image_size, which is much cheaper than decoding the full image
+    and resizing it afterwards. Other formats are decoded at full resolution.
+    """
+    from PIL import Image
+
+    img = Image.open(img_pth)
+    if image_size is not None and img.format == "JPEG":
+        img.draft("RGB", (image_size, image_size))
+    return img.convert("RGB")
+
+
+def get_middle_frame(reference_vid_pth, strict=False):
     from pathlib import Path
 
     import cv2
@@ -47,6 +66,8 @@ def get_middle_frame(reference_vid_pth):
     reference_vid_pth = str(reference_vid_pth)
 
     if not Path(reference_vid_pth).exists():
+        if strict:
+            raise CorruptedMediaError("does not exist")
         print(f"Video {reference_vid_pth} does not exist")
         return Image.fromarray(np.zeros((384, 384, 3)).astype(np.uint8))
 
@@ -66,6 +87,8 @@ def get_middle_frame(reference_vid_pth):
     ret, frame = cap.read()
 
     if not ret or frame is None:
+        if strict:
+            raise CorruptedMediaError("frame could not be decoded")
         print(f"Video {reference_vid_pth} is corrupted")
         return Image.fromarray(np.zeros((384, 384, 3)).astype(np.uint8))
 
@@ -78,7 +101,7 @@ def get_middle_frame(reference_vid_pth):
     return pil_image
 
 
-def get_random_frame(reference_vid_pth):
+def get_random_frame(reference_vid_pth, strict=False):
     from pathlib import Path
 
     import cv2
@@ -88,6 +111,8 @@ def get_random_frame(reference_vid_pth):
     reference_vid_pth = str(reference_vid_pth)
 
     if not Path(reference_vid_pth).exists():
+        if strict:
+            raise CorruptedMediaError("does not exist")
         print(f"Video {reference_vid_pth} does not exist")
         return Image.fromarray(np.zeros((384, 384, 3)).astype(np.uint8))
 
@@ -98,7 +123,7 @@ def get_random_frame(reference_vid_pth):
     total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
 
     # calculate the index of random frame
-    random_frame_index = np.random.randint(0, total_frames)
+    random_frame_index = np.random.randint(0, max(total_frames, 1))
 
     # set the current frame index to the random frame index
     cap.set(cv2.CAP_PROP_POS_FRAMES, random_frame_index)
@@ -107,6 +132,8 @@ def get_random_frame(reference_vid_pth):
     ret, frame = cap.read()
 
     if not ret or frame is None:
+        if strict:
+            raise CorruptedMediaError("frame could not be decoded")
         print(f"Video {reference_vid_pth} is corrupted")
         return Image.fromarray(np.zeros((384, 384, 3)).astype(np.uint8))
 
@@ -134,9 +161,12 @@ def sample_frames(frames_videos, vlen):
 
 
 class FrameLoader:
-    def __init__(self, transform, frames_video=1, method="middle"):
+    def __init__(self, transform, frames_video=1, method="middle", quarantine=None):
         self.transform = transform
         self.method = method
+        # With a Quarantine, unreadable videos are recorded and None is returned
+        # instead of a black frame, so the sample can be skipped by collate_fn.
+        self.quarantine = quarantine
 
         if method == "middle":
             self.get_frame = get_middle_frame
@@ -151,11 +181,23 @@ class FrameLoader:
             raise ValueError(f"Invalid method: {method}")
 
     def __call__(self, video_pth: str):
+        if self.quarantine is None:
+            return self.load(video_pth)
+        if video_pth in self.quarantine:
+            return None
+        try:
+            return self.load(video_pth, strict=True)
+        except (CorruptedMediaError, ValueError) as e:
+            print(f"Video {video_pth} quarantined: {e}")
+            self.quarantine.add(video_pth, str(e))
+            return None
+
+    def load(self, video_pth: str, strict: bool = False):
         if self.method == "sample":
             frames = self.get_video_frames(video_pth, 0.0, None)
             return torch.stack(frames)
         else:
-            return self.transform(self.get_frame(video_pth))
+            return self.transform(self.get_frame(video_pth, strict=strict))
 
     def get_video_frames(
         self,
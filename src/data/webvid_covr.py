@@ -8,7 +8,11 @@ from lightning import LightningDataModule
 from PIL import Image
 from torch.utils.data import DataLoader, Dataset
 
-from src.data.transforms import transform_test, transform_train
+from src.data.transforms import BatchAugmentCollate, transform_test, transform_train
+from src.data.quarantine import get_quarantine
+from src.data.samplers import LengthBucketBatchSampler, RefGroupBatchSampler
+from src.data.text_tokens import CaptionTokens
+from src.data.txt_store import TextEmbStore
 from src.data.utils import FrameLoader, id2int, pre_caption
 from src.tools.files import write_txt
 from src.tools.utils import print_dist
@@ -34,6 +38,13 @@ class WebVidCoVRDataModule(LightningDataModule):
         vid_frames: int = 1,
         n_embs: int = 15,
         si_tc_weight=0,
+        batch_aug: bool = False,
+        quarantine: str = None,
+        txt_store: str = None,
+        ref_group_size: int = 0,
+        pretokenize: bool = False,
+        max_txt_len: int = 32,
+        length_bucket: int = 0,
         **kwargs,  # type: ignore
     ) -> None:
         super().__init__()
@@ -41,16 +52,26 @@ class WebVidCoVRDataModule(LightningDataModule):
         # also ensures init params will be stored in ckpt
         self.save_hyperparameters(logger=False)
 
-        self.batch_size = batch_size
+        self.batch_size = frame_batch_size(batch_size, vid_query_method, vid_frames)
         self.num_workers = num_workers
         self.pin_memory = pin_memory
         self.emb_pool = emb_pool
         self.iterate = iterate
         self.vid_query_method = vid_query_method
         self.vid_frames = vid_frames
+        self.batch_aug = batch_aug
+        self.ref_group_size = ref_group_size
+        self.length_bucket = length_bucket
+        assert (
+            length_bucket == 0 or pretokenize
+        ), "length_bucket needs the caption lengths of pretokenize"
+        assert (
+            length_bucket == 0 or ref_group_size == 0
+        ), "length_bucket and ref_group_size are exclusive"
 
-        self.transform_train = transform_train(image_size)
+        self.transform_train = transform_train(image_size, batch_aug=batch_aug)
         self.transform_test = transform_test(image_size)
+        self.quarantine = get_quarantine(quarantine)
 
         self.data_train = WebVidCoVRDataset(
             transform=self.transform_train,
@@ -64,6 +85,11 @@ class WebVidCoVRDataModule(LightningDataModule):
             vid_frames=self.vid_frames,
             n_embs=n_embs,
             si_tc_weight=si_tc_weight,
+            quarantine=self.quarantine,
+            txt_store=txt_store,
+            pretokenize=pretokenize,
+            max_txt_len=max_txt_len,
+            return_ref_id=ref_group_size > 0,
         )
         self.data_val = WebVidCoVRDataset(
             transform=self.transform_test,
@@ -76,6 +102,9 @@ class WebVidCoVRDataModule(LightningDataModule):
             vid_query_method=self.vid_query_method,
             vid_frames=self.vid_frames,
             n_embs=n_embs,
+            quarantine=self.quarantine,
+            pretokenize=pretokenize,
+            max_txt_len=max_txt_len,
         )
 
     def prepare_data(self):
@@ -84,12 +113,46 @@ class WebVidCoVRDataModule(LightningDataModule):
         pass
 
     def train_dataloader(self):
+        if self.ref_group_size > 0:
+            # 同一参考视频的多条修改文本放进同一个batch, 参考视频只过一次ViT
+            return DataLoader(
+                dataset=self.data_train,
+                batch_sampler=RefGroupBatchSampler(
+                    self.data_train,
+                    batch_size=self.batch_size,
+                    group_size=self.ref_group_size,
+                    drop_last=True,
+                ),
+                num_workers=self.num_workers,
+                pin_memory=self.pin_memory,
+                collate_fn=(
+                    BatchAugmentCollate(collate_fn) if self.batch_aug else collate_fn
+                ),
+            )
+        if self.length_bucket > 0:
+            # 长度相近的修改文本放进同一个batch, 减少补齐的token
+            return DataLoader(
+                dataset=self.data_train,
+                batch_sampler=LengthBucketBatchSampler(
+                    self.data_train.caption_lengths(),
+                    batch_size=self.batch_size,
+                    bucket_size=self.length_bucket,
+                    drop_last=True,
+                ),
+                num_workers=self.num_workers,
+                pin_memory=self.pin_memory,
+                collate_fn=(
+                    BatchAugmentCollate(collate_fn) if self.batch_aug else collate_fn
+                ),
+            )
         return DataLoader(
             dataset=self.data_train,
             batch_size=self.batch_size,
             num_workers=self.num_workers,
             pin_memory=self.pin_memory,
-            collate_fn=collate_fn,
+            collate_fn=(
+                BatchAugmentCollate(collate_fn) if self.batch_aug else collate_fn
+            ),
             shuffle=True,
             drop_last=True,
         )
@@ -126,7 +189,7 @@ class WebVidCoVRTestDataModule(LightningDataModule):
         super().__init__()
         self.save_hyperparameters(logger=False)
 
-        self.batch_size = batch_size
+        self.batch_size = frame_batch_size(batch_size, vid_query_method, vid_frames)
         self.num_workers = num_workers
         self.pin_memory = pin_memory
         self.emb_pool = emb_pool
@@ -161,6 +224,17 @@ class WebVidCoVRTestDataModule(LightningDataModule):
         )
 
 
+def frame_batch_size(batch_size, vid_query_method, vid_frames):
+    """Divide the batch size by the frames per video to keep B*F ViT images constant."""
+    if vid_query_method != "sample" or vid_frames <= 1:
+        return batch_size
+    frame_batch = max(batch_size // vid_frames, 1)
+    print_dist(
+        f"Sampling {vid_frames} frames per video: batch_size {batch_size} -> {frame_batch}"
+    )
+    return frame_batch
+
+
 class WebVidCoVRDataset(Dataset):
     def __init__(
         self,
@@ -176,10 +250,17 @@ class WebVidCoVRDataset(Dataset):
         vid_query_method: str = "middle",
         vid_frames: int = 1,
         si_tc_weight=0,
+        quarantine=None,
+        txt_store=None,
+        pretokenize: bool = False,
+        max_txt_len: int = 32,
+        return_ref_id: bool = False,
     ) -> None:
         super().__init__()
 
         self.transform = transform
+        # ref_id只在ref_group_size > 0时返回: 模型据此对同一参考视频去重
+        self.return_ref_id = return_ref_id
 
         self.annotation_pth = Path(annotation)
         assert (
@@ -268,6 +349,14 @@ class WebVidCoVRDataset(Dataset):
         self.df = self.df[self.df["path2"].notna()]
         self.df.reset_index(drop=True, inplace=True)
 
+        # Remove triplets whose video or embedding already failed to load
+        self.quarantine = quarantine
+        if quarantine is not None:
+            self.df, n_quarantined = quarantine.filter(self.df)
+            if n_quarantined > 0:
+                print_dist(
+                    f"Skipping {n_quarantined} triplets with quarantined files ({len(quarantine)} in {quarantine.quarantine_pth})"
+                )
 
         self.max_words = max_words
 
@@ -303,6 +392,10 @@ class WebVidCoVRDataset(Dataset):
         self.int2id = {k: list(v)[0] for k, v in self.int2id.items()}
 
         self.pairid2tar = self.df["int2"].to_dict()
+        # small ints of the references, to find the triplets sharing one in a batch
+        self.ref2int = {
+            ref: i for i, ref in enumerate(sorted(self.df["pth1"].unique()))
+        }
         self.df.set_index(iterate, inplace=True)
         self.df[iterate] = self.df.index
 
@@ -320,12 +413,29 @@ class WebVidCoVRDataset(Dataset):
             ]
         ), f"Invalid vid_query_method: {vid_query_method}, must be one of middle, random, or sample"
         self.frame_loader = FrameLoader(
-            transform=self.transform, method=vid_query_method, frames_video=vid_frames
+            transform=self.transform,
+            method=vid_query_method,
+            frames_video=vid_frames,
+            quarantine=quarantine,
         )
 
+        # Token ids of the edits, padded per batch in collate_fn
+        self.edit_tokens = None
+        if pretokenize:
+            edits = [pre_caption(e, max_words) for e in self.df["edit"].unique()]
+            self.edit_tokens = CaptionTokens(
+                edits,
+                self.emb_dir / f"edit-tokens_{self.annotation_pth.stem}.pth",
+                max_length=max_txt_len,
+            )
+
         # Load text embeddings if si_tc_weight > 0
         self.txt2emb = None
-        if si_tc_weight > 0:
+        if si_tc_weight > 0 and txt_store is not None:
+            # captions resolved against the shared content-addressed store
+            txt2s = self.df["txt2"].unique().tolist()
+            self.txt2emb = TextEmbStore(txt_store).lookup(txt2s)
+        elif si_tc_weight > 0:
             txt2emb_pth = self.emb_dir / f"txt2_{self.annotation_pth.stem}.pth"
             if "blip2" in str(txt2emb_pth):
                 model = "blip2"
@@ -354,16 +464,33 @@ class WebVidCoVRDataset(Dataset):
     def __len__(self) -> int:
         return len(self.target_txts)
 
+    def caption_lengths(self):
+        """Tokens of the longest edit of every item, for LengthBucketBatchSampler."""
+        lengths = self.df["edit"].apply(
+            lambda e: self.edit_tokens.length(pre_caption(e, self.max_words))
+        )
+        lengths = lengths.groupby(level=0).max()
+        return [int(lengths[target_txt]) for target_txt in self.target_txts]
+
 
     def __getitem__(self, index):
+        ref = None
+        if isinstance(index, tuple):
+            # (index, pth1) from RefGroupBatchSampler: triplet with this reference
+            index, ref = index
         target_txt = self.target_txts[index]
         ann = self.df.loc[target_txt]
         if ann.ndim > 1:
+            if ref is not None:
+                ann = ann[ann["pth1"] == ref]
             ann = ann.sample()
             ann = ann.iloc[0]
 
         reference_pth = str(ann["path1"])
         reference_vid = self.frame_loader(reference_pth)
+        if reference_vid is None:
+            # quarantined by the frame loader, dropped by collate_fn
+            return None
 
         caption = pre_caption(ann["edit"], self.max_words)
         #改动3 利用标题
@@ -377,7 +504,11 @@ class WebVidCoVRDataset(Dataset):
             "txt1" : txt1, #txt1和2是我新加的
             "txt2" : txt2,
         }
+        if self.return_ref_id:
+            return_dict["ref_id"] = self.ref2int[ann["pth1"]]
         #-------------------------------------------------------------
+        if self.edit_tokens is not None:
+            return_dict["edit_ids"] = self.edit_tokens[caption]
         if self.txt2emb is not None:
             return_dict["tar_txt_feat"] = self.txt2emb[ann["txt2"]]
 
@@ -393,6 +524,8 @@ class WebVidCoVRDataset(Dataset):
         if target_emb is None:
             # 如果加载失败，直接return None交给collate_fn函数去处理
             print(f"跳过了样本: {target_pth}")
+            if self.quarantine is not None:
+                self.quarantine.add(target_pth, "embedding could not be loaded")
             return None
         #我认为这样应该不会有大问题，因为只有个位数的损坏文件
         #DS建议我用的就是这个方法，以下是说明
@@ -287,7 +287,7 @@ class WebVidCoVRDatasetRuleBased(Dataset):
 
         # Get target embeddings
         target_pth = str(ann["path2"])
-        target_emb = torch.load(target_pth, weights_only=True).cpu()
+        target_emb = torch.load(target_pth, weights_only=True).cpu().float()
         if self.emb_pool == "middle":
             return_dict["tar_img_feat"] = target_emb[len(target_emb) // 2]
             return return_dict
@@ -132,6 +132,14 @@ class BertSelfAttention(nn.Module):
             )
         self.save_attention = False
 
+        # "sdpa" dispatches to F.scaled_dot_product_attention (flash / memory
+        # efficient kernels) when the attention probabilities are not needed
+        self.attention_backend = getattr(config, "attention_backend", "eager")
+        assert self.attention_backend in [
+            "eager",
+            "sdpa",
+        ], f"Invalid attention_backend: {self.attention_backend}"
+
     def save_attn_gradients(self, attn_gradients):
         self.attn_gradients = attn_gradients
 
@@ -144,6 +152,16 @@ class BertSelfAttention(nn.Module):
     def get_attention_map(self):
         return self.attention_map
 
+    def use_sdpa(self, is_cross_attention, head_mask, output_attentions):
+        return (
+            self.attention_backend == "sdpa"
+            and hasattr(nn.functional, "scaled_dot_product_attention")
+            and self.position_embedding_type == "absolute"
+            and head_mask is None
+            and not output_attentions
+            and not (is_cross_attention and self.save_attention)
+        )
+
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[:-1] + (
             self.num_attention_heads,
@@ -161,6 +179,7 @@ class BertSelfAttention(nn.Module):
         encoder_attention_mask=None,
         past_key_value=None,
         output_attentions=False,
+        encoder_index=None,
     ):
         # If this is instantiated as a cross-attention module, the keys
         # and values come from an encoder; the attention mask needs to be
@@ -174,6 +193,12 @@ class BertSelfAttention(nn.Module):
             # NOT working [bs, 7, 768]
             value_layer = self.transpose_for_scores(self.value(encoder_hidden_states))
             attention_mask = encoder_attention_mask
+            if encoder_index is not None:
+                # K/V只按不同的图片算一次, 再分发给同一张图片的每条文本
+                key_layer = key_layer.index_select(0, encoder_index)
+                value_layer = value_layer.index_select(0, encoder_index)
+                if attention_mask is not None:
+                    attention_mask = attention_mask.index_select(0, encoder_index)
         elif past_key_value is not None:
             key_layer = self.transpose_for_scores(self.key(hidden_states))
             value_layer = self.transpose_for_scores(self.value(hidden_states))
@@ -189,6 +214,21 @@ class BertSelfAttention(nn.Module):
 
         past_key_value = (key_layer, value_layer)
 
+        if self.use_sdpa(is_cross_attention, head_mask, output_attentions):
+            if attention_mask is not None:
+                attention_mask = attention_mask.to(query_layer.dtype)
+            context_layer = nn.functional.scaled_dot_product_attention(
+                query_layer,
+                key_layer,
+                value_layer,
+                attn_mask=attention_mask,
+                dropout_p=self.dropout.p if self.training else 0.0,
+            )
+            context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+            new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
+            context_layer = context_layer.view(*new_context_layer_shape)
+            return (context_layer, past_key_value)
+
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
 
@@ -316,6 +356,7 @@ class BertAttention(nn.Module):
         encoder_attention_mask=None,
         past_key_value=None,
         output_attentions=False,
+        encoder_index=None,
     ):
         self_outputs = self.self(
             hidden_states,
@@ -325,6 +366,7 @@ class BertAttention(nn.Module):
             encoder_attention_mask,
             past_key_value,
             output_attentions,
+            encoder_index,
         )
         attention_output = self.output(self_outputs[0], hidden_states)
 
@@ -397,6 +439,7 @@ class BertLayer(nn.Module):
         past_key_value=None,
         output_attentions=False,
         query_length=0,
+        encoder_index=None,
     ):
         # decoder uni-directional self-attention cached key/values tuple is at positions 1,2
         self_attn_past_key_value = (
@@ -428,6 +471,7 @@ class BertLayer(nn.Module):
                     encoder_hidden_states,
                     encoder_attention_mask,
                     output_attentions=output_attentions,
+                    encoder_index=encoder_index,
                 )
                 query_attention_output = cross_attention_outputs[0]
                 outputs = (
@@ -493,6 +537,7 @@ class BertEncoder(nn.Module):
         output_hidden_states=False,
         return_dict=True,
         query_length=0,
+        encoder_index=None,
     ):
         all_hidden_states = () if output_hidden_states else None
         all_self_attentions = () if output_attentions else None
@@ -520,7 +565,11 @@ class BertEncoder(nn.Module):
                 def create_custom_forward(module):
                     def custom_forward(*inputs):
                         return module(
-                            *inputs, past_key_value, output_attentions, query_length
+                            *inputs,
+                            past_key_value,
+                            output_attentions,
+                            query_length,
+                            encoder_index,
                         )
 
                     return custom_forward
@@ -543,6 +592,7 @@ class BertEncoder(nn.Module):
                     past_key_value,
                     output_attentions,
                     query_length,
+                    encoder_index,
                 )
 
             hidden_states = layer_outputs[0]
@@ -803,6 +853,7 @@ class BertModel(BertPreTrainedModel):
         output_hidden_states=None,
         return_dict=None,
         is_decoder=False,
+        encoder_index=None,
     ):
         r"""
         encoder_hidden_states  (:obj:`torch.FloatTensor` of shape :obj:`(batch_size, sequence_length, hidden_size)`, `optional`):
@@ -821,6 +872,10 @@ class BertModel(BertPreTrainedModel):
         use_cache (:obj:`bool`, `optional`):
             If set to :obj:`True`, :obj:`past_key_values` key value states are returned and can be used to speed up
             decoding (see :obj:`past_key_values`).
+        encoder_index (:obj:`torch.LongTensor` of shape :obj:`(batch_size,)`, `optional`):
+            Row of :obj:`encoder_hidden_states` used by each input when several inputs share the same image. The
+            encoder states and mask then hold one row per unique image, and the cross-attention keys and values are
+            computed once per image.
         """
         output_attentions = (
             output_attentions
@@ -933,6 +988,7 @@ class BertModel(BertPreTrainedModel):
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
             query_length=query_length,
+            encoder_index=encoder_index,
         )
         sequence_output = encoder_outputs[0]
         pooled_output = (
@@ -1222,3 +1278,63 @@ class BertForMaskedLM(BertPreTrainedModel):
             hidden_states=outputs.hidden_states,
             attentions=outputs.attentions,
         )
+
+
+if __name__ == "__main__":
+    # parity of the sdpa and eager attention backends (self and cross-attention)
+    torch.manual_seed(0)
+    config = BertConfig(
+        hidden_size=64,
+        num_attention_heads=4,
+        attention_probs_dropout_prob=0.0,
+    )
+    config.encoder_width = 48
+    for is_cross_attention in [False, True]:
+        config.attention_backend = "eager"
+        eager = BertSelfAttention(config, is_cross_attention).eval()
+        config.attention_backend = "sdpa"
+        sdpa = BertSelfAttention(config, is_cross_attention).eval()
+        sdpa.load_state_dict(eager.state_dict())
+
+        hidden_states = torch.randn(2, 40, 64)
+        mask = torch.ones(2, 40)
+        mask[1, 30:] = 0
+        encoder_hidden_states = None
+        encoder_mask = None
+        if is_cross_attention:
+            encoder_hidden_states = torch.randn(2, 50, 48)
+            encoder_mask = torch.ones(2, 50)
+            encoder_mask[0, 45:] = 0
+            encoder_mask = (1.0 - encoder_mask[:, None, None, :]) * -10000.0
+        mask = (1.0 - mask[:, None, None, :]) * -10000.0
+
+        with torch.no_grad():
+            out_eager = eager(hidden_states, mask, None, encoder_hidden_states, encoder_mask)
+            out_sdpa = sdpa(hidden_states, mask, None, encoder_hidden_states, encoder_mask)
+        diff = (out_eager[0] - out_sdpa[0]).abs().max().item()
+        name = "cross" if is_cross_attention else "self"
+        print(f"{name}-attention max abs diff: {diff:.2e}")
+        assert diff < 1e-5, f"sdpa and eager {name}-attention differ"
+
+        if is_cross_attention:
+            # K/V reuse: rows sharing an image give the same output as repeated images
+            encoder_index = torch.tensor([0, 1, 1, 0])
+            with torch.no_grad():
+                out_repeat = sdpa(
+                    hidden_states[[0, 1, 1, 0]],
+                    None,
+                    None,
+                    encoder_hidden_states[encoder_index],
+                    encoder_mask[encoder_index],
+                )
+                out_index = sdpa(
+                    hidden_states[[0, 1, 1, 0]],
+                    None,
+                    None,
+                    encoder_hidden_states,
+                    encoder_mask,
+                    encoder_index=encoder_index,
+                )
+            diff = (out_repeat[0] - out_index[0]).abs().max().item()
+            print(f"cross-attention encoder_index max abs diff: {diff:.2e}")
+            assert diff < 1e-6, "encoder_index does not match repeated images"
@@ -26,6 +26,7 @@ from lavis.models.eva_vit import create_eva_vit_g
 from transformers import BertTokenizer
 
 from src.model.blip2.Qformer import BertConfig, BertLMHeadModel
+from src.model.blip2.tome import apply_tome
 
 
 class Blip2Base(BaseModel):
@@ -48,9 +49,16 @@ class Blip2Base(BaseModel):
             return contextlib.nullcontext()
 
     @classmethod
-    def init_Qformer(cls, num_query_token, vision_width, cross_attention_freq=2):
+    def init_Qformer(
+        cls,
+        num_query_token,
+        vision_width,
+        cross_attention_freq=2,
+        attention_backend="eager",
+    ):
         encoder_config = BertConfig.from_pretrained("bert-base-uncased")
         encoder_config.encoder_width = vision_width
+        encoder_config.attention_backend = attention_backend
         # insert cross-attention layer every other block
         encoder_config.add_cross_attention = True
         encoder_config.cross_attention_freq = cross_attention_freq
@@ -65,7 +73,13 @@ class Blip2Base(BaseModel):
         return Qformer, query_tokens
 
     def init_vision_encoder(
-        self, model_name, img_size, drop_path_rate, use_grad_checkpoint, precision
+        self,
+        model_name,
+        img_size,
+        drop_path_rate,
+        use_grad_checkpoint,
+        precision,
+        tome_r=0,
     ):
         assert model_name in [
             "eva_clip_g",
@@ -84,6 +98,10 @@ class Blip2Base(BaseModel):
             visual_encoder = create_clip_vit_L(img_size, use_grad_checkpoint, precision)
         else:
             raise NotImplementedError
+        if tome_r:
+            # token merging in the ViT blocks, fewer tokens for the Q-Former
+            assert model_name == "eva_clip_g", "token merging needs the EVA ViT"
+            visual_encoder = apply_tome(visual_encoder, tome_r)
         ln_vision = LayerNorm(visual_encoder.num_features)
         self.vit_name = model_name
         return visual_encoder, ln_vision
@@ -103,6 +121,10 @@ class Blip2Base(BaseModel):
         else:
             raise RuntimeError(f"checkpoint url or path is invalid: {url_or_filename}")
 
+        if "base_ckpt" in checkpoint:
+            # trainable-only checkpoint (src.tools.checkpoint): base weights first
+            self.load_from_pretrained(checkpoint["base_ckpt"])
+
         state_dict = checkpoint["model"]
 
         msg = self.load_state_dict(state_dict, strict=False)
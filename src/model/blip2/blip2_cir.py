@@ -12,15 +12,17 @@ import torch
 import torch.nn as nn
 from torch.cuda.amp import autocast as autocast
 from torch.nn import functional as F
+from transformers import BatchEncoding
 
 from src.model.blip2.blip2 import Blip2Base, disabled_train
-from src.tools.utils import all_gather_with_grad, concat_all_gather
+from src.tools.utils import all_gather_async, all_gather_features
 from src.model.cloud.cloud import Cloud
 # from src.model.blip2.video_transformer import Transformer
 from src.model.blip2.DyT import DynamicTanh , convert_ln_to_dyt
 # from src.model.blip2.f2seq_tf import Transformer as F2SeqTF
 from src.model.blip2.xpool_cross_att import Transformer as xpool_cross_att
 from src.model.blip2.xpool_cross_att import sim_matrix_training
+from src.model.blip2.xpool_cross_att import chunked_xpool_sim
 # from src.model.blip2.SubspaceTransformer import SubspaceTransformer
 from src.model.blip2.ca_for_mask import CrossTransformer
 
@@ -59,6 +61,13 @@ class BLIP2Cir(Blip2Base):
         temperature=1,
         si_ti_weight=1,
         si_tc_weight=0,
+        frame_pool="mean",
+        qformer_attention="eager",
+        tome_r=0,
+        xpool_chunk=0,
+        queue_size=0,
+        queue_max_age=0,
+        gather_dtype=None,
     ):
         super().__init__()
 
@@ -67,8 +76,14 @@ class BLIP2Cir(Blip2Base):
         self.tokenizer = self.init_tokenizer()
 
         self.visual_encoder, self.ln_vision = self.init_vision_encoder(
-            vit_model, image_size, drop_path_rate, use_grad_checkpoint, vit_precision
+            vit_model,
+            image_size,
+            drop_path_rate,
+            use_grad_checkpoint,
+            vit_precision,
+            tome_r=tome_r,
         )
+        self.tome_r = tome_r
         self.train_vit = train_vit
         if not train_vit:
             for name, param in self.visual_encoder.named_parameters():
@@ -77,7 +92,10 @@ class BLIP2Cir(Blip2Base):
             self.visual_encoder.train = disabled_train
             logging.info("freeze vision encoder")
         self.Qformer, self.query_tokens = self.init_Qformer(
-            num_query_token, self.visual_encoder.num_features, cross_attention_freq
+            num_query_token,
+            self.visual_encoder.num_features,
+            cross_attention_freq,
+            attention_backend=qformer_attention,
         )
         self.Qformer.resize_token_embeddings(len(self.tokenizer))
         state_dict = self.Qformer.state_dict()
@@ -106,6 +124,17 @@ class BLIP2Cir(Blip2Base):
         self.si_ti_weight = si_ti_weight
         self.si_tc_weight = si_tc_weight
 
+        # 多帧参考视频 (B, F, 3, H, W) 的池化方式
+        # mean: 每帧单独过Q-Former, 再对F帧的query特征取平均
+        # pool: ViT token在帧维度上取平均 (B, N, C), 只过一次Q-Former
+        # concat: 所有帧的ViT token拼接 (B, F*N, C) 后只过一次Q-Former, 交叉注意力开销随F增长
+        assert frame_pool in [
+            "mean",
+            "pool",
+            "concat",
+        ], f"Invalid frame_pool: {frame_pool}, must be one of mean, pool or concat"
+        self.frame_pool = frame_pool
+
         # # 实例化两个网络
         # diff_calculator = F2SeqTF(
         #     embed_dim=768,
@@ -127,6 +156,25 @@ class BLIP2Cir(Blip2Base):
         # self.diff_proj = nn.Linear(self.Qformer.config.hidden_size, embed_dim)
         #改动 11 xpool交叉注意力
         self.xpool_cross_att = xpool_cross_att(embed_dim=embed_dim, num_heads=1)
+        self.xpool_chunk = xpool_chunk
+
+        # 目标特征的FIFO负样本队列 (queue_size > 0时启用), 作为query→target方向的额外负样本
+        # 目标特征是预先提取并all-gather过的, 每个rank的队列相同; 只保留最近queue_max_age步的 (0: 不限)
+        self.queue_size = queue_size
+        self.queue_max_age = queue_max_age
+        self.register_buffer("tar_queue", None, persistent=False)
+        self.register_buffer("tar_queue_step", None, persistent=False)
+        self.queue_ptr = 0
+        self.queue_steps = 0
+
+        # 多卡训练时all-gather特征的传输精度: None(原精度), fp16 或 bf16
+        assert gather_dtype in [
+            None,
+            "fp32",
+            "fp16",
+            "bf16",
+        ], f"Invalid gather_dtype: {gather_dtype}, must be one of fp32, fp16 or bf16"
+        self.gather_dtype = gather_dtype
         # ca = CrossTransformer(embed_dim , 1)
         # self.ca = convert_ln_to_dyt(ca)
         # ---xpool_cross_att的替代模块
@@ -143,34 +191,159 @@ class BLIP2Cir(Blip2Base):
         # self.cat_proj_img = nn.Linear(1408, embed_dim)
         #--------------------------------------------------------------------------
 
-    def forward(self, batch, fabric):
+    def encode_ref(self, ref_img):
+        """ViT features of (B, 3, H, W) images or (B, F, 3, H, W) frames."""
+        n_frames = 1
+        if ref_img.dim() == 5:
+            # 多帧: 展平成B*F张图片一起过ViT
+            n_frames = ref_img.shape[1]
+            ref_img = ref_img.flatten(0, 1)
+
+        if self.train_vit:
+            ref_img_embs = self.ln_vision(self.visual_encoder(ref_img))
+        else:
+            with torch.no_grad():
+                ref_img_embs = self.ln_vision(self.visual_encoder(ref_img))
+
+        if n_frames > 1 and self.frame_pool == "pool":
+            # (B*F, N, C) -> (B, N, C), 交叉注意力的输入与单帧相同
+            ref_img_embs = ref_img_embs.view(
+                -1, n_frames, *ref_img_embs.shape[1:]
+            ).mean(dim=1)
+            n_frames = 1
+        elif n_frames > 1 and self.frame_pool == "concat":
+            # (B*F, N, C) -> (B, F*N, C), Q-Former只跑一次, 交叉注意力覆盖所有帧
+            ref_img_embs = ref_img_embs.view(
+                -1, n_frames * ref_img_embs.shape[1], ref_img_embs.shape[2]
+            )
+            n_frames = 1
+        return ref_img_embs, n_frames
+
+    def train(self, mode=True):
+        super().train(mode)
+        if self.tome_r:
+            # 只在推理时合并ViT的token, 训练时保持完整的677个token
+            self.visual_encoder._tome_info["enabled"] = not mode
+        return self
+
+    @torch.no_grad()
+    def dequeue_and_enqueue(self, tar_img_feat):
+        """Replace the oldest queued targets by the (all-gathered) targets of the batch."""
+        if self.tar_queue is None:
+            self.tar_queue = tar_img_feat.new_zeros(
+                (self.queue_size, *tar_img_feat.shape[1:])
+            )
+            self.tar_queue_step = torch.full(
+                (self.queue_size,), -1, dtype=torch.long, device=tar_img_feat.device
+            )
+        n = min(len(tar_img_feat), self.queue_size)
+        idx = torch.arange(n, device=tar_img_feat.device)
+        idx = (self.queue_ptr + idx) % self.queue_size
+        self.tar_queue[idx] = tar_img_feat[-n:].to(self.tar_queue.dtype)
+        self.tar_queue_step[idx] = self.queue_steps
+        self.queue_ptr = (self.queue_ptr + n) % self.queue_size
+        self.queue_steps += 1
+
+    def queued_targets(self):
+        """Queued target features not older than queue_max_age steps, or None."""
+        if self.tar_queue is None:
+            return None
+        valid = self.tar_queue_step >= 0
+        if self.queue_max_age > 0:
+            valid &= self.tar_queue_step >= self.queue_steps - self.queue_max_age
+        if not valid.any():
+            return None
+        return self.tar_queue[valid]
+
+    @staticmethod
+    def unique_refs(ref_img, ref_ids):
+        """First image of every unique ref_id, and the row of each item in them."""
+        unique_ids, ref_index = torch.unique(ref_ids, return_inverse=True)
+        if len(unique_ids) == len(ref_ids):
+            return ref_img, None
+        rows = torch.arange(len(ref_ids), device=ref_ids.device)
+        first = torch.full_like(unique_ids, len(ref_ids)).scatter_reduce(
+            0, ref_index, rows, reduce="amin"
+        )
+        return ref_img[first], ref_index
+
+    def encode_query(self, ref_img, text_tokens, ref_index=None):
+        """
+        Query features [bs, 32, 256] of the reference and the edit text.
+
+        With ref_index (bs,), ref_img only holds the unique references and
+        ref_index[i] is the reference of text i: the ViT and the cross-attention
+        keys/values of the Q-Former run once per reference.
+        """
+        ref_img_embs, n_frames = self.encode_ref(ref_img)
+        device = ref_img_embs.device
+
+        input_ids = text_tokens.input_ids
+        text_atts = text_tokens.attention_mask
+        if n_frames > 1:
+            # 每帧复用同一条修改文本
+            input_ids = input_ids.repeat_interleave(n_frames, dim=0)
+            text_atts = text_atts.repeat_interleave(n_frames, dim=0)
+            if ref_index is not None:
+                # 第i条文本的第f帧 -> 第ref_index[i]个参考的第f帧
+                frame_ids = torch.arange(n_frames, device=ref_index.device)
+                ref_index = (ref_index[:, None] * n_frames + frame_ids).flatten()
+
+        ref_img_atts = torch.ones(ref_img_embs.size()[:-1], dtype=torch.long).to(device)
+
+        query_tokens = self.query_tokens.expand(input_ids.shape[0], -1, -1)
+        query_atts = torch.ones(query_tokens.size()[:-1], dtype=torch.long).to(device)
+        attention_mask = torch.cat([query_atts, text_atts], dim=1)
+
+        output = self.Qformer.bert(
+            input_ids,  # [bs, 32]
+            query_embeds=query_tokens,  # [bs, 32, 768]
+            attention_mask=attention_mask,  # [bs, 64]
+            encoder_hidden_states=ref_img_embs,  # [bs, 677, 1408]
+            encoder_attention_mask=ref_img_atts,  # [bs, 677]
+            return_dict=True,
+            encoder_index=ref_index,
+        )
+
+        vl_embs = output.last_hidden_state[:, : query_tokens.size(1), :] #[bs , 32 , 768]
+        query_si_feat = F.normalize(self.text_proj(vl_embs), dim=-1) #[bs ,32 ,256]
+        if n_frames > 1:
+            # (B*F, 32, 256) -> (B, 32, 256), 帧间平均
+            query_si_feat = query_si_feat.view(-1, n_frames, *query_si_feat.shape[1:])
+            query_si_feat = F.normalize(query_si_feat.mean(dim=1), dim=-1)
+        return query_si_feat
+
+    def query_features(self, batch):
+        """Query features [bs, 32, 256] of the (local) batch, before all-gather."""
         #改动
         #-----------------------------------------------
         # txt1 = batch["txt1"]
         #-----------------------------------------------
         ref_img = batch["ref_img"]
         # print(f'ref_img的形状: {ref_img.shape}') #64 ,3 ,3 ,364 ,364
-        # ref_img = ref_img.reshape(-1  ,3 ,364 ,364)
+        # 多帧 (B, F, 3, H, W) 在encode_ref中展平
 
-        tar_img_feat = batch["tar_img_feat"]
         caption = batch["edit"]
 
         ref_img.half()
 
         device = ref_img.device
 
-        # Encode the target image
-        tar_img_feat = tar_img_feat.to(device)
-        tar_img_feat = concat_all_gather(tar_img_feat, fabric)
-
         # Text
-        text_tokens = self.tokenizer(
-            caption,
-            padding="max_length",
-            truncation=True,
-            max_length=self.max_txt_len,
-            return_tensors="pt",
-        ).to(device)
+        if "edit_ids" in batch:
+            # 数据集预先tokenize, 在DataLoader worker中按batch内最长补齐
+            text_tokens = BatchEncoding(
+                {"input_ids": batch["edit_ids"], "attention_mask": batch["edit_atts"]}
+            ).to(device)
+        else:
+            # padding只影响被mask的位置, 按batch内最长补齐, 与测评一致
+            text_tokens = self.tokenizer(
+                caption,
+                padding="longest",
+                truncation=True,
+                max_length=self.max_txt_len,
+                return_tensors="pt",
+            ).to(device)
 
         #改动8 将txt全部token化
         #----------------------------------------------------------------------------------------------------------------------------------------
@@ -183,39 +356,43 @@ class BLIP2Cir(Blip2Base):
         #     return_tensors="pt",
         # ).to(device)
         #----------------------------------------------------------------------------------------------------------------------------------------
-        if self.train_vit:
-            ref_img_embs = self.ln_vision(self.visual_encoder(ref_img))
-        else:
-            with torch.no_grad():
-                ref_img_embs = self.ln_vision(self.visual_encoder(ref_img))
-
-        # Encode the reference image
-        ref_img_atts = torch.ones(ref_img_embs.size()[:-1], dtype=torch.long).to(device)
-
         ###============== Image-text Matching ===================###
-        query_tokens = self.query_tokens.expand(ref_img_embs.shape[0], -1, -1)
-        query_atts = torch.ones(query_tokens.size()[:-1], dtype=torch.long).to(
-            self.device
-        )
-        attention_mask = torch.cat([query_atts, text_tokens.attention_mask], dim=1)
+        ref_index = None
+        if "ref_id" in batch:
+            # 共享参考视频的triplet只编码一次参考, 再按ref_index分发回每一行
+            ref_img, ref_index = self.unique_refs(ref_img, batch["ref_id"].to(device))
+        return self.encode_query(ref_img, text_tokens, ref_index) #[bs ,32 ,256]
+
+    def forward(self, batch, fabric, query_si_feat=None, return_query=False):
+        """
+        Contrastive loss of the batch. Used by the gradient cache
+        (src.tools.grad_cache): return_query only returns the query features
+        of the batch, and query_si_feat computes the loss from given features.
+        """
+        if return_query:
+            return self.query_features(batch)
+
+        device = batch["ref_img"].device
 
-        output = self.Qformer.bert(
-            text_tokens.input_ids,  # [bs, 32]
-            query_embeds=query_tokens,  # [bs, 32, 768]
-            attention_mask=attention_mask,  # [bs, 64]
-            encoder_hidden_states=ref_img_embs,  # [bs, 677, 1408]
-            encoder_attention_mask=ref_img_atts,  # [bs, 677]
-            return_dict=True,
-        )
+        # Encode the target image
+        # 目标(和文本)特征是预先提取的, 不需要梯度: 一次异步all-gather, 与下面的ViT/Q-Former重叠
+        tar_feats = [batch["tar_img_feat"].to(device)]
+        if self.si_tc_weight > 0:
+            assert "tar_txt_feat" in batch, "tar_txt_feat is not in batch"
+            tar_feats.append(batch["tar_txt_feat"].to(device))
+        wait_tar_feats = all_gather_async(tar_feats, fabric, self.gather_dtype)
 
-        vl_embs = output.last_hidden_state[:, : query_tokens.size(1), :] #[bs , 32 , 768]
-        query_si_feat = F.normalize(self.text_proj(vl_embs), dim=-1) #[bs ,32 ,256]
-        query_si_feat = all_gather_with_grad(query_si_feat, fabric)
+        if query_si_feat is None:
+            query_si_feat = self.query_features(batch)
 
         # mean over all query tokens 改动5暂时注释掉平均
         # query_si_feats = query_si_feat #我保留一下mean之前的结果
         query_si_feat = query_si_feat.mean(dim=1) #[bs , 256]
         query_si_feat = F.normalize(query_si_feat, dim=-1) #真正的查询
+        # 先在本卡平均32个query token, 只all-gather (bs, 256)
+        (query_si_feat,) = all_gather_features([query_si_feat], fabric, self.gather_dtype)
+        tar_feats = wait_tar_feats()
+        tar_img_feat = tar_feats[0]
         # tar_img_feat = tar_img_feat.mean(dim=1)
         tar_img_feat = F.normalize(tar_img_feat, dim=-1)
         # print(f'不mean的tarf:{tar_img_feat.shape}')
@@ -277,9 +454,19 @@ class BLIP2Cir(Blip2Base):
         # xpool_sim_matrix = sim_matrix_training(query_si_feat , cross_feats,'max') #(B,B)对比矩阵
         # cross_feats , attn_entropy = self.xpool_cross_att(query_si_feat , tar_img_feat,is_training=True) #交叉结果(B,B,dim)
         # --------
-        cross_feats, attn_entropy = self.xpool_cross_att(query_si_feat , tar_img_feat,is_training=True) #交叉结果(B,B,dim)
         # cross_feats = self.xpool_cross_att(query_si_feat , tar_img_feat,is_training=False) #交叉结果(B,B,dim)
-        xpool_sim_matrix = sim_matrix_training(query_si_feat , cross_feats,'max') #(B,B)对比矩阵
+        # xpool_chunk > 0: 按目标分块计算, 反向时逐块重算, 不保存(B,B,dim)的交叉结果
+        xpool_sim_matrix, attn_entropy = chunked_xpool_sim(
+            self.xpool_cross_att, query_si_feat, tar_img_feat, self.xpool_chunk
+        ) #(B,B)对比矩阵
+        queue_kwargs = {}
+        queue_feat = self.queued_targets() if self.training else None
+        if queue_feat is not None:
+            # 队列中的目标只作为负样本, 注意力熵只按batch内的目标计算
+            queue_sim_matrix, _ = chunked_xpool_sim(
+                self.xpool_cross_att, query_si_feat, queue_feat, self.xpool_chunk
+            ) #(B,K)
+            queue_kwargs["queue_sim_matrix"] = queue_sim_matrix
         #---------------------------------
 
 
@@ -290,7 +477,7 @@ class BLIP2Cir(Blip2Base):
         if self.si_ti_weight > 0:
             #改动，使用xpool_hn_hce损失
             # print("测试损失")
-            si_ti_loss = self.loss(xpool_sim_matrix,self.temp)
+            si_ti_loss = self.loss(xpool_sim_matrix,self.temp, **queue_kwargs)
             loss += si_ti_loss * self.si_ti_weight
 
             # ===== 加上那个注意力熵 =====
@@ -302,10 +489,7 @@ class BLIP2Cir(Blip2Base):
         use_txt_loss = False
         if self.si_tc_weight > 0:
             # print(f'检测是否打开了txt_loss')
-            assert "tar_txt_feat" in batch, "tar_txt_feat is not in batch"
-            tar_txt_feat = batch["tar_txt_feat"]
-
-            tar_txt_feat = all_gather_with_grad(tar_txt_feat, fabric)
+            tar_txt_feat = tar_feats[1]
             #改动
             #------------------------------------------------------
             #云模型
@@ -330,6 +514,9 @@ class BLIP2Cir(Blip2Base):
             diff_feat_loss = self.loss(diff_feat, tar_img_feat, self.temp)
             loss = (diff_feat_loss * self.diff_loss_weight) + loss
 
+        if self.training and self.queue_size > 0:
+            self.dequeue_and_enqueue(tar_img_feat)
+
         return loss
 
 
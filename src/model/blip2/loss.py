@@ -1,6 +1,9 @@
+import math
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from src.model.cloud.cloud import Cloud
 from src.model.blip2.xpool_cross_att import sim_matrix_training
 
@@ -25,17 +28,116 @@ class CrossEntropyLoss(nn.Module):
         return (loss_t2q + loss_q2t) / 2
 
 
+def off_diagonal_logsumexp(logits: torch.Tensor, offset: int = 0):
+    """
+    logsumexp over dim 1 of a block of rows of a (B, B) matrix starting at row
+    offset, without the diagonal terms (row i, column offset + i).
+
+    The diagonal of logits is overwritten with -inf: pass a temporary (e.g.
+    beta * rows), not a tensor used elsewhere.
+    """
+    # -inf written in place drops the diagonal from the sum, without a (B, B) mask
+    logits.diagonal(offset).fill_(-math.inf)
+    return torch.logsumexp(logits, dim=1)
+
+
+def map_row_chunks(fn, logits: torch.Tensor, chunk_size: int = 0, *args):
+    """
+    Concatenation of fn(rows, start, *args) over blocks of chunk_size rows. The
+    blocks are recomputed in backward, so only (chunk_size, B) intermediates
+    are kept alive.
+    """
+    if chunk_size <= 0 or chunk_size >= len(logits):
+        return fn(logits, 0, *args)
+    chunks = []
+    for start in range(0, len(logits), chunk_size):
+        rows = logits[start : start + chunk_size]
+        if torch.is_grad_enabled():
+            chunks.append(checkpoint(fn, rows, start, *args, use_reentrant=False))
+        else:
+            chunks.append(fn(rows, start, *args))
+    return torch.cat(chunks)
+
+
+def hn_nce_loss(
+    sim_matrix: torch.Tensor,
+    alpha: float,
+    beta: float,
+    chunk_size=0,
+    queue_sim: torch.Tensor = None,
+):
+    """
+    Hard-negative NCE of the (B, B) similarity matrix already divided by the
+    temperature, both directions, in the log domain:
+        log(alpha * exp(s_ii) + sum_{j != i} (B - 1) * exp((1 + beta) * s_ij) / Z_j)
+    with Z_j the sum of exp(beta * s) of row j (v2t) or column j (t2v) without
+    the diagonal, as the weights w_v2t and w_t2v of the original implementation.
+
+    queue_sim (B, K) holds the similarities of the rows with K queued targets,
+    extra negatives of the v2t (query -> target) direction only. The queued
+    targets have no row of their own, so v2t then normalises the weights of each
+    row i over its B - 1 + K negatives: (B - 1 + K) * exp(beta * s_ij) / Z_i.
+    """
+    sim_matrix = sim_matrix.float()
+    batch_size = sim_matrix.size(0)
+    nominator = torch.diagonal(sim_matrix)
+    log_pos = nominator + (math.log(alpha) if alpha > 0 else -math.inf)
+
+    def log_z(rows, start):
+        return off_diagonal_logsumexp(beta * rows, start)
+
+    def log_neg_v2t(rows, start, log_z_v2t):
+        return off_diagonal_logsumexp((1 + beta) * rows - log_z_v2t, start)
+
+    def log_neg_t2v(rows, start, log_z_t2v):
+        log_z_rows = log_z_t2v[start : start + len(rows), None]
+        return off_diagonal_logsumexp((1 + beta) * rows - log_z_rows, start)
+
+    def log_neg_queue(rows, start, queue_sim):
+        queue_rows = queue_sim[start : start + len(rows)]
+        log_z_rows = torch.logaddexp(
+            off_diagonal_logsumexp(beta * rows, start),
+            torch.logsumexp(beta * queue_rows, dim=1),
+        )
+        log_neg_rows = torch.logaddexp(
+            off_diagonal_logsumexp((1 + beta) * rows, start),
+            torch.logsumexp((1 + beta) * queue_rows, dim=1),
+        )
+        return log_neg_rows - log_z_rows
+
+    if queue_sim is None:
+        log_z_v2t = map_row_chunks(log_z, sim_matrix, chunk_size)
+        log_neg_v2t = map_row_chunks(log_neg_v2t, sim_matrix, chunk_size, log_z_v2t)
+        log_n_v2t = math.log(batch_size - 1)
+    else:
+        queue_sim = queue_sim.float()
+        log_neg_v2t = map_row_chunks(log_neg_queue, sim_matrix, chunk_size, queue_sim)
+        log_n_v2t = math.log(batch_size - 1 + queue_sim.size(1))
+    log_z_t2v = map_row_chunks(log_z, sim_matrix.T, chunk_size)
+    log_neg_t2v = map_row_chunks(log_neg_t2v, sim_matrix.T, chunk_size, log_z_t2v)
+
+    denominator_v2t = torch.logaddexp(log_neg_v2t + log_n_v2t, log_pos)
+    denominator_t2v = torch.logaddexp(log_neg_t2v + math.log(batch_size - 1), log_pos)
+
+    return (denominator_v2t - nominator).mean() + (
+        denominator_t2v - nominator
+    ).mean()
+
+
 class HardNegativeNCE(nn.Module):
     """
     Hard-Negative NCE loss for contrastive learning.
     https://arxiv.org/pdf/2301.02280.pdf
     """
 
-    def __init__(self, alpha: float = 1.0, beta: float = 0.0, **kwargs):
+    def __init__(
+        self, alpha: float = 1.0, beta: float = 0.0, chunk_size: int = 0, **kwargs
+    ):
         """
         Args:
             alpha: rescaling factor for positiver terms
             beta: concentration parameter
+            chunk_size: rows computed at a time (recomputed in backward), 0 for all
 
         Note:
             alpha = 1 and beta = 0 corresponds to the original Info-NCE loss
@@ -43,57 +145,44 @@ class HardNegativeNCE(nn.Module):
         super(HardNegativeNCE, self).__init__()
         self.alpha = alpha
         self.beta = beta
+        self.chunk_size = chunk_size
 
     def forward(
         self,
         video_embds: torch.Tensor,
         text_embds: torch.Tensor,
         temp,
+        queue_embds: torch.Tensor = None,
     ):
         """
         Args:
             video_embds: (batch_size, video_embd_dim)
             text_embds: (batch_size, text_embd_dim)
+            queue_embds: (queue_size, text_embd_dim), extra negatives of the videos
         """
-        batch_size = video_embds.size(0)
         # computation of the similarity matrix
         sim_matrix = video_embds @ text_embds.T  # (batch_size, batch_size)
         # scale the similarity matrix with the temperature
         sim_matrix = sim_matrix / temp
         sim_matrix = sim_matrix.float()
+        queue_sim = None
+        if queue_embds is not None:
+            queue_sim = video_embds @ queue_embds.T / temp
 
-        nominator = torch.diagonal(sim_matrix)
-
-        beta_sim = self.beta * sim_matrix
-        w_v2t = (
-            (batch_size - 1)
-            * torch.exp(beta_sim)
-            / (torch.exp(beta_sim).sum(dim=1) - torch.exp(torch.diagonal(beta_sim)))
+        return hn_nce_loss(
+            sim_matrix, self.alpha, self.beta, self.chunk_size, queue_sim
         )
-        w_t2v = (
-            (batch_size - 1)
-            * torch.exp(beta_sim)
-            / (torch.exp(beta_sim).sum(dim=0) - torch.exp(torch.diagonal(beta_sim)))
-        )
-        # replace the diagonal terms of w_v2t and w_t2v with alpha
-        w_v2t[range(batch_size), range(batch_size)] = self.alpha
-        w_t2v[range(batch_size), range(batch_size)] = self.alpha
-
-        denominator_v2t = torch.log((torch.exp(sim_matrix) * w_v2t).sum(dim=1))
-        denominator_t2v = torch.log((torch.exp(sim_matrix) * w_t2v).sum(dim=0))
-
-        hn_nce_loss = (denominator_v2t - nominator).mean() + (
-            denominator_t2v - nominator
-        ).mean()
-        return hn_nce_loss
 
 #云模型 + 硬负对比损失
 class CloudHardNegativeNCE(nn.Module):
-    def __init__(self, alpha: float = 1.0, beta: float = 0.0, **kwargs):
+    def __init__(
+        self, alpha: float = 1.0, beta: float = 0.0, chunk_size: int = 0, **kwargs
+    ):
         """
         Args:
             alpha: rescaling factor for positiver terms
             beta: concentration parameter
+            chunk_size: rows computed at a time (recomputed in backward), 0 for all
 
         Note:
             alpha = 1 and beta = 0 corresponds to the original Info-NCE loss
@@ -101,19 +190,21 @@ class CloudHardNegativeNCE(nn.Module):
         super(CloudHardNegativeNCE, self).__init__()  # 修正为当前类名
         self.alpha = alpha
         self.beta = beta
+        self.chunk_size = chunk_size
 
     def forward(
         self,
         video_embds: torch.Tensor,
         text_embds: torch.Tensor,
         temp,
+        queue_embds: torch.Tensor = None,
     ):
         """
         Args:
             video_embds: (batch_size, video_embd_dim)
             text_embds: (batch_size, text_embd_dim)
+            queue_embds: (queue_size, text_embd_dim), extra negatives of the videos
         """
-        batch_size = video_embds.size(0)
         #改动
         #------------------------------------------------------
         #云模型
@@ -126,40 +217,25 @@ class CloudHardNegativeNCE(nn.Module):
         # scale the similarity matrix with the temperature
         sim_matrix = sim_matrix / temp
         sim_matrix = sim_matrix.float()
+        queue_sim = None
+        if queue_embds is not None:
+            queue_sim = video_embds @ queue_embds.T / temp
 
-        nominator = torch.diagonal(sim_matrix)
-
-        beta_sim = self.beta * sim_matrix
-        w_v2t = (
-            (batch_size - 1)
-            * torch.exp(beta_sim)
-            / (torch.exp(beta_sim).sum(dim=1) - torch.exp(torch.diagonal(beta_sim)))
+        return hn_nce_loss(
+            sim_matrix, self.alpha, self.beta, self.chunk_size, queue_sim
         )
-        w_t2v = (
-            (batch_size - 1)
-            * torch.exp(beta_sim)
-            / (torch.exp(beta_sim).sum(dim=0) - torch.exp(torch.diagonal(beta_sim)))
-        )
-        # replace the diagonal terms of w_v2t and w_t2v with alpha
-        w_v2t[range(batch_size), range(batch_size)] = self.alpha
-        w_t2v[range(batch_size), range(batch_size)] = self.alpha
-
-        denominator_v2t = torch.log((torch.exp(sim_matrix) * w_v2t).sum(dim=1))
-        denominator_t2v = torch.log((torch.exp(sim_matrix) * w_t2v).sum(dim=0))
-
-        hn_nce_loss = (denominator_v2t - nominator).mean() + (
-            denominator_t2v - nominator
-        ).mean()
-        return hn_nce_loss
 
 
 # xpool_hce交叉损失
 class XpoolHardNegativeNCE(nn.Module):
-    def __init__(self, alpha: float = 1.0, beta: float = 0.0, **kwargs):
+    def __init__(
+        self, alpha: float = 1.0, beta: float = 0.0, chunk_size: int = 0, **kwargs
+    ):
         """
         Args:
             alpha: rescaling factor for positiver terms
             beta: concentration parameter
+            chunk_size: rows computed at a time (recomputed in backward), 0 for all
 
         Note:
             alpha = 1 and beta = 0 corresponds to the original Info-NCE loss
@@ -167,47 +243,31 @@ class XpoolHardNegativeNCE(nn.Module):
         super(XpoolHardNegativeNCE, self).__init__()
         self.alpha = alpha
         self.beta = beta
+        self.chunk_size = chunk_size
 
     def forward(
         self,
         xpool_sim_matrix : torch.Tensor,
         temp,
+        queue_sim_matrix: torch.Tensor = None,
     ):
         """
         Args:
             xpool_sim_matrix: (batch_size,batch_size,dim)
+            queue_sim_matrix: (batch_size, queue_size), queries vs queued targets
         """
-        batch_size = xpool_sim_matrix.size(0)
         # computation of the similarity matrix
         sim_matrix = xpool_sim_matrix
         # scale the similarity matrix with the temperature
         sim_matrix = sim_matrix / temp
         sim_matrix = sim_matrix.float()
+        queue_sim = None
+        if queue_sim_matrix is not None:
+            queue_sim = queue_sim_matrix / temp
 
-        nominator = torch.diagonal(sim_matrix)
-
-        beta_sim = self.beta * sim_matrix
-        w_v2t = (
-            (batch_size - 1)
-            * torch.exp(beta_sim)
-            / (torch.exp(beta_sim).sum(dim=1) - torch.exp(torch.diagonal(beta_sim)))
-        )
-        w_t2v = (
-            (batch_size - 1)
-            * torch.exp(beta_sim)
-            / (torch.exp(beta_sim).sum(dim=0) - torch.exp(torch.diagonal(beta_sim)))
+        return hn_nce_loss(
+            sim_matrix, self.alpha, self.beta, self.chunk_size, queue_sim
         )
-        # replace the diagonal terms of w_v2t and w_t2v with alpha
-        w_v2t[range(batch_size), range(batch_size)] = self.alpha
-        w_t2v[range(batch_size), range(batch_size)] = self.alpha
-
-        denominator_v2t = torch.log((torch.exp(sim_matrix) * w_v2t).sum(dim=1))
-        denominator_t2v = torch.log((torch.exp(sim_matrix) * w_t2v).sum(dim=0))
-
-        hn_nce_loss = (denominator_v2t - nominator).mean() + (
-            denominator_t2v - nominator
-        ).mean()
-        return hn_nce_loss
 
 
 #增强版硬负样本对比损失，支持跨模态硬负样本挖掘
@@ -387,3 +447,55 @@ class CrossModalHardNegativeNCE(nn.Module):
         }
         
         return loss, aux_info
+
+
+if __name__ == "__main__":
+    # the fused loss matches the weights of the original implementation
+    def reference_hn_nce(sim_matrix, alpha, beta):
+        batch_size = sim_matrix.size(0)
+        nominator = torch.diagonal(sim_matrix)
+        beta_sim = beta * sim_matrix
+        w_v2t = (
+            (batch_size - 1)
+            * torch.exp(beta_sim)
+            / (torch.exp(beta_sim).sum(dim=1) - torch.exp(torch.diagonal(beta_sim)))
+        )
+        w_t2v = (
+            (batch_size - 1)
+            * torch.exp(beta_sim)
+            / (torch.exp(beta_sim).sum(dim=0) - torch.exp(torch.diagonal(beta_sim)))
+        )
+        w_v2t[range(batch_size), range(batch_size)] = alpha
+        w_t2v[range(batch_size), range(batch_size)] = alpha
+        denominator_v2t = torch.log((torch.exp(sim_matrix) * w_v2t).sum(dim=1))
+        denominator_t2v = torch.log((torch.exp(sim_matrix) * w_t2v).sum(dim=0))
+        return (denominator_v2t - nominator).mean() + (
+            denominator_t2v - nominator
+        ).mean()
+
+    torch.manual_seed(0)
+    for alpha, beta, chunk_size in [(1, 0, 0), (1, 0.5, 0), (0.8, 0.5, 7), (1, 1, 16)]:
+        sim = torch.randn(37, 37, dtype=torch.float64) * 3
+        sim_ref = sim.clone().requires_grad_()
+        sim_fused = sim.clone().requires_grad_()
+        loss_ref = reference_hn_nce(sim_ref, alpha, beta)
+        loss_fused = hn_nce_loss(sim_fused, alpha, beta, chunk_size)
+        loss_ref.backward()
+        loss_fused.backward()
+        assert torch.allclose(loss_ref, loss_fused.double(), atol=1e-5), (
+            loss_ref,
+            loss_fused,
+        )
+        assert torch.allclose(sim_ref.grad, sim_fused.grad, atol=1e-5)
+
+    # queued targets: extra columns of the v2t softmax (Info-NCE for beta = 0)
+    sim, queue_sim = torch.randn(37, 37) * 3, torch.randn(37, 100) * 3
+    labels = torch.arange(37)
+    loss_ce = F.cross_entropy(torch.cat([sim, queue_sim], dim=1), labels)
+    loss_ce = loss_ce + F.cross_entropy(sim.T, labels)
+    loss_queue = hn_nce_loss(sim, 1, 0, queue_sim=queue_sim)
+    assert torch.allclose(loss_ce, loss_queue, atol=1e-5), (loss_ce, loss_queue)
+    loss_queue = hn_nce_loss(sim, 1, 0.5, queue_sim=queue_sim)
+    loss_chunks = hn_nce_loss(sim, 1, 0.5, chunk_size=8, queue_sim=queue_sim)
+    assert torch.allclose(loss_queue, loss_chunks, atol=1e-5)
+    print("hn_nce ok")
@@ -0,0 +1,170 @@
+"""
+Token merging (ToMe, Bolya et al. 2023) for the EVA ViT of LAVIS.
+
+After the attention of each block, the r most similar pairs of tokens (cosine
+similarity of the attention keys, bipartite matching between even and odd
+tokens) are averaged, so the ViT and the Q-Former cross-attention run on fewer
+tokens. The class token is never merged. Merged tokens keep their size, used as
+weights for the following merges and as a log-bias of the attention
+(proportional attention).
+"""
+
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+def bipartite_soft_matching(metric: torch.Tensor, r: int, class_token: bool = True):
+    """Merge function removing r tokens, from the (B, N, C) similarity metric."""
+    protected = 1 if class_token else 0
+    r = min(r, (metric.shape[1] - protected) // 2)
+    if r <= 0:
+        return lambda x, mode="mean": x
+
+    with torch.no_grad():
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = metric[..., ::2, :], metric[..., 1::2, :]
+        scores = a @ b.transpose(-1, -2)
+        if class_token:
+            scores[..., 0, :] = -math.inf
+
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx = edge_idx[..., r:, :]  # tokens of a that are kept
+        src_idx = edge_idx[..., :r, :]  # tokens of a merged into b
+        dst_idx = node_idx[..., None].gather(dim=-2, index=src_idx)
+        if class_token:
+            # keep the class token first
+            unm_idx = unm_idx.sort(dim=1)[0]
+
+    def merge(x: torch.Tensor, mode="mean") -> torch.Tensor:
+        src, dst = x[..., ::2, :], x[..., 1::2, :]
+        n, t1, c = src.shape
+        unm = src.gather(dim=-2, index=unm_idx.expand(n, t1 - r, c))
+        src = src.gather(dim=-2, index=src_idx.expand(n, r, c))
+        dst = dst.scatter_reduce(-2, dst_idx.expand(n, r, c), src, reduce=mode)
+        return torch.cat([unm, dst], dim=1)
+
+    return merge
+
+
+def merge_wavg(merge, x: torch.Tensor, size: torch.Tensor = None):
+    """Average the merged tokens weighted by their size, returns (x, size)."""
+    if size is None:
+        size = torch.ones_like(x[..., 0, None])
+    x = merge(x * size, mode="sum")
+    size = merge(size, mode="sum")
+    return x / size, size
+
+
+def attention_with_metric(attn, x, rel_pos_bias=None, size=None):
+    """Forward of the LAVIS ViT Attention, also returning the keys averaged over heads."""
+    assert (
+        attn.relative_position_bias_table is None and rel_pos_bias is None
+    ), "token merging does not support relative position biases"
+    B, N, C = x.shape
+    qkv_bias = None
+    if attn.q_bias is not None:
+        qkv_bias = torch.cat(
+            (
+                attn.q_bias,
+                torch.zeros_like(attn.v_bias, requires_grad=False),
+                attn.v_bias,
+            )
+        )
+    qkv = F.linear(input=x, weight=attn.qkv.weight, bias=qkv_bias)
+    qkv = qkv.reshape(B, N, 3, attn.num_heads, -1).permute(2, 0, 3, 1, 4)
+    q, k, v = qkv[0], qkv[1], qkv[2]
+
+    q = q * attn.scale
+    scores = q @ k.transpose(-2, -1)
+    if size is not None:
+        # proportional attention: a merged token counts for the tokens it holds
+        scores = scores + size.log()[:, None, None, :, 0]
+    scores = attn.attn_drop(scores.softmax(dim=-1))
+
+    x = (scores @ v).transpose(1, 2).reshape(B, N, -1)
+    x = attn.proj_drop(attn.proj(x))
+    return x, k.mean(1)
+
+
+def make_tome_block(block_class):
+    class ToMeBlock(block_class):
+        def forward(self, x, rel_pos_bias=None):
+            info = self._tome_info
+            if not info["enabled"]:
+                return super().forward(x, rel_pos_bias)
+
+            size = info["size"] if info["prop_attn"] else None
+            x_attn, metric = attention_with_metric(
+                self.attn, self.norm1(x), rel_pos_bias, size
+            )
+            if self.gamma_1 is not None:
+                x_attn = self.gamma_1 * x_attn
+            x = x + self.drop_path(x_attn)
+
+            r = info["r"].pop(0)
+            if r > 0:
+                merge = bipartite_soft_matching(metric, r, info["class_token"])
+                x, info["size"] = merge_wavg(merge, x, info["size"])
+
+            x_mlp = self.mlp(self.norm2(x))
+            if self.gamma_2 is not None:
+                x_mlp = self.gamma_2 * x_mlp
+            return x + self.drop_path(x_mlp)
+
+    return ToMeBlock
+
+
+def make_tome_vit(vit_class):
+    class ToMeVisionTransformer(vit_class):
+        def forward(self, *args, **kwargs):
+            self._tome_info["r"] = list(self.tome_r)
+            self._tome_info["size"] = None
+            x = super().forward(*args, **kwargs)
+            self._tome_info["tokens"] = x.shape[1]
+            return x
+
+    return ToMeVisionTransformer
+
+
+def apply_tome(visual_encoder, r, prop_attn: bool = True):
+    """
+    Patch a LAVIS ViT in place to merge r tokens in each block, r is an int or
+    a list with one value per block. Merging only happens while
+    visual_encoder._tome_info["enabled"] is True (set by BLIP2Cir in eval mode).
+    """
+    n_blocks = len(visual_encoder.blocks)
+    if isinstance(r, int):
+        r = [r] * n_blocks
+    r = list(r)
+    assert len(r) == n_blocks, f"tome_r has {len(r)} values for {n_blocks} blocks"
+
+    visual_encoder.__class__ = make_tome_vit(visual_encoder.__class__)
+    visual_encoder.tome_r = r
+    visual_encoder._tome_info = {
+        "r": list(r),
+        "size": None,
+        "tokens": None,
+        "class_token": True,
+        "prop_attn": prop_attn,
+        "enabled": False,
+    }
+    block_class = make_tome_block(visual_encoder.blocks[0].__class__)
+    for block in visual_encoder.blocks:
+        block.__class__ = block_class
+        block._tome_info = visual_encoder._tome_info
+    return visual_encoder
+
+
+if __name__ == "__main__":
+    # merging r tokens keeps the class token and the total size
+    torch.manual_seed(0)
+    x = torch.randn(2, 677, 16)
+    merge = bipartite_soft_matching(x, 8)
+    x_merged, size = merge_wavg(merge, x)
+    assert x_merged.shape == (2, 669, 16), x_merged.shape
+    assert torch.allclose(x_merged[:, 0], x[:, 0]), "class token was merged"
+    assert torch.allclose(size.sum(dim=1), torch.full((2, 1), 677.0))
+    print("tome ok")
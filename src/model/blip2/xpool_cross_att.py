@@ -26,11 +26,12 @@ class MultiHeadedAttention(nn.Module):
         #============================
 
     
-    def forward(self, text_embeds, video_embeds,is_training = False):
+    def forward(self, text_embeds, video_embeds,is_training = False, viz=True):
         """
         Input
             text_embeds: num_texts x embed_dim
             video_embeds: num_vids x num_frames x embed_dim
+            viz: save the attention weights of the first calls (viz_count)
         Output
             o: num_vids x num_texts x embed_dim
         """
@@ -85,7 +86,7 @@ class MultiHeadedAttention(nn.Module):
         renormalized_weights = masked_weights / (weight_sums + 1e-8)
         
         # ======= 新增可视化保存逻辑 =======
-        if self.viz_count < 5:
+        if viz and self.viz_count < 5:
             print(f'进来了，在保存第{self.viz_count}批的')
             os.makedirs(self.save_dir, exist_ok=True)
             # 提取第一个样本，第一个 head 的权重 [32 slots, 1 text]
@@ -156,11 +157,12 @@ class Transformer(nn.Module):
                     param.data.fill_(0.)
 
 
-    def forward(self, text_embeds, video_embeds,is_training = False):
+    def forward(self, text_embeds, video_embeds,is_training = False, viz=True):
         """
         Input
             text_embeds: num_texts x embed_dim
             video_embeds: num_vids x num_frames x embed_dim
+            viz: passed to the cross attention
         Output
             out: num_vids x num_texts x embed_dim
         """
@@ -168,7 +170,7 @@ class Transformer(nn.Module):
         video_embeds = self.layer_norm1(video_embeds)
 
         # num_vids x num_texts x embed_dim
-        attn_out = self.cross_attn(text_embeds, video_embeds,is_training)
+        attn_out = self.cross_attn(text_embeds, video_embeds,is_training, viz=viz)
         attn_out = self.layer_norm2(attn_out)
 
         linear_out = self.linear_proj(attn_out)
@@ -216,6 +218,112 @@ def sim_matrix_training(text_embeds, vid_embeds_pooled, pooling_type):
     return sims
 
 
+def xpool_sim_chunk(xpool, text_embeds, video_embeds):
+    """
+    Similarity (num_texts x chunk) of the texts with a chunk of the videos, and
+    the sum of the attention entropies of the chunk. No attention visualisation:
+    the chunks can hold fewer than 5 videos and are recomputed in backward.
+    """
+    cross_feats, attn_entropy = xpool(
+        text_embeds, video_embeds, is_training=True, viz=False
+    )
+    sims = sim_matrix_training(text_embeds, cross_feats, 'max')
+    n_entropy = video_embeds.shape[0] * xpool.cross_attn.num_heads * text_embeds.shape[0]
+    return sims, attn_entropy * n_entropy
+
+
+class ChunkedXpoolSim(torch.autograd.Function):
+    """
+    xpool similarity matrix and mean attention entropy, computed chunk_size
+    videos at a time. Only the inputs are saved: the backward recomputes each
+    chunk (same RNG and autocast state, so dropout and gradients are identical)
+    and frees its activations before the next one, the (num_vids, num_texts,
+    dim) cross features are never all kept for backward.
+    """
+
+    @staticmethod
+    def forward(ctx, xpool, chunk_size, text_embeds, video_embeds, *params):
+        ctx.xpool = xpool
+        ctx.chunk_size = chunk_size
+        ctx.params = params
+        ctx.autocast = (torch.is_autocast_enabled(), torch.get_autocast_gpu_dtype())
+        ctx.devices = [video_embeds.device] if video_embeds.is_cuda else []
+        ctx.rng_states = []
+        ctx.save_for_backward(text_embeds, video_embeds)
+
+        sims = []
+        entropy = 0
+        for start in range(0, video_embeds.shape[0], chunk_size):
+            ctx.rng_states.append(get_rng_state(ctx.devices))
+            sims_chunk, entropy_chunk = xpool_sim_chunk(
+                xpool, text_embeds, video_embeds[start : start + chunk_size]
+            )
+            sims.append(sims_chunk)
+            entropy = entropy + entropy_chunk
+        ctx.n_entropy = (
+            video_embeds.shape[0] * xpool.cross_attn.num_heads * text_embeds.shape[0]
+        )
+        return torch.cat(sims, dim=1), entropy / ctx.n_entropy
+
+    @staticmethod
+    def backward(ctx, grad_sims, grad_entropy):
+        text_embeds, video_embeds = ctx.saved_tensors
+        params = [p for p in ctx.params if p.requires_grad]
+        grad_text = torch.zeros_like(text_embeds)
+        grad_video = torch.zeros_like(video_embeds)
+        grad_params = [torch.zeros_like(p) for p in params]
+
+        for i, start in enumerate(range(0, video_embeds.shape[0], ctx.chunk_size)):
+            end = start + ctx.chunk_size
+            with torch.random.fork_rng(devices=ctx.devices):
+                set_rng_state(ctx.rng_states[i], ctx.devices)
+                with torch.enable_grad(), torch.autocast(
+                    "cuda", dtype=ctx.autocast[1], enabled=ctx.autocast[0]
+                ):
+                    text_chunk = text_embeds.detach().requires_grad_()
+                    video_chunk = video_embeds[start:end].detach().requires_grad_()
+                    sims_chunk, entropy_chunk = xpool_sim_chunk(
+                        ctx.xpool, text_chunk, video_chunk
+                    )
+                    out = (sims_chunk * grad_sims[:, start:end]).sum()
+                    out = out + entropy_chunk * grad_entropy / ctx.n_entropy
+            grads = torch.autograd.grad(
+                out, [text_chunk, video_chunk] + params, allow_unused=True
+            )
+            grad_text += grads[0]
+            grad_video[start:end] = grads[1]
+            for grad_param, grad in zip(grad_params, grads[2:]):
+                if grad is not None:
+                    grad_param += grad
+
+        grad_params = iter(grad_params)
+        grads_all = [next(grad_params) if p.requires_grad else None for p in ctx.params]
+        return (None, None, grad_text, grad_video, *grads_all)
+
+
+def get_rng_state(devices):
+    return torch.get_rng_state(), [torch.cuda.get_rng_state(d) for d in devices]
+
+
+def set_rng_state(state, devices):
+    torch.set_rng_state(state[0])
+    for device, cuda_state in zip(devices, state[1]):
+        torch.cuda.set_rng_state(cuda_state, device)
+
+
+def chunked_xpool_sim(xpool, text_embeds, video_embeds, chunk_size):
+    """
+    Same as sim_matrix_training(text, xpool(text, video, is_training=True)[0],
+    'max') and the attention entropy, with O(chunk_size) activation memory.
+    """
+    if chunk_size <= 0 or not torch.is_grad_enabled():
+        cross_feats, attn_entropy = xpool(text_embeds, video_embeds, is_training=True)
+        return sim_matrix_training(text_embeds, cross_feats, 'max'), attn_entropy
+    return ChunkedXpoolSim.apply(
+        xpool, chunk_size, text_embeds, video_embeds, *xpool.parameters()
+    )
+
+
 def cirr_sim_matrix_training(text_embeds, vid_embeds_pooled, pooling_type):
     """
     Computes the similarity matrix using pooled video frames
@@ -281,4 +389,28 @@ if __name__ == '__main__':
     print(f"xpool 输出形状: {xpool_sims.shape}") 
     assert xpool_sims.shape == (num_texts, batch_size), f"xpool 形状错误: 期望 {(batch_size, batch_size)}, 得到 {xpool_sims.shape}"
     
-    print("\nsim_matrix_training 测试通过！输出维度符合预期。")
\ No newline at end of file
+    print("\nsim_matrix_training 测试通过！输出维度符合预期。")
+
+    # chunked_xpool_sim: 与一次性计算的相似度矩阵, 熵和梯度一致
+    print("\n测试 chunked_xpool_sim...")
+    torch.manual_seed(0)
+    xpool = Transformer(embed_dim=embed_dim, num_heads=1).eval()
+    text_embeds = torch.randn(num_texts, embed_dim, requires_grad=True)
+    video_embeds = torch.randn(num_texts, 32, embed_dim, requires_grad=True)
+    params = [text_embeds, video_embeds] + list(xpool.parameters())
+    weights = torch.linspace(-1, 1, num_texts * num_texts).view(num_texts, num_texts)
+
+    # 一次性计算 (不保存可视化)
+    cross_feats, ent_full = xpool(text_embeds, video_embeds, is_training=True, viz=False)
+    sims_full = sim_matrix_training(text_embeds, cross_feats, 'max')
+    grads_full = torch.autograd.grad((sims_full * weights).sum() + ent_full, params)
+
+    # 32个目标: 最后一块不足5个 (7 -> 4), 以及每块都不足5个 (3)
+    for chunk_size in [7, 3]:
+        sims, entropy = chunked_xpool_sim(xpool, text_embeds, video_embeds, chunk_size)
+        grads = torch.autograd.grad((sims * weights).sum() + entropy, params)
+        assert torch.allclose(sims_full, sims, atol=1e-6), "相似度不一致"
+        assert torch.allclose(ent_full, entropy, atol=1e-6), "熵不一致"
+        for g_full, g_chunk in zip(grads_full, grads):
+            assert torch.allclose(g_full, g_chunk, atol=1e-5), "梯度不一致"
+    print("chunked_xpool_sim 测试通过！")
\ No newline at end of file
@@ -9,6 +9,7 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 
+from src.test.blip2.utils import unique_refs
 from src.tools.files import json_dump
 
 
@@ -35,7 +36,9 @@ class TestCirco:
             query_ids.extend(batch["query_id"])
             ref_img_ids.extend(batch["reference_img_id"])
 
-            ref_img_embs = model.ln_vision(model.visual_encoder(ref_img))
+            # 同一参考图只过一次ViT, Q-Former的K/V也只算一次
+            ref_rows, ref_index = unique_refs(batch["reference_img_id"], device)
+            ref_img_embs = model.ln_vision(model.visual_encoder(ref_img[ref_rows]))
             ref_img_atts = torch.ones(ref_img_embs.size()[:-1], dtype=torch.long).to(
                 device
             )
@@ -49,7 +52,7 @@ class TestCirco:
             ).to(device)
 
             # Shift encoder
-            query_tokens = model.query_tokens.expand(ref_img_embs.shape[0], -1, -1)
+            query_tokens = model.query_tokens.expand(len(caption), -1, -1)
             query_atts = torch.ones(query_tokens.size()[:-1], dtype=torch.long).to(
                 device
             )
@@ -62,6 +65,7 @@ class TestCirco:
                 encoder_hidden_states=ref_img_embs,
                 encoder_attention_mask=ref_img_atts,
                 return_dict=True,
+                encoder_index=ref_index,
             )
 
             query_feat = query_embs.last_hidden_state[:, : query_tokens.size(1), :]
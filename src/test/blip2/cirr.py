@@ -8,6 +8,7 @@ import torch
 import torch.nn.functional as F
 from src.model.blip2.xpool_cross_att import Transformer as xpool_cross_att
 from src.model.blip2.xpool_cross_att import sim_matrix_training
+from src.test.blip2.utils import gallery_embs, unique_refs
 from src.tools.files import json_dump
 from src.tools.utils import concat_all_gather
 import gc #做垃圾回收, 内存不够,跑不起来
@@ -41,7 +42,11 @@ class TestCirr:
 
             device = ref_img.device
 
-            ref_img_embs = model.ln_vision(model.visual_encoder(ref_img))
+            # 同一参考图只过一次ViT, Q-Former的K/V也只算一次
+            ref_rows, ref_index = unique_refs(
+                [data_loader.dataset.pairid2ref[i] for i in pair_id.tolist()], device
+            )
+            ref_img_embs = model.ln_vision(model.visual_encoder(ref_img[ref_rows]))
             ref_img_atts = torch.ones(ref_img_embs.size()[:-1], dtype=torch.long).to(
                 device
             )
@@ -55,7 +60,7 @@ class TestCirr:
             ).to(device)
 
             # Shift encoder
-            query_tokens = model.query_tokens.expand(ref_img_embs.shape[0], -1, -1)
+            query_tokens = model.query_tokens.expand(len(caption), -1, -1)
             query_atts = torch.ones(query_tokens.size()[:-1], dtype=torch.long).to(
                 device
             )
@@ -68,6 +73,7 @@ class TestCirr:
                 encoder_hidden_states=ref_img_embs,
                 encoder_attention_mask=ref_img_atts,
                 return_dict=True,
+                encoder_index=ref_index,
             )
 
             vl_embs = output.last_hidden_state[:, : query_tokens.size(1), :]
@@ -162,15 +168,10 @@ class TestCirr:
             img_ids = [data_loader.dataset.pairid2ref[pair_id] for pair_id in pair_ids]
             assert len(img_ids) == len(pair_ids)
 
-            id2emb = OrderedDict()
-            for img_id, target_emb_pth in data_loader.dataset.id2embpth.items():
-                if img_id not in id2emb:
-                    tar_emb = F.normalize(
-                        torch.load(target_emb_pth, weights_only=True).cpu(), dim=-1
-                    )
-                    id2emb[img_id] = tar_emb
-
-            tar_feats = torch.stack(list(id2emb.values()), dim=0).to("cpu")
+            # gallery不依赖模型, 只在第一次测试时从磁盘读取
+            id2emb = OrderedDict.fromkeys(data_loader.dataset.id2embpth)
+            tar_feats = gallery_embs(data_loader.dataset, id2emb)
+            tar_feats = F.normalize(tar_feats, dim=-1)
             vl_feats = vl_feats.to("cpu") #本来就在cpu上吧
             #=====================================================
             device = next(model.xpool_cross_att.parameters()).device
@@ -6,6 +6,8 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 
+from src.test.blip2.utils import speed_report
+from src.tools.files import json_dump
 from src.tools.utils import concat_all_gather
 
 
@@ -65,6 +67,10 @@ class ValCirr:
             vl_feat = F.normalize(model.text_proj(vl_embs), dim=-1)
             vl_feats.append(vl_feat.cpu())
 
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        speed = speed_report(model, len(pair_ids), time.time() - start_time)
+
         pair_ids = torch.tensor(pair_ids, dtype=torch.long)
         vl_feats = torch.cat(vl_feats, dim=0)
 
@@ -82,7 +88,8 @@ class ValCirr:
             for img_id, target_emb_pth in data_loader.dataset.id2embpth.items():
                 if img_id not in id2emb:
                     tar_emb = F.normalize(
-                        torch.load(target_emb_pth, weights_only=True).cpu(), dim=-1
+                        torch.load(target_emb_pth, weights_only=True).cpu().float(),
+                        dim=-1,
                     )
                     id2emb[img_id] = tar_emb
 
@@ -143,6 +150,8 @@ class ValCirr:
                 ][:3]
                 recalls_subset[str(pair_id)] = query_id_recalls_subset
 
+            eval_result = {}
+
             # Compute Recall@K
             paird2target = {
                 ann["pairid"]: ann["target_hard"]
@@ -154,6 +163,7 @@ class ValCirr:
                     r += paird2target[int(pair_id)] in query_id_recalls[:k]
                 r /= len(recalls)
                 fabric.print(f"Recall@{k}: {r*100:.2f}")
+                eval_result[f"R{k}"] = round(r * 100, 4)
 
             # Compute Recall_subset@K
             paird2target_soft = {
@@ -170,5 +180,10 @@ class ValCirr:
                     r += highest_r
                 r /= len(recalls_subset)
                 fabric.print(f"Recall_subset@{k}: {r*100:.2f}")
+                eval_result[f"R_subset{k}"] = round(r * 100, 4)
+
+            eval_result["speed"] = speed
+            fabric.print(speed)
+            json_dump(eval_result, "recalls_cirr-val.json")
 
         fabric.barrier()
@@ -12,6 +12,7 @@ from tabulate import tabulate
 
 from src.model.blip2.xpool_cross_att import Transformer as xpool_cross_att
 from src.model.blip2.xpool_cross_att import sim_matrix_training
+from src.test.blip2.utils import gallery_embs, unique_refs
 from src.tools.files import json_dump, json_load
 import gc #做垃圾回收, 内存不够,跑不起来
 from pathlib import Path
@@ -45,7 +46,11 @@ class TestFashionIQ:
 
             device = ref_img.device
 
-            ref_img_embs = model.ln_vision(model.visual_encoder(ref_img))
+            # 同一参考图只过一次ViT, Q-Former的K/V也只算一次
+            ref_rows, ref_index = unique_refs(
+                [data_loader.dataset.pairid2ref[i] for i in idx.tolist()], device
+            )
+            ref_img_embs = model.ln_vision(model.visual_encoder(ref_img[ref_rows]))
             ref_img_atts = torch.ones(ref_img_embs.size()[:-1], dtype=torch.long).to(
                 device
             )
@@ -59,7 +64,7 @@ class TestFashionIQ:
             ).to(device)
 
             # Shift encoder
-            query_tokens = model.query_tokens.expand(ref_img_embs.shape[0], -1, -1)
+            query_tokens = model.query_tokens.expand(len(caption), -1, -1)
             query_atts = torch.ones(query_tokens.size()[:-1], dtype=torch.long).to(
                 device
             )
@@ -72,6 +77,7 @@ class TestFashionIQ:
                 encoder_hidden_states=ref_img_embs,
                 encoder_attention_mask=ref_img_atts,
                 return_dict=True,
+                encoder_index=ref_index,
             )
             query_feat = query_embs.last_hidden_state[:, : query_tokens.size(1), :]
             query_feat = F.normalize(model.text_proj(query_feat), dim=-1)
@@ -154,14 +160,9 @@ class TestFashionIQ:
             ref_img_ids = [data_loader.dataset.pairid2ref[idx] for idx in idxs]
             ref_img_ids = [data_loader.dataset.int2id[id] for id in ref_img_ids]
 
-            tar_img_feats = []
-            tar_img_ids = []
-            for target_id in data_loader.dataset.target_ids:
-                tar_img_ids.append(target_id)
-                target_emb_pth = data_loader.dataset.id2embpth[target_id]
-                target_feat = torch.load(target_emb_pth, weights_only=True).cpu()
-                tar_img_feats.append(target_feat.cpu())
-            tar_img_feats = torch.stack(tar_img_feats)
+            # gallery不依赖模型, 只在第一次测试时从磁盘读取
+            tar_img_ids = list(data_loader.dataset.target_ids)
+            tar_img_feats = gallery_embs(data_loader.dataset, tar_img_ids)
             
             tar_img_feats = tar_img_feats.to(query_feats.device)
 
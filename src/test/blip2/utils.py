@@ -229,3 +229,58 @@ def eval_recall(scores_q2t):
         "R_mean": round(tr_mean, 4),
     }
     return eval_result
+
+
+def unique_refs(ref_ids, device=None):
+    """
+    Rows of the first query of every unique reference in a batch, and the index
+    of the reference of each query among them (encoder_index of the Q-Former).
+    """
+    id2row = {}
+    rows = []
+    ref_index = []
+    for i, ref_id in enumerate(ref_ids):
+        if ref_id not in id2row:
+            id2row[ref_id] = len(rows)
+            rows.append(i)
+        ref_index.append(id2row[ref_id])
+    rows = torch.tensor(rows, dtype=torch.long, device=device)
+    ref_index = torch.tensor(ref_index, dtype=torch.long, device=device)
+    return rows, ref_index
+
+
+def speed_report(model, n_queries, encode_time):
+    """
+    Token merging setting, ViT output tokens and query encoding throughput of
+    this rank, saved with the recalls to compare the tome_r settings (see
+    tools/scripts/tome_curve.py).
+    """
+    tome_r = getattr(model.visual_encoder, "tome_r", [0])
+    tome_info = getattr(model.visual_encoder, "_tome_info", None)
+    if tome_info is not None and tome_info["tokens"] is not None:
+        vit_tokens = tome_info["tokens"]
+    else:
+        vit_tokens = model.visual_encoder.patch_embed.num_patches + 1
+    return {
+        "tome_r": tome_r[0] if len(set(tome_r)) == 1 else list(tome_r),
+        "vit_tokens": vit_tokens,
+        "encode_time": round(encode_time, 2),
+        "queries_per_s": round(n_queries / max(encode_time, 1e-6), 1),
+    }
+
+
+def gallery_embs(dataset, ids):
+    """
+    Stacked target embeddings of ids (loaded from dataset.id2embpth). They do
+    not depend on the model: the stack is kept on the dataset and reused by the
+    next evaluations when the test set is kept across epochs (TestHarness).
+    """
+    ids = list(ids)
+    cached = getattr(dataset, "_gallery", None)
+    if cached is not None and cached[0] == ids:
+        return cached[1]
+    embs = torch.stack(
+        [torch.load(dataset.id2embpth[i], weights_only=True).cpu() for i in ids]
+    ).float()
+    dataset._gallery = (ids, embs)
+    return embs
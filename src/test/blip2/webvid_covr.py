@@ -10,6 +10,7 @@ import torch.nn.functional as F
 from src.tools.files import json_dump
 from src.model.blip2.xpool_cross_att import Transformer as xpool_cross_att
 from src.model.blip2.xpool_cross_att import sim_matrix_training
+from src.test.blip2.utils import speed_report
 
 class TestWebVidCoVR:
     def __init__(self, remove_self_similarity: bool = True, dataset: str = "covr"):
@@ -44,11 +45,6 @@ class TestWebVidCoVR:
 
             device = ref_img.device
 
-            ref_img_embs = model.ln_vision(model.visual_encoder(ref_img))
-            ref_img_atts = torch.ones(ref_img_embs.size()[:-1], dtype=torch.long).to(
-                device
-            )
-
             text_tokens = model.tokenizer(
                 caption,
                 padding="longest",
@@ -57,22 +53,8 @@ class TestWebVidCoVR:
                 return_tensors="pt",
             ).to(device)
 
-            # Shift encoder
-            query_tokens = model.query_tokens.expand(ref_img_embs.shape[0], -1, -1)
-            query_atts = torch.ones(query_tokens.size()[:-1], dtype=torch.long).to(
-                device
-            )
-            attention_mask = torch.cat([query_atts, text_tokens.attention_mask], dim=1)
-            query_embs = model.Qformer.bert(
-                text_tokens.input_ids,
-                query_embeds=query_tokens,
-                attention_mask=attention_mask,
-                encoder_hidden_states=ref_img_embs,
-                encoder_attention_mask=ref_img_atts,
-                return_dict=True,
-            )
-            query_feat = query_embs.last_hidden_state[:, : query_tokens.size(1), :]
-            query_feat = F.normalize(model.text_proj(query_feat), dim=-1) # [bs , 32 ,256]
+            # Shift encoder, ref_img可以是多帧 (B, F, 3, H, W)
+            query_feat = model.encode_query(ref_img, text_tokens) # [bs , 32 ,256]
 
             # 改动5
             #-------------------------------------------------------------------------------------
@@ -135,6 +117,10 @@ class TestWebVidCoVR:
 
             # Encode the target image
             tar_img_feats.append(tar_feat.cpu())
+
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        speed = speed_report(model, len(pair_ids), time.time() - start_time)
         
         query_feats = torch.cat(query_feats, dim=0) #[2500 ,256] or  [2500 , 32 ,256] #我改了batch中操作以后应该是 [2500 , 256] 原来是 [2500 , 32 ,256]
         tar_img_feats = torch.cat(tar_img_feats, dim=0) #[2500 , 256]   #我想在batch中做好32变1 最后不用在外面做32变1
@@ -203,6 +189,7 @@ class TestWebVidCoVR:
 
             recalls = eval_recall(sim_q2t)
             recalls["annotation"] = Path(data_loader.dataset.annotation_pth).name
+            recalls["speed"] = speed
             fabric.print(recalls)
 
             # Save results
@@ -0,0 +1,177 @@
+"""
+Evaluation of the cfg.test sets in a separate process, while training goes on
+(train.py trainer.async_eval=true).
+
+At the end of every epoch, rank 0 copies the trainable parameters to CPU and
+hands them to the worker; the worker holds its own BLIP2Cir (frozen weights
+from the model config) and its own TestHarness on trainer.eval_device (e.g.
+cpu or cuda:1, a device not used by training), runs the evaluators and sends
+back the recalls. It also takes the best-checkpoint decisions
+(trainer.save_ckpt=best) and writes the best checkpoint itself: a
+trainable-only checkpoint, loaded by test.py with model.ckpt.path=<path> like
+the ones saved by training.
+"""
+
+import queue
+from pathlib import Path
+
+import lightning as L
+import torch
+import torch.multiprocessing as mp
+from hydra.utils import instantiate
+from omegaconf import OmegaConf
+
+from src.data.embs_pipeline import atomic_save
+from src.tools.checkpoint import to_cpu, trainable_state_dict, unwrap
+from src.tools.test_harness import TestHarness
+
+BEST_CKPT = "m2_web_16_normal_att_best.ckpt"
+
+
+def eval_fabric(device: str, precision: str):
+    device = torch.device(device)
+    if device.type == "cpu":
+        return L.Fabric(accelerator="cpu", devices=1, precision="32-true")
+    return L.Fabric(
+        accelerator="cuda", devices=[device.index or 0], precision=precision
+    )
+
+
+def numeric(recalls: dict):
+    return {k: v for k, v in recalls.items() if isinstance(v, (int, float))}
+
+
+def eval_worker(cfg, device: str, best_R1: float, jobs, results):
+    """Evaluation process: one job (epoch, trainable parameters) at a time."""
+    fabric = eval_fabric(device, cfg.trainer.precision)
+    model = instantiate(cfg.model)
+    model = fabric.setup(model)
+    harness = TestHarness(
+        cfg, fabric, persistent=cfg.trainer.test_harness, cache=cfg.trainer.test_cache
+    )
+    parent = mp.parent_process()
+
+    while True:
+        try:
+            job = jobs.get(timeout=30)
+        except queue.Empty:
+            if parent is not None and not parent.is_alive():
+                break
+            continue
+        if job is None:
+            break
+
+        epoch = job["epoch"]
+        unwrap(model).load_state_dict(job["model"], strict=False)
+        recalls = harness.run_all(model, f"epoch{epoch}")
+
+        is_best = False
+        if cfg.trainer.save_ckpt == "best":
+            for dataset_recalls in recalls.values():
+                cur_R1 = dataset_recalls.get("R1")
+                if cur_R1 is not None and cur_R1 > best_R1:
+                    best_R1 = cur_R1
+                    is_best = True
+            if is_best:
+                state = {
+                    "base_ckpt": cfg.model.ckpt.path,
+                    "model": job["model"],
+                    "epoch": epoch + 1,
+                    "best_R1": best_R1,
+                }
+                atomic_save(state, Path(BEST_CKPT))
+                fabric.print(f"Epoch {epoch + 1}: best R1 {best_R1}, saved {BEST_CKPT}")
+
+        results.put(
+            {
+                "epoch": epoch,
+                "recalls": {k: numeric(v) for k, v in recalls.items()},
+                "is_best": is_best,
+                "best_R1": best_R1,
+            }
+        )
+
+
+class AsyncEvaluator:
+    """
+    Rank 0 side of the evaluation process. submit() only copies the trainable
+    parameters to CPU (shared memory) and returns; poll() gives the results
+    received so far, close() waits for the pending jobs.
+    """
+
+    def __init__(self, cfg, device: str, best_R1: float = 0):
+        ctx = mp.get_context("spawn")
+        self.jobs = ctx.Queue()
+        self.results = ctx.Queue()
+        self.n_pending = 0
+        # the ${hydra:...} resolvers (paths) only work in this process
+        cfg = OmegaConf.create(OmegaConf.to_container(cfg, resolve=True))
+        # not a daemon: the evaluator DataLoaders start their own workers
+        self.process = ctx.Process(
+            target=eval_worker,
+            args=(cfg, device, best_R1, self.jobs, self.results),
+        )
+        self.process.start()
+
+    def submit(self, model, epoch: int):
+        self.jobs.put({"epoch": epoch, "model": to_cpu(trainable_state_dict(model))})
+        self.n_pending += 1
+
+    def poll(self, block: bool = False):
+        received = []
+        while self.n_pending > 0:
+            try:
+                result = self.results.get(block=block, timeout=60 if block else None)
+            except queue.Empty:
+                if block and self.process.is_alive():
+                    continue
+                break
+            received.append(result)
+            self.n_pending -= 1
+        assert self.n_pending == 0 or self.process.is_alive(), (
+            f"Evaluation process exited (code {self.process.exitcode}) "
+            f"with {self.n_pending} epochs not evaluated"
+        )
+        return received
+
+    def close(self):
+        """Wait for the pending results, then stop the worker."""
+        received = self.poll(block=True)
+        self.jobs.put(None)
+        self.process.join()
+        return received
+
+
+if __name__ == "__main__":
+    # smoke check: the worker gets a config whose resolver only exists in this
+    # process (like ${hydra:...}), survives its first job and sends it back
+    import torch.nn as nn
+
+    OmegaConf.register_new_resolver("parent_only", lambda: 8)
+    cfg = OmegaConf.create(
+        {
+            "model": {
+                "_target_": "torch.nn.Linear",
+                "in_features": "${parent_only:}",
+                "out_features": 2,
+            },
+            "test": {},
+            "profiler": {"enabled": False},
+            "trainer": {
+                "precision": "32-true",
+                "test_harness": True,
+                "test_cache": False,
+                "save_ckpt": "best",
+            },
+        }
+    )
+    evaluator = AsyncEvaluator(cfg, "cpu")
+    model = nn.Linear(8, 2)
+    for epoch in range(2):
+        evaluator.submit(model, epoch)
+        results = evaluator.poll(block=True)
+        assert [r["epoch"] for r in results] == [epoch], results
+        assert evaluator.process.is_alive()
+    assert evaluator.close() == []
+    assert evaluator.process.exitcode == 0
+    print("AsyncEvaluator: worker survived its jobs")
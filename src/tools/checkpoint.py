@@ -0,0 +1,126 @@
+"""
+Trainable-only training checkpoints, written in the background.
+
+The frozen EVA ViT-g and the frozen parts of the Q-Former are not saved: a
+checkpoint holds the parameters with requires_grad, the optimizer state, the
+mixed-precision state (grad scaler of 16-mixed) and base_ckpt, the checkpoint they were initialized from (Blip2Base
+load_from_pretrained loads base_ckpt first). It also records the epoch, the
+number of batches done in it and the RNG states, for an exact mid-epoch
+resume with train.py trainer.resume_from=<path>.
+"""
+
+import random
+import threading
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from src.data.embs_pipeline import atomic_save
+
+CKPT_FORMAT = "trainable-v1"
+
+
+def unwrap(model: nn.Module) -> nn.Module:
+    """The BLIP2Cir module inside the Fabric/DDP wrappers."""
+    while isinstance(getattr(model, "module", None), nn.Module):
+        model = model.module
+    return model
+
+
+def to_cpu(obj):
+    """Copy of the tensors of a (nested) state on CPU."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def get_rng_state():
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def trainable_state_dict(model: nn.Module):
+    params = unwrap(model).named_parameters()
+    return {name: param for name, param in params if param.requires_grad}
+
+
+class AsyncCheckpointer:
+    """
+    Save trainable-only checkpoints on rank 0. The state is copied to CPU in
+    save(), then torch.save runs in a background thread while training goes on.
+    A new save waits for the previous write.
+    """
+
+    def __init__(self, fabric, base_ckpt: str):
+        self.fabric = fabric
+        self.base_ckpt = base_ckpt
+        self.thread = None
+
+    def save(self, path, model, optimizer, epoch: int, step: int, **extra):
+        """
+        epoch and step: the next batch to train is batch step of epoch. extra
+        holds the other training state (epoch_rng, best_R1, ...).
+        """
+        if self.fabric.global_rank != 0:
+            return
+        state = {
+            "format": CKPT_FORMAT,
+            "base_ckpt": self.base_ckpt,
+            "model": to_cpu(trainable_state_dict(model)),
+            "optimizer": to_cpu(optimizer.state_dict()),
+            "precision": to_cpu(self.fabric.strategy.precision.state_dict()),
+            "epoch": epoch,
+            "step": step,
+            "rng": get_rng_state(),
+            **to_cpu(extra),
+        }
+        self.wait()
+        self.thread = threading.Thread(target=atomic_save, args=(state, Path(path)))
+        self.thread.start()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+def load_resume(path, model, optimizer, fabric):
+    """
+    Load the trainable parameters, the optimizer state and the mixed-precision
+    state (loss scale) of a checkpoint saved by AsyncCheckpointer (the frozen
+    weights come from the model config), and return the checkpoint for the rest
+    of the training state.
+    """
+    ckpt = torch.load(path, map_location="cpu", weights_only=False)
+    assert ckpt.get("format") == CKPT_FORMAT, f"{path} is not a resumable checkpoint"
+
+    trainable = set(trainable_state_dict(model).keys())
+    assert trainable == set(ckpt["model"].keys()), (
+        f"Trainable parameters differ from {path}: "
+        f"{sorted(trainable ^ set(ckpt['model'].keys()))[:10]}"
+    )
+    unwrap(model).load_state_dict(ckpt["model"], strict=False)
+    optimizer.load_state_dict(ckpt["optimizer"])
+    if ckpt.get("precision"):
+        fabric.strategy.precision.load_state_dict(ckpt["precision"])
+    return ckpt
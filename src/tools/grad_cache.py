@@ -0,0 +1,167 @@
+"""
+Gradient cache (Gao et al. 2021): exact contrastive training of a large
+logical batch with the activation memory of a micro-batch.
+
+1. the query features of every micro-batch are computed without graph (the
+   RNG state of each micro-batch is recorded);
+2. the loss of the whole batch is computed from the cached features, and
+   backpropagated to the features and to the loss head (xpool);
+3. every micro-batch is run again with graph, same RNG state, and the cached
+   feature gradients are backpropagated through the Q-Former.
+
+The gradients are the ones of the monolithic batch. Under DDP, every backward
+runs without gradient sync and the gradients are averaged once at the end, as
+DDP would do.
+"""
+
+import torch
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+
+def split_batch(batch: dict, micro_batch_size: int):
+    """Micro-batches of micro_batch_size rows of a collated batch."""
+    batch_size = len(batch["tar_img_feat"])
+    micro_batches = []
+    for start in range(0, batch_size, micro_batch_size):
+        end = start + micro_batch_size
+        micro_batch = {}
+        for key, value in batch.items():
+            per_row = isinstance(value, (torch.Tensor, list, tuple))
+            if per_row and len(value) == batch_size:
+                micro_batch[key] = value[start:end]
+            else:
+                micro_batch[key] = value
+        micro_batches.append(micro_batch)
+    return micro_batches
+
+
+def get_rng_state(device):
+    cuda_state = torch.cuda.get_rng_state(device) if device.type == "cuda" else None
+    return torch.get_rng_state(), cuda_state
+
+
+def set_rng_state(state, device):
+    torch.set_rng_state(state[0])
+    if state[1] is not None:
+        torch.cuda.set_rng_state(state[1], device)
+
+
+def average_gradients(model, fabric):
+    """Average the gradients over the ranks in one collective (DDP gradient sync)."""
+    if fabric.world_size == 1:
+        return
+    params = [p for p in model.parameters() if p.requires_grad]
+    for p in params:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+    grads = [p.grad for p in params]
+    flat = fabric.all_reduce(_flatten_dense_tensors(grads), reduce_op="mean")
+    for grad, reduced in zip(grads, _unflatten_dense_tensors(flat, grads)):
+        grad.copy_(reduced)
+
+
+def grad_cache_step(model, batch, fabric, micro_batch_size: int):
+    """
+    Forward and backward of the batch in micro-batches of micro_batch_size,
+    returns the (detached) loss. optimizer.zero_grad/step stay in the loop.
+    """
+    micro_batches = split_batch(batch, micro_batch_size)
+    device = batch["tar_img_feat"].device
+    rng_devices = [device] if device.type == "cuda" else []
+
+    with fabric.no_backward_sync(model, enabled=fabric.world_size > 1):
+        # 1. query features of all the micro-batches, without graph
+        rng_states = []
+        query_feats = []
+        with torch.no_grad():
+            for micro_batch in micro_batches:
+                rng_states.append(get_rng_state(device))
+                query_feats.append(model(micro_batch, fabric, return_query=True))
+
+        # 2. loss of the whole batch, backward to the cached features and the loss head
+        query_si_feat = torch.cat(query_feats).detach().requires_grad_()
+        loss = model(batch, fabric, query_si_feat=query_si_feat)
+        fabric.backward(loss)
+        feat_grads = query_si_feat.grad.split([len(x) for x in query_feats])
+
+        # 3. recompute each micro-batch (same dropout) and backward the cached gradients
+        for micro_batch, rng_state, feat_grad in zip(
+            micro_batches, rng_states, feat_grads
+        ):
+            with torch.random.fork_rng(devices=rng_devices):
+                set_rng_state(rng_state, device)
+                feats = model(micro_batch, fabric, return_query=True)
+            # feat_grad already holds the loss scale of mixed precision, so it does
+            # not go through fabric.backward again
+            torch.autograd.backward(feats, feat_grad.to(feats.dtype))
+
+    average_gradients(model, fabric)
+    return loss.detach()
+
+
+if __name__ == "__main__":
+    # the gradients of grad_cache_step match the ones of the whole batch in one graph
+    import lightning as L
+    import torch.nn as nn
+    import torch.nn.functional as F
+
+    class TinyCir(nn.Module):
+        """Query encoder with dropout and a contrastive loss, BLIP2Cir.forward API."""
+
+        def __init__(self, dropout):
+            super().__init__()
+            self.encoder = nn.Sequential(
+                nn.Linear(8, 16), nn.GELU(), nn.Dropout(dropout), nn.Linear(16, 4)
+            )
+            self.temp = nn.Parameter(torch.tensor(0.1))
+
+        def forward(self, batch, fabric, query_si_feat=None, return_query=False):
+            if return_query or query_si_feat is None:
+                query_feat = F.normalize(self.encoder(batch["ref_img"]), dim=-1)
+                if return_query:
+                    return query_feat
+                query_si_feat = query_feat
+            tar_feat = F.normalize(batch["tar_img_feat"], dim=-1)
+            logits = query_si_feat @ tar_feat.T / self.temp
+            labels = torch.arange(len(logits))
+            return F.cross_entropy(logits, labels) + F.cross_entropy(logits.T, labels)
+
+    def grads(model):
+        return [p.grad.clone() for p in model.parameters()]
+
+    fabric = L.Fabric(accelerator="cpu", devices=1)
+    batch_size, micro_batch_size = 10, 4  # last micro-batch of 2 rows
+    batch = {
+        "ref_img": torch.randn(batch_size, 8),
+        "tar_img_feat": torch.randn(batch_size, 4),
+        "edit": [f"edit {i}" for i in range(batch_size)],
+    }
+
+    for dropout in [0.0, 0.3]:
+        torch.manual_seed(0)
+        model = fabric.setup(TinyCir(dropout))
+        model.train()
+
+        # reference: one graph over the whole batch. With dropout, the query
+        # features are computed micro-batch after micro-batch from the same seed,
+        # which draws the dropout masks grad_cache_step records and replays
+        torch.manual_seed(1)
+        if dropout == 0:
+            loss_ref = model(batch, fabric)
+        else:
+            feats = [
+                model(micro_batch, fabric, return_query=True)
+                for micro_batch in split_batch(batch, micro_batch_size)
+            ]
+            loss_ref = model(batch, fabric, query_si_feat=torch.cat(feats))
+        fabric.backward(loss_ref)
+        grads_ref = grads(model)
+
+        model.zero_grad()
+        torch.manual_seed(1)
+        loss = grad_cache_step(model, batch, fabric, micro_batch_size)
+        assert torch.allclose(loss, loss_ref.detach(), atol=1e-6), (loss, loss_ref)
+        for grad, grad_ref in zip(grads(model), grads_ref):
+            max_diff = (grad - grad_ref).abs().max()
+            assert torch.allclose(grad, grad_ref, atol=1e-6), max_diff
+    print("grad_cache_step ok")
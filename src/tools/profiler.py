@@ -0,0 +1,105 @@
+"""
+torch.profiler capture windows, configured by the profiler config group
+(configs/profiler, e.g. python train.py profiler=default).
+
+Every window of the schedule exports, in the run (Hydra output) directory,
+    <dir>/<name>_rank<r>_step<n>.json    Chrome trace (chrome://tracing, Perfetto)
+    <dir>/<name>_rank<r>_step<n>.txt     per-op summary table
+With profiler=none (the default) no profiler is created: the train loop calls
+a no-op step() and the evaluator loaders are not wrapped.
+"""
+
+from pathlib import Path
+
+import torch
+
+
+class NullProfiler:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def step(self):
+        pass
+
+
+def export_window(prof, out_dir: Path, name: str, row_limit: int, group_shapes: bool):
+    out_dir.mkdir(parents=True, exist_ok=True)
+    stem = f"{name}_step{prof.step_num}"
+    prof.export_chrome_trace(str(out_dir / f"{stem}.json"))
+
+    sort_by = "self_cpu_time_total"
+    if torch.cuda.is_available():
+        sort_by = "self_cuda_time_total"
+    table = prof.key_averages(group_by_input_shape=group_shapes).table(
+        sort_by=sort_by, row_limit=row_limit
+    )
+    with open(out_dir / f"{stem}.txt", "w") as f:
+        f.write(table)
+    print(f"Profile of {name} saved in {out_dir / stem}.json/.txt")
+
+
+def build_profiler(cfg, name: str, stage: str, epoch: int = None):
+    """
+    torch.profiler.profile for the steps of stage ("train" or "test"), or a
+    NullProfiler when profiling is disabled for it. Used as a context manager,
+    with step() called after every step.
+    """
+    if cfg is None or not cfg.enabled or not cfg[stage]:
+        return NullProfiler()
+    if epoch is not None and epoch != cfg.epoch:
+        return NullProfiler()
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    rank = torch.distributed.get_rank() if torch.distributed.is_initialized() else 0
+    name = f"{name}_rank{rank}"
+
+    return torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(
+            skip_first=cfg.skip_first,
+            wait=cfg.wait,
+            warmup=cfg.warmup,
+            active=cfg.active,
+            repeat=cfg.repeat,
+        ),
+        on_trace_ready=lambda prof: export_window(
+            prof, Path(cfg.dir), name, cfg.row_limit, cfg.record_shapes
+        ),
+        record_shapes=cfg.record_shapes,
+        profile_memory=cfg.profile_memory,
+        with_stack=cfg.with_stack,
+    )
+
+
+class ProfiledLoader:
+    """Iterate over loader with one profiler step per batch (evaluator loops)."""
+
+    def __init__(self, loader, profiler):
+        self.loader = loader
+        self.profiler = profiler
+
+    def __iter__(self):
+        with self.profiler:
+            for batch in self.loader:
+                yield batch
+                self.profiler.step()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+
+def profile_loader(loader, cfg, name: str):
+    """loader itself when test profiling is disabled, else a ProfiledLoader."""
+    profiler = build_profiler(cfg, name, "test")
+    if isinstance(profiler, NullProfiler):
+        return loader
+    return ProfiledLoader(loader, profiler)
@@ -0,0 +1,180 @@
+"""
+Training telemetry without a device sync per step.
+
+The loss and the phase timings are accumulated and only read (one sync) at
+each flush, then logged through the Fabric loggers:
+    loss, lr                           averages since the last flush
+    time/data_wait                     CPU time spent waiting for the loader
+    time/<phase>                       device time of each phase (CUDA events)
+    throughput/samples_per_s           samples / wall time since the last flush
+    data/ready_batches                 batches loaded and not consumed yet
+    data/outstanding_w<i>              batches requested from worker i
+    data/skipped_batches               None batches (all items invalid)
+so that a run can be told I/O-bound (data_wait high, ready_batches 0) or
+compute-bound (data_wait ~0, ready_batches at the prefetch limit).
+
+The data/ queue metrics read private DataLoader internals (_get_iterator, and
+_task_info, _rcvd_idx, _data_queue of the multi-process iterator) as of the
+pinned torch 2.4. If a torch upgrade changes them, watch() leaves the loader
+as is and the queue metrics are dropped; the other metrics are unaffected.
+"""
+
+import time
+from collections import defaultdict
+
+import torch
+
+
+class Timer:
+    """Mark the end of phases with CUDA events (or CPU time), read them lazily."""
+
+    def __init__(self, device):
+        self.cuda = device.type == "cuda"
+        self.marks = []
+
+    def now(self):
+        if self.cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def mark(self, name):
+        self.marks.append((name, self.now()))
+
+    def read(self):
+        """Seconds of every phase (time from the previous mark) since the last read."""
+        times = defaultdict(float)
+        if len(self.marks) == 0:
+            return times
+        if self.cuda:
+            self.marks[-1][1].synchronize()
+        for (_, start), (name, end) in zip(self.marks, self.marks[1:]):
+            if name is None:
+                continue
+            if self.cuda:
+                times[name] += start.elapsed_time(end) / 1000
+            else:
+                times[name] += end - start
+        self.marks = []
+        return times
+
+
+class TrainTelemetry:
+    """
+    Accumulates the training steps on device; train.py flushes it every
+    log_interval steps (and when printing), the only points where it syncs.
+    """
+
+    def __init__(self, fabric):
+        self.fabric = fabric
+        self.timer = Timer(fabric.device)
+        self.global_step = 0
+        self.loader_iter = None
+        self.reset()
+
+    def reset(self):
+        self.loss_sum = torch.zeros((), device=self.fabric.device)
+        self.lr_sum = 0.0
+        self.n_steps = 0
+        self.n_samples = 0
+        self.n_skipped = 0
+        self.data_wait = 0.0
+        self.flush_time = time.perf_counter()
+
+    def watch(self, loader):
+        """Keep a reference to the DataLoader iterator, for the queue depths."""
+        dataloader = getattr(loader, "_dataloader", loader)
+        try:
+            get_iterator = dataloader._get_iterator
+        except AttributeError:
+            return loader
+
+        def _get_iterator():
+            self.loader_iter = get_iterator()
+            return self.loader_iter
+
+        dataloader._get_iterator = _get_iterator
+        return loader
+
+    def wait_start(self):
+        """Before fetching the next batch."""
+        self.wait_time = time.perf_counter()
+
+    def step_start(self, batch):
+        """Batch received: end of the data wait, start of the device phases."""
+        self.data_wait += time.perf_counter() - self.wait_time
+        if batch is None:
+            self.n_skipped += 1
+            return
+        self.n_samples += len(batch["tar_img_feat"]) * self.fabric.world_size
+        self.timer.mark(None)
+
+    def mark(self, name):
+        """End of a phase (forward, backward, optimizer, ...) of the step."""
+        self.timer.mark(name)
+
+    def step_end(self, loss, lr):
+        """Accumulate the loss (on device) and the lr of the step."""
+        self.loss_sum += loss.detach().float()
+        self.lr_sum += lr
+        self.n_steps += 1
+        self.global_step += 1
+
+    def queue_depths(self):
+        """Ready batches and batches requested per worker of the loader."""
+        it = self.loader_iter
+        if it is None or not hasattr(it, "_task_info"):
+            return {}
+        outstanding = defaultdict(int)
+        ready = 0
+        try:
+            for idx, info in list(it._task_info.items()):
+                if idx < it._rcvd_idx:
+                    continue
+                outstanding[info[0]] += 1
+                ready += len(info) == 2
+            try:
+                ready += it._data_queue.qsize()
+            except NotImplementedError:
+                pass
+            num_workers = it._num_workers
+        except (AttributeError, TypeError, IndexError):
+            # DataLoader internals changed (torch upgrade): no queue metrics
+            return {}
+        depths = {"data/ready_batches": ready}
+        for worker_id in range(num_workers):
+            depths[f"data/outstanding_w{worker_id}"] = outstanding[worker_id]
+        return depths
+
+    def flush(self, **extra):
+        """Read the accumulated values (one device sync) and log them."""
+        n_steps = max(self.n_steps, 1)
+        elapsed = time.perf_counter() - self.flush_time
+        metrics = {
+            "loss": (self.loss_sum / n_steps).item(),
+            "lr": self.lr_sum / n_steps,
+            "time/data_wait": self.data_wait / n_steps,
+            "throughput/samples_per_s": self.n_samples / max(elapsed, 1e-9),
+            "data/skipped_batches": self.n_skipped,
+        }
+        for name, seconds in self.timer.read().items():
+            metrics[f"time/{name}"] = seconds / n_steps
+        metrics.update(self.queue_depths())
+        metrics.update(extra)
+        self.fabric.log_dict(metrics, step=self.global_step)
+        self.reset()
+        return metrics
+
+    @staticmethod
+    def summary(metrics):
+        times = [
+            f"{name[5:]} {seconds * 1000:.0f}ms"
+            for name, seconds in metrics.items()
+            if name.startswith("time/")
+        ]
+        return (
+            f"Loss: {metrics['loss']:.6f}\t"
+            f"{metrics['throughput/samples_per_s']:.1f} samples/s\t"
+            + ", ".join(times)
+        )
@@ -0,0 +1,125 @@
+"""
+Test sets kept from one evaluation to the next (trainer.test_harness=true).
+
+The datamodules, their Fabric loaders (with persistent workers) and the
+evaluators of cfg.test are built once, before training; every epoch only runs
+the evaluators, i.e. the model forward and the scoring. The model-independent
+gallery embeddings are kept on the datasets by the evaluators (gallery_embs),
+and with trainer.test_cache=true the test batches themselves are kept in CPU
+memory after the first evaluation, so later evaluations do not load anything.
+"""
+
+import shutil
+
+from hydra.utils import instantiate
+from torch.utils.data import DataLoader
+
+from src.tools.profiler import profile_loader
+
+
+def persistent_loader(loader: DataLoader) -> DataLoader:
+    """Same DataLoader, with workers kept alive between the iterations."""
+    if loader.num_workers == 0 or loader.persistent_workers:
+        return loader
+    if loader.batch_size is None and loader.batch_sampler is not None:
+        # custom batch sampler: batch_size, sampler and drop_last are unset
+        batching = dict(batch_sampler=loader.batch_sampler)
+    else:
+        batching = dict(
+            batch_size=loader.batch_size,
+            sampler=loader.sampler,
+            drop_last=loader.drop_last,
+        )
+    return DataLoader(
+        dataset=loader.dataset,
+        **batching,
+        num_workers=loader.num_workers,
+        collate_fn=loader.collate_fn,
+        pin_memory=loader.pin_memory,
+        timeout=loader.timeout,
+        worker_init_fn=loader.worker_init_fn,
+        multiprocessing_context=loader.multiprocessing_context,
+        generator=loader.generator,
+        prefetch_factor=loader.prefetch_factor,
+        persistent_workers=True,
+        pin_memory_device=loader.pin_memory_device,
+    )
+
+
+class CachedLoader:
+    """
+    Iterate over a Fabric loader once, keeping its batches on CPU, then replay
+    them (moved to the device) at every iteration.
+    """
+
+    def __init__(self, loader, fabric):
+        self.loader = loader
+        self.fabric = fabric
+        self.batches = None
+
+    def __iter__(self):
+        if self.batches is None:
+            batches = []
+            # batches of the DataLoader inside the Fabric loader, still on CPU
+            for batch in self.loader._dataloader:
+                batches.append(batch)
+                yield self.fabric.to_device(batch)
+            self.batches = batches
+            return
+        for batch in self.batches:
+            yield self.fabric.to_device(batch)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+
+class TestHarness:
+    """
+    The test sets of cfg.test for fabric. With persistent=False every run
+    builds the test set again (the evaluation before the harness).
+    """
+
+    def __init__(self, cfg, fabric, persistent: bool = True, cache: bool = False):
+        self.cfg = cfg
+        self.fabric = fabric
+        self.persistent = persistent
+        self.cache = cache
+        self.test_sets = {}
+        if persistent:
+            for dataset in cfg.test:
+                self.test_sets[dataset] = self.build(dataset)
+
+    def build(self, dataset: str):
+        data = instantiate(self.cfg.test[dataset])
+        loader = data.test_dataloader()
+        if self.persistent:
+            loader = persistent_loader(loader)
+        loader = self.fabric.setup_dataloaders(loader)
+        if self.cache:
+            loader = CachedLoader(loader, self.fabric)
+        test = instantiate(self.cfg.test[dataset].test)
+        return data, loader, test
+
+    def run(self, model, dataset: str, name: str):
+        """Recalls of model on the test set dataset of cfg.test."""
+        columns = shutil.get_terminal_size().columns
+        self.fabric.print("-" * columns)
+        self.fabric.print(
+            f"Testing on {self.cfg.test[dataset].dataname}".center(columns)
+        )
+
+        if self.persistent:
+            _, loader, test = self.test_sets[dataset]
+        else:
+            _, loader, test = self.build(dataset)
+        loader = profile_loader(loader, self.cfg.profiler, f"test_{dataset}_{name}")
+        return test(model, loader, fabric=self.fabric)
+
+    def run_all(self, model, name: str):
+        """Recalls of every test set, keyed by test set."""
+        return {
+            dataset: self.run(model, dataset, name) or {} for dataset in self.cfg.test
+        }
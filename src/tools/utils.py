@@ -1,4 +1,5 @@
 import torch
+import torch.distributed as dist
 from einops import rearrange
 from lightning_utilities.core.rank_zero import rank_zero_only
 
@@ -50,3 +51,106 @@ def all_gather_with_grad(tensors, fabric):
         tensors = fabric.all_gather(tensors, sync_grads=True)
         tensors = rearrange(tensors, "batch num_gpu ... -> (batch num_gpu) ...")
     return tensors
+
+
+wire_dtypes = {None: None, "fp32": None, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def _flatten_rows(tensors, dtype=None):
+    """(B, ...) tensors -> one contiguous (B, sum of row sizes) buffer."""
+    if dtype is None:
+        dtype = tensors[0].dtype
+        for t in tensors[1:]:
+            dtype = torch.promote_types(dtype, t.dtype)
+    return torch.cat([t.reshape(len(t), -1).to(dtype) for t in tensors], dim=1)
+
+
+def _unflatten_rows(buffer, tensors, n_rows):
+    """Inverse of _flatten_rows, with n_rows rows and the dtypes of tensors."""
+    sizes = [t[0].numel() for t in tensors]
+    return [
+        chunk.reshape(n_rows, *t.shape[1:]).to(t.dtype)
+        for chunk, t in zip(buffer.split(sizes, dim=1), tensors)
+    ]
+
+
+def _all_gather_rows(buffer, async_op=False):
+    """(B, C) buffer of every rank -> (world_size * B, C), rank-major."""
+    world_size = dist.get_world_size()
+    out = buffer.new_empty((world_size * len(buffer), buffer.shape[1]))
+    if dist.get_backend() == "nccl":
+        work = dist.all_gather_into_tensor(out, buffer, async_op=async_op)
+    else:
+        work = dist.all_gather(list(out.chunk(world_size)), buffer, async_op=async_op)
+    return out, work
+
+
+class _BucketedAllGather(torch.autograd.Function):
+    """
+    All-gather of several tensors in one collective, sent as wire_dtype. The
+    backward sums the gradients of every rank in fp32 and keeps the local rows
+    (reduce-scatter), as all_gather_with_grad.
+    """
+
+    @staticmethod
+    def forward(ctx, wire_dtype, *tensors):
+        ctx.tensors_meta = [(t.shape, t.dtype) for t in tensors]
+        buffer = _flatten_rows(tensors, wire_dtype)
+        out, _ = _all_gather_rows(buffer)
+        return tuple(_unflatten_rows(out, tensors, len(out)))
+
+    @staticmethod
+    def backward(ctx, *grads):
+        metas = ctx.tensors_meta
+        grads = [
+            torch.zeros((len(grads[0]), *shape[1:]), device=grads[0].device)
+            if grad is None
+            else grad
+            for grad, (shape, _) in zip(grads, metas)
+        ]
+        buffer = _flatten_rows(grads, torch.float32)
+        n_rows = metas[0][0][0]
+        if dist.get_backend() == "nccl":
+            local = buffer.new_empty((n_rows, buffer.shape[1]))
+            dist.reduce_scatter_tensor(local, buffer)
+        else:
+            dist.all_reduce(buffer)
+            local = buffer[dist.get_rank() * n_rows : (dist.get_rank() + 1) * n_rows]
+        sizes = [torch.Size(shape[1:]).numel() for shape, _ in metas]
+        local_grads = [
+            chunk.reshape(shape).to(dtype)
+            for chunk, (shape, dtype) in zip(local.split(sizes, dim=1), metas)
+        ]
+        return (None, *local_grads)
+
+
+def all_gather_features(tensors, fabric, wire_dtype=None):
+    """
+    Differentiable all-gather of a list of (B, ...) tensors in a single
+    collective, e.g. features already reduced to (B, D). With wire_dtype
+    (fp16/bf16) the features are sent in half precision and the gradients
+    reduced in fp32. Same rank-major order as all_gather_with_grad.
+    """
+    if fabric.world_size == 1:
+        return list(tensors)
+    return list(_BucketedAllGather.apply(wire_dtypes[wire_dtype], *tensors))
+
+
+def all_gather_async(tensors, fabric, wire_dtype=None):
+    """
+    Start the all-gather of a list of (B, ...) tensors without gradient (e.g.
+    the precomputed targets) in one collective, and return a function waiting
+    for it and returning the gathered tensors. The collective runs while the
+    model computes the query features.
+    """
+    if fabric.world_size == 1:
+        return lambda: list(tensors)
+    tensors = [t.detach() for t in tensors]
+    buffer = _flatten_rows(tensors, wire_dtypes[wire_dtype])
+    out, work = _all_gather_rows(buffer, async_op=True)
+
+    def wait():
+        work.wait()
+        return _unflatten_rows(out, tensors, len(out))
+
+    return wait
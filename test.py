@@ -5,6 +5,7 @@ from hydra.utils import instantiate
 from omegaconf import DictConfig, OmegaConf
 
 from src.tools.files import json_dump
+from src.tools.profiler import profile_loader
 
 
 @hydra.main(version_base=None, config_path="configs", config_name="test")
@@ -25,6 +26,7 @@ def main(cfg: DictConfig):
 
         data = instantiate(cfg.test[dataset])
         test_loader = fabric.setup_dataloaders(data.test_dataloader())
+        test_loader = profile_loader(test_loader, cfg.profiler, f"test_{dataset}")
 
         test = instantiate(cfg.test[dataset].test)
         test(model, test_loader, fabric=fabric)
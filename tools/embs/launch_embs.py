@@ -0,0 +1,263 @@
+# Run save_blip2_embs_{vids,imgs}.py with several local worker processes.
+#
+# Instead of static shards, the pending videos/images are ordered longest-first
+# (frame count from the container, or file size) and handed out in small chunks
+# from a shared queue, so every worker stays busy until the end. Each worker
+# loads the model once, can be pinned to a device and a CPU set, and writes to
+# the same save_dir with its own journal. Works on a CPU-only machine with
+# --devices cpu.
+#
+# python tools/embs/launch_embs.py vids --procs 4 --devices cuda:0,cuda:1 \
+#     -- --video_dir datasets/WebVid/8M/train --batch_size 8
+
+import argparse
+import importlib.util
+import multiprocessing as mp
+import os
+import queue
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from torch.utils.data import Sampler
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(script_dir, "..", ".."))
+sys.path.append(project_root)
+
+SCRIPTS = {
+    "vids": "save_blip2_embs_vids.py",
+    "imgs": "save_blip2_embs_imgs.py",
+}
+
+
+def load_script(name):
+    spec = importlib.util.spec_from_file_location(
+        f"embs_{name}", os.path.join(script_dir, SCRIPTS[name])
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class QueueSampler(Sampler):
+    """Yield the dataset indices of the chunks of ids read from a shared queue."""
+
+    def __init__(self, dataset, work_queue):
+        self.id2idx = {video_id: i for i, video_id in enumerate(dataset.video_ids)}
+        self.work_queue = work_queue
+
+    def __iter__(self):
+        while True:
+            chunk = self.work_queue.get()
+            if chunk is None:
+                return
+            for video_id in chunk:
+                if video_id in self.id2idx:
+                    yield self.id2idx[video_id]
+                else:
+                    print(f"{video_id} not found, skipping")
+
+
+def parse_cpus(cpus: str):
+    """'0-3,8' -> {0, 1, 2, 3, 8}"""
+    cpu_set = set()
+    for part in cpus.split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            cpu_set.update(range(int(start), int(end) + 1))
+        else:
+            cpu_set.add(int(part))
+    return cpu_set
+
+
+def worker(worker_id, name, script_argv, device, cpus, work_queue, progress_queue):
+    # must be set before CUDA is initialized in this process
+    if device == "cpu":
+        os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    elif device.startswith("cuda:"):
+        os.environ["CUDA_VISIBLE_DEVICES"] = device.split(":")[1]
+    if cpus is not None:
+        os.sched_setaffinity(0, parse_cpus(cpus))
+
+    script = load_script(name)
+    args = script.get_parser().parse_args(script_argv)
+    args.journal_name = f"worker{worker_id}"
+    if name == "imgs":
+        args.save_dir.mkdir(exist_ok=True)
+
+    script.main(
+        args,
+        make_sampler=lambda dataset: QueueSampler(dataset, work_queue),
+        progress=lambda n: progress_queue.put(n),
+    )
+
+
+def get_todo(name, args):
+    from src.data.embs import ImageDataset, VideoDataset
+
+    if name == "vids":
+        save_dir = load_script(name).get_save_dir(args)
+        save_dir.mkdir(exist_ok=True)
+        dataset = VideoDataset(
+            video_dir=args.video_dir, todo_ids=args.todo_ids, save_dir=save_dir
+        )
+        return {video_id: dataset.id2path[video_id] for video_id in dataset.video_ids}
+
+    args.save_dir.mkdir(exist_ok=True)
+    dataset = ImageDataset(
+        image_dir=args.image_dir, save_dir=args.save_dir, todo_ids=args.todo_ids
+    )
+    return {video_id: dataset.id2pth[video_id] for video_id in dataset.video_ids}
+
+
+def count_frames(pth):
+    import cv2
+
+    cap = cv2.VideoCapture(str(pth))
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    return total_frames
+
+
+def order_longest_first(id2pth, order, num_workers):
+    video_ids = sorted(id2pth.keys())
+    if order == "none":
+        return video_ids
+    pths = [id2pth[video_id] for video_id in video_ids]
+    if order == "frames":
+        with ProcessPoolExecutor(num_workers) as executor:
+            lengths = list(executor.map(count_frames, pths, chunksize=256))
+    else:
+        lengths = [os.path.getsize(pth) for pth in pths]
+    order_idxs = sorted(range(len(video_ids)), key=lambda i: -lengths[i])
+    return [video_ids[i] for i in order_idxs]
+
+
+def merge_journals(journal_dir, n_workers):
+    """Append the worker journals to journal/launch.txt and remove them."""
+    from src.data.embs_pipeline import Journal
+
+    merged = Journal(journal_dir, "launch")
+    for worker_id in range(n_workers):
+        journal_pth = Path(journal_dir) / f"worker{worker_id}.txt"
+        if not journal_pth.exists():
+            continue
+        with open(journal_pth) as f:
+            done_ids = [line[:-1] for line in f if line.endswith("\n")]
+        merged.add(done_ids)
+        journal_pth.unlink()
+
+
+def main(args, script_argv):
+    script = load_script(args.script)
+    script_args = script.get_parser().parse_args(script_argv)
+
+    id2pth = get_todo(args.script, script_args)
+    video_ids = order_longest_first(id2pth, args.order, args.probe_workers)
+    chunks = [
+        video_ids[i : i + args.chunk_size]
+        for i in range(0, len(video_ids), args.chunk_size)
+    ]
+    print(f"{len(video_ids)} items in {len(chunks)} chunks for {args.procs} workers")
+
+    devices = args.devices.split(",")
+    cpu_sets = args.cpu_sets.split(":") if args.cpu_sets else None
+
+    ctx = mp.get_context("spawn")
+    work_queue = ctx.Queue()
+    progress_queue = ctx.Queue()
+    for chunk in chunks:
+        work_queue.put(chunk)
+    for _ in range(args.procs):
+        work_queue.put(None)
+
+    procs = []
+    for worker_id in range(args.procs):
+        proc = ctx.Process(
+            target=worker,
+            args=(
+                worker_id,
+                args.script,
+                script_argv,
+                devices[worker_id % len(devices)],
+                cpu_sets[worker_id % len(cpu_sets)] if cpu_sets else None,
+                work_queue,
+                progress_queue,
+            ),
+        )
+        proc.start()
+        procs.append(proc)
+
+    start = time.time()
+    n_done = 0
+    last_print = start
+    while any(proc.is_alive() for proc in procs) or not progress_queue.empty():
+        try:
+            n_done += progress_queue.get(timeout=1)
+        except queue.Empty:
+            pass
+        if time.time() - last_print > args.print_every:
+            last_print = time.time()
+            rate = n_done / (last_print - start)
+            eta = (len(video_ids) - n_done) / rate if rate > 0 else float("inf")
+            print(
+                f"{n_done}/{len(video_ids)} done, {rate:.1f} it/s, eta {eta / 60:.1f} min",
+                flush=True,
+            )
+
+    failed = [i for i, proc in enumerate(procs) if proc.exitcode != 0]
+    print(f"{n_done} items in {(time.time() - start) / 60:.1f} min")
+    if args.script == "vids":
+        save_dir = script.get_save_dir(script_args)
+        merge_journals(save_dir / "journal", args.procs)
+        if script_args.frame_selection == "adaptive":
+            merge_journals(
+                save_dir.parent / f"{save_dir.name}-frames" / "journal", args.procs
+            )
+    else:
+        merge_journals(script_args.save_dir / "journal", args.procs)
+    if len(failed) > 0:
+        raise RuntimeError(f"Workers {failed} failed, relaunch to resume")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Arguments after -- are passed to the extraction script"
+    )
+    parser.add_argument("script", type=str, choices=list(SCRIPTS.keys()))
+    parser.add_argument("--procs", type=int, default=2, help="Worker processes")
+    parser.add_argument(
+        "--devices",
+        type=str,
+        default="cuda:0",
+        help="Comma separated devices assigned round-robin, e.g. cuda:0,cuda:1 or cpu",
+    )
+    parser.add_argument(
+        "--cpu_sets",
+        type=str,
+        default=None,
+        help="Colon separated CPU sets assigned round-robin, e.g. 0-7:8-15",
+    )
+    parser.add_argument("--chunk_size", type=int, default=64)
+    parser.add_argument(
+        "--order",
+        type=str,
+        default="frames",
+        choices=["frames", "size", "none"],
+        help="Longest-first by frame count (videos only), file size, or no order",
+    )
+    parser.add_argument("--probe_workers", type=int, default=16)
+    parser.add_argument("--print_every", type=float, default=10)
+
+    argv = sys.argv[1:]
+    script_argv = []
+    if "--" in argv:
+        split = argv.index("--")
+        argv, script_argv = argv[:split], argv[split + 1 :]
+    args = parser.parse_args(argv)
+    if args.order == "frames" and args.script == "imgs":
+        args.order = "size"
+
+    main(args, script_argv)
@@ -0,0 +1,327 @@
+# Extract the BLIP-2 video, image and text embeddings of a dataset in one run.
+#
+# The model is loaded once for every source (--video_dir, --image_dir and the
+# --columns of --annotation). Text batches are interleaved with the image/video
+# batches: they are issued right after each visual batch is launched, so their
+# CPU work (tokenization) runs while the visual batch is on the GPU. Their GPU
+# work is queued after it on the same stream, not run concurrently. All
+# outputs go to the same store, which can be used directly as emb_dir:
+#   save_dir/<id>.pth               video (<sub>/<id>) and image embeddings
+#   save_dir/<column>_<csv>.pth     {"texts", "feats"}, as save_blip2_embs_txts.py
+#                                   (or appended to the --txt_store text store)
+#   save_dir/journal/               completed ids, for resuming
+#   save_dir/manifest.json          extraction settings and sources
+# The settings are checked against the manifest, so that a store never mixes
+# embeddings computed with different models or preprocessing.
+
+import argparse
+import math
+import os
+import sys
+import time
+from pathlib import Path
+
+import torch
+from tqdm.auto import tqdm
+
+script_path = os.path.abspath(__file__)
+script_dir = os.path.dirname(script_path)
+project_root = os.path.abspath(os.path.join(script_dir, "..", ".."))
+sys.path.append(project_root)
+
+from lavis.models import load_model_and_preprocess
+
+from src.data.embs import ImageDataset, TextDataset, VideoDataset
+from src.data.txt_store import TextEmbStore
+from src.data.embs_pipeline import (
+    DevicePrefetcher,
+    EmbWriter,
+    Journal,
+    StageTimer,
+    atomic_save,
+    get_done_ids,
+)
+from src.tools.files import json_dump, json_load
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+save_dtypes = {"fp16": torch.float16, "fp32": torch.float32}
+
+MANIFEST_VERSION = 1
+
+
+def update_manifest(args, sources, counts=None):
+    settings = {
+        "model": "blip2_feature_extractor",
+        "model_type": args.model_type,
+        "image_size": args.image_size,
+        "frames_video": args.frames_video,
+        "frame_selection": args.frame_selection,
+        "save_dtype": args.save_dtype,
+    }
+    manifest_pth = args.save_dir / "manifest.json"
+    manifest = {"version": MANIFEST_VERSION, "settings": settings, "sources": {}}
+    if manifest_pth.exists():
+        manifest = json_load(manifest_pth)
+        assert (
+            manifest["version"] == MANIFEST_VERSION
+        ), f"{manifest_pth} has version {manifest['version']}"
+        assert (
+            manifest["settings"] == settings
+        ), f"{args.save_dir} was extracted with {manifest['settings']}"
+    manifest["sources"].update(sources)
+    if counts is not None:
+        manifest["counts"] = counts
+    manifest["updated"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    json_dump(manifest, manifest_pth)
+
+
+class TextSource:
+    """
+    Text batches of one csv column, interleaved with the visual batches. With
+    a store, the captions of every column not in the store yet.
+    """
+
+    def __init__(self, args, column, txt_processor, store=None):
+        column = column or args.columns[0]
+        self.save_pth = args.save_dir / f"{column}_{args.annotation.stem}.pth"
+        self.dataset = TextDataset(
+            args.annotation, column=column, txt_processor=txt_processor
+        )
+        self.store = store
+        if store is not None:
+            self.save_pth = store.store_pth
+            texts = set()
+            for column in args.columns:
+                texts.update(self.dataset.df[column].unique().tolist())
+            self.dataset.texts = store.missing(texts)
+        self.loader = torch.utils.data.DataLoader(
+            self.dataset,
+            batch_size=args.txt_batch_size,
+            shuffle=False,
+            num_workers=0,
+        )
+        self.batches = iter(self.loader)
+        self.feats = []
+
+    def __len__(self):
+        return len(self.loader)
+
+    def step(self, model):
+        txts = next(self.batches, None)
+        if txts is None:
+            return False
+        txt_embs = model.extract_features({"text_input": txts}, mode="text")
+        # no sync here: the copy completes with the next visual batch (or in save)
+        self.feats.append(
+            txt_embs.text_embeds_proj[:, 0, :].to("cpu", non_blocking=True)
+        )
+        return True
+
+    def save(self):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        if self.store is not None:
+            if len(self.feats) > 0:
+                self.store.add(self.dataset.texts, torch.cat(self.feats, dim=0))
+                self.store.save()
+            return
+        if len(self.feats) == 0:
+            return
+        save_obj = {
+            "texts": self.dataset.texts,
+            "feats": torch.cat(self.feats, dim=0),
+        }
+        atomic_save(save_obj, self.save_pth)
+
+
+def get_visual_loaders(args, transform):
+    loaders = []
+    if args.video_dir is not None:
+        dataset = VideoDataset(
+            video_dir=args.video_dir,
+            todo_ids=args.todo_ids,
+            frames_video=args.frames_video,
+            image_size=args.image_size,
+            frame_selection=args.frame_selection,
+        )
+        # the dataset exits when everything is done, filter the journal here
+        done_ids = get_done_ids(args.save_dir, "*/*.pth")
+        dataset.video_ids = [v for v in dataset.video_ids if v not in done_ids]
+        dataset.transform = transform
+        loaders.append(("videos", dataset))
+    if args.image_dir is not None:
+        dataset = ImageDataset(
+            image_dir=args.image_dir,
+            todo_ids=args.todo_ids,
+            image_size=args.image_size,
+        )
+        done_ids = get_done_ids(args.save_dir, "*.pth")
+        dataset.video_ids = [v for v in dataset.video_ids if v not in done_ids]
+        dataset.transform = transform
+        loaders.append(("images", dataset))
+
+    return [
+        (
+            name,
+            torch.utils.data.DataLoader(
+                dataset,
+                batch_size=args.batch_size,
+                shuffle=False,
+                pin_memory=True,
+                num_workers=args.num_workers,
+            ),
+        )
+        for name, dataset in loaders
+        if len(dataset) > 0
+    ]
+
+
+@torch.no_grad()
+def main(args):
+    args.save_dir.mkdir(parents=True, exist_ok=True)
+    sources = {}
+    if args.video_dir is not None:
+        sources["videos"] = str(args.video_dir)
+    if args.image_dir is not None:
+        sources["images"] = str(args.image_dir)
+    if args.annotation is not None:
+        for column in args.columns:
+            sources[f"{column}_{args.annotation.stem}"] = str(args.annotation)
+    assert len(sources) > 0, "Nothing to extract"
+    update_manifest(args, sources)
+
+    print("Creating model")
+    model, vis_processors, txt_processors = load_model_and_preprocess(
+        name="blip2_feature_extractor",
+        model_type=args.model_type,
+        is_eval=True,
+        device=device,
+    )
+
+    text_sources = []
+    if args.annotation is not None and args.txt_store is not None:
+        store = TextEmbStore(args.txt_store)
+        text_source = TextSource(args, None, txt_processors["eval"], store=store)
+        print(f"{len(text_source.dataset)} captions not in {args.txt_store}")
+        text_sources.append(text_source)
+    elif args.annotation is not None:
+        for column in args.columns:
+            text_source = TextSource(args, column, txt_processors["eval"])
+            if text_source.save_pth.exists():
+                print(f"{text_source.save_pth} exists, skipping")
+                continue
+            text_sources.append(text_source)
+
+    visual_loaders = get_visual_loaders(args, vis_processors["eval"])
+
+    timer = StageTimer()
+    writer = EmbWriter(
+        args.save_dir,
+        num_writers=args.num_writers,
+        dtype=save_dtypes[args.save_dtype],
+        timer=timer,
+        journal=Journal(args.save_dir / "journal", "extract"),
+    )
+
+    # spread the text batches evenly over the visual batches
+    n_visual = sum(len(loader) for _, loader in visual_loaders)
+    n_text = sum(len(text_source) for text_source in text_sources)
+    text_per_step = math.ceil(n_text / n_visual) if n_visual > 0 else 0
+
+    for name, loader in visual_loaders:
+        pbar = tqdm(DevicePrefetcher(loader, device, timer), desc=name)
+        for batch in pbar:
+            start = time.time()
+            if name == "videos":
+                video_ids, f_idxs, frames = batch
+                valid = f_idxs > -1
+                if not valid.any():
+                    continue
+                n_valid = valid.sum(dim=1).tolist()
+                frames = frames[valid].to(device, non_blocking=True)
+            else:
+                frames, video_ids = batch
+                frames = frames.to(device, non_blocking=True)
+                n_valid = [1] * len(video_ids)
+
+            feats = model.extract_features({"image": frames}, mode="image")
+
+            # text batches while the visual batch runs on the GPU: tokenization
+            # overlaps it, the text kernels are queued after it
+            text_start = time.time()
+            for _ in range(text_per_step):
+                while len(text_sources) > 0 and not text_sources[0].step(model):
+                    text_sources.pop(0).save()
+            text_time = time.time() - text_start
+            timer.add("text", text_time)
+
+            feats = feats.image_embeds_proj.cpu()
+            timer.add("device", time.time() - start - text_time, len(video_ids))
+
+            feats = feats.split(n_valid)
+            for video_id, n, feat in zip(video_ids, n_valid, feats):
+                if n == 0 or video_id == "delete":
+                    continue
+                writer.submit(video_id, feat if name == "videos" else feat[0])
+            pbar.set_postfix_str(timer.summary())
+
+    # texts left when there is no (or not enough) visual work
+    for text_source in text_sources:
+        for _ in tqdm(range(len(text_source)), desc=text_source.save_pth.stem):
+            text_source.step(model)
+        text_source.save()
+
+    writer.close()
+    print(timer.summary())
+
+    update_manifest(
+        args,
+        sources,
+        counts={
+            "embeddings": len(get_done_ids(args.save_dir, "*/*.pth")),
+            "texts": sorted(
+                name
+                for name in sources
+                if (args.save_dir / f"{name}.pth").exists()
+            ),
+        },
+    )
+    print(f"Embeddings saved in {args.save_dir}")
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--save_dir", type=Path, required=True, help="Store directory")
+    parser.add_argument("--video_dir", type=Path, default=None)
+    parser.add_argument("--image_dir", type=Path, default=None)
+    parser.add_argument("--annotation", type=Path, default=None, help="csv file")
+    parser.add_argument(
+        "--columns", type=str, nargs="+", default=["txt2"], help="Text columns"
+    )
+    parser.add_argument(
+        "--txt_store", type=Path, default=None, help="Shared text store to append to"
+    )
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--txt_batch_size", type=int, default=128)
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--num_writers", type=int, default=4)
+    parser.add_argument(
+        "--model_type", type=str, default="coco", choices=["coco", "pretrain_vitL"]
+    )
+    parser.add_argument("--frames_video", type=int, default=15)
+    parser.add_argument(
+        "--frame_selection", type=str, default="uniform", choices=["uniform", "adaptive"]
+    )
+    parser.add_argument("--todo_ids", type=str, default=None)
+    parser.add_argument("--image_size", type=int, default=364, choices=[224, 364])
+    parser.add_argument(
+        "--save_dtype", type=str, default="fp16", choices=list(save_dtypes.keys())
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+
+    main(args)
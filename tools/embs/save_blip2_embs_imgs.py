@@ -1,3 +1,4 @@
+import argparse
 import os
 import sys
 from pathlib import Path
@@ -14,15 +15,17 @@ sys.path.append(project_root)
 from lavis.models import load_model_and_preprocess
 
 from src.data.embs import ImageDataset
+from src.data.embs_pipeline import EmbWriter, Journal
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
 @torch.no_grad()
-def main(args):
+def main(args, make_sampler=None, progress=None):
+    """See save_blip2_embs_vids.main for make_sampler and progress."""
     dataset = ImageDataset(
         image_dir=args.image_dir,
-        save_dir=args.save_dir,
+        save_dir=args.save_dir if make_sampler is None else None,
         todo_ids=args.todo_ids,
         image_size=args.image_size,
     )
@@ -42,22 +45,34 @@ def main(args):
         dataset,
         batch_size=args.batch_size,
         shuffle=False,
+        sampler=make_sampler(dataset) if make_sampler is not None else None,
         pin_memory=False,
         num_workers=args.num_workers,
     )
 
+    writer = EmbWriter(
+        args.save_dir,
+        dtype=torch.float32,
+        journal=Journal(
+            args.save_dir / "journal", getattr(args, "journal_name", None) or "shard0"
+        ),
+    )
     for imgs, video_ids in tqdm(loader):
         imgs = imgs.to(device)
         img_embs = model.extract_features({"image": imgs}, mode="image")
         img_feats = img_embs.image_embeds_proj.cpu()
 
         for img_feat, video_id in zip(img_feats, video_ids):
-            torch.save(img_feat, args.save_dir / f"{video_id}.pth")
-
+            if video_id == "delete":
+                # corrupted image, see ImageDataset
+                continue
+            writer.submit(video_id, img_feat)
+        if progress is not None:
+            progress(len(video_ids))
+    writer.close()
 
-if __name__ == "__main__":
-    import argparse
 
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--image_dir", type=Path, required=True, help="Path to image directory"
@@ -70,7 +85,11 @@ if __name__ == "__main__":
     )
     parser.add_argument("--todo_ids", type=str, default=None)
     parser.add_argument("--image_size", type=int, default=364, choices=[224, 364])
-    args = parser.parse_args()
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
 
     args.save_dir.mkdir(exist_ok=True)
 
@@ -14,6 +14,8 @@ sys.path.append(project_root)
 
 from lavis.models import load_model_and_preprocess
 
+from src.data.txt_store import TextEmbStore
+
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
@@ -67,6 +69,16 @@ def main(args):
         column=args.column,
     )
 
+    store = None
+    if args.store is not None:
+        # only embed the captions that are not in the shared store yet
+        store = TextEmbStore(args.store)
+        n_texts = len(dataset.texts)
+        dataset.texts = store.missing(dataset.texts)
+        print(f"{len(dataset.texts)}/{n_texts} captions not in {args.store}")
+        if len(dataset.texts) == 0:
+            return
+
     loader = torch.utils.data.DataLoader(
         dataset,
         batch_size=args.batch_size,
@@ -82,6 +94,12 @@ def main(args):
         text_feats.append(text_feat)
 
     text_feats = torch.cat(text_feats, dim=0)
+    if store is not None:
+        store.add(dataset.texts, text_feats)
+        store.save()
+        print(f"{len(store)} captions in {args.store}")
+        return
+
     save_obj = {
         "texts": dataset.texts,
         "feats": text_feats,
@@ -101,6 +119,12 @@ if __name__ == "__main__":
         "--model_type", type=str, default="coco", choices=["coco", "pretrain_vitL"]
     )
     parser.add_argument("--column", type=str, default="txt2")
+    parser.add_argument(
+        "--store",
+        type=Path,
+        default=None,
+        help="Append the new captions to this text store instead of writing <column>_<stem>.pth",
+    )
     args = parser.parse_args()
 
     args.save_dir.mkdir(exist_ok=True)
@@ -1,5 +1,7 @@
+import argparse
 import os
 import sys
+import time
 from pathlib import Path
 
 import torch
@@ -14,17 +16,34 @@ sys.path.append(project_root)
 from lavis.models import load_model_and_preprocess
 
 from src.data.embs import VideoDataset
+from src.data.embs_pipeline import DevicePrefetcher, EmbWriter, Journal, StageTimer
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+save_dtypes = {"fp16": torch.float16, "fp32": torch.float32}
 
-@torch.no_grad()
-def main(args):
+
+def get_save_dir(args):
     if args.model_type == "coco":
-        save_dir = args.video_dir.parent / f"blip2-vid-embs-large-all"
-    else:
-        save_dir = args.video_dir.parent / f"blip2-vid-embs-{args.model_type}-all"
+        return args.video_dir.parent / f"blip2-vid-embs-large-all"
+    return args.video_dir.parent / f"blip2-vid-embs-{args.model_type}-all"
+
+
+@torch.no_grad()
+def main(args, make_sampler=None, progress=None):
+    """
+    make_sampler(dataset) and progress(n_videos) are used by launch_embs.py:
+    the sampler hands out the videos to extract (the dataset then contains
+    every video and is not filtered nor sharded), and progress is called
+    after each batch.
+    """
+    save_dir = get_save_dir(args)
     save_dir.mkdir(exist_ok=True)
+    journal_name = getattr(args, "journal_name", None) or f"shard{args.shard_id}"
+    if args.frame_selection == "adaptive":
+        # kept frame indices, one tensor per video next to the embeddings dir
+        idx_dir = save_dir.parent / f"{save_dir.name}-frames"
+        idx_dir.mkdir(exist_ok=True)
 
     dataset = VideoDataset(
         video_dir=args.video_dir,
@@ -32,14 +51,17 @@ def main(args):
         num_shards=args.num_shards,
         shard_id=args.shard_id,
         frames_video=args.frames_video,
-        save_dir=save_dir,
+        save_dir=save_dir if make_sampler is None else None,
         image_size=args.image_size,
+        frame_selection=args.frame_selection,
+        scene_threshold=args.scene_threshold,
     )
 
     loader = torch.utils.data.DataLoader(
         dataset,
         batch_size=args.batch_size,
         shuffle=False,
+        sampler=make_sampler(dataset) if make_sampler is not None else None,
         pin_memory=True,
         num_workers=args.num_workers,
     )
@@ -55,31 +77,65 @@ def main(args):
     dataset.transform = vis_processors["eval"]
     dataset.image_size = args.image_size
 
-    for video_ids, f_idxs, frames in tqdm(loader):
-        frames = frames.to(device)
-        bs, nf, c, h, w = frames.shape
-        frames = frames.view(bs * nf, c, h, w)
+    # decode (DataLoader workers) -> device (prefetched H2D copy + forward)
+    # -> write (background threads), each stage timed separately
+    timer = StageTimer()
+    writer = EmbWriter(
+        save_dir,
+        num_writers=args.num_writers,
+        max_pending=args.max_pending,
+        dtype=save_dtypes[args.save_dtype],
+        shard_size=args.shard_size,
+        shard_prefix=journal_name,
+        timer=timer,
+        journal=Journal(save_dir / "journal", journal_name),
+    )
+    idx_writer = None
+    if args.frame_selection == "adaptive":
+        idx_writer = EmbWriter(
+            idx_dir,
+            num_writers=1,
+            dtype=torch.long,
+            journal=Journal(idx_dir / "journal", journal_name),
+        )
+
+    pbar = tqdm(DevicePrefetcher(loader, device, timer))
+    for step, (video_ids, f_idxs, frames) in enumerate(pbar):
+        start = time.time()
+        # only encode the frames with f_idx > -1, padding frames are dropped.
+        # Padding is always at the end, so the first n_valid frames are kept.
+        valid = f_idxs > -1
+        if not valid.any():
+            continue
+        n_valid = valid.sum(dim=1).tolist()
+        frames = frames[valid].to(device, non_blocking=True)
 
         frm_feats = model.extract_features({"image": frames}, mode="image")
-        frm_feats = frm_feats.image_embeds_proj.view(bs, nf, 32, 256).cpu()
-
-        for video_id, f_idx, frm_feat in zip(video_ids, f_idxs, frm_feats):
-            # remove the features with f_idx=-1
-            frm_feat = frm_feat[f_idx > -1]
-            f_idx = f_idx[f_idx > -1]
-            if len(f_idx) == 0:
-                continue
-            save_pth = save_dir / f"{video_id}.pth"
-            if save_pth.exists():
+        frm_feats = frm_feats.image_embeds_proj.cpu()
+        timer.add("device", time.time() - start, len(video_ids))
+
+        f_idxs = f_idxs.cpu()
+        for video_id, n, f_idx, frm_feat in zip(
+            video_ids, n_valid, f_idxs, frm_feats.split(n_valid)
+        ):
+            if n == 0:
                 continue
-            save_pth.parent.mkdir(exist_ok=True)
+            writer.submit(video_id, frm_feat)
+            if idx_writer is not None:
+                idx_writer.submit(video_id, f_idx[:n])
 
-            torch.save(frm_feat, save_pth)
+        if progress is not None:
+            progress(len(video_ids))
+        if (step + 1) % args.log_every == 0:
+            pbar.set_postfix_str(timer.summary())
 
+    writer.close()
+    if idx_writer is not None:
+        idx_writer.close()
+    print(timer.summary())
 
-if __name__ == "__main__":
-    import argparse
 
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--video_dir", type=Path, required=True, help="Path to video directory"
@@ -92,8 +148,39 @@ if __name__ == "__main__":
     parser.add_argument("--num_shards", type=int, default=1)
     parser.add_argument("--shard_id", type=int, default=0)
     parser.add_argument("--frames_video", type=int, default=15)
+    parser.add_argument(
+        "--frame_selection",
+        type=str,
+        default="uniform",
+        choices=["uniform", "adaptive"],
+        help="adaptive keeps only frames that differ from the previous kept one",
+    )
+    parser.add_argument(
+        "--scene_threshold",
+        type=float,
+        default=0.1,
+        help="Mean abs difference of 16x16 gray thumbnails to keep a frame",
+    )
     parser.add_argument("--todo_ids", type=str, default=None)
     parser.add_argument("--image_size", type=int, default=364, choices=[224, 364])
-    args = parser.parse_args()
+    parser.add_argument("--num_writers", type=int, default=4)
+    parser.add_argument(
+        "--max_pending", type=int, default=64, help="Max queued writes"
+    )
+    parser.add_argument(
+        "--save_dtype", type=str, default="fp16", choices=list(save_dtypes.keys())
+    )
+    parser.add_argument(
+        "--shard_size",
+        type=int,
+        default=0,
+        help="Pack this many videos per file in save_dir/shards (0: one file per video)",
+    )
+    parser.add_argument("--log_every", type=int, default=50)
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
 
     main(args)
@@ -0,0 +1,117 @@
+# Write a reduced-resolution mirror of an image directory.
+#
+# Every image whose longest side is above --max_side (default 2 * image_size) is
+# re-encoded at that size, smaller ones are copied as is. Relative paths and
+# extensions are kept, so the mirror can replace the original directory in the
+# img_dirs of the data configs. A manifest.json in the mirror maps every mirrored
+# path to its source path and original size.
+
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from PIL import Image
+from tqdm.auto import tqdm
+
+Image.MAX_IMAGE_PIXELS = None  # Disable DecompressionBombWarning
+
+EXTENSIONS = [".jpg", ".jpeg", ".png"]
+
+
+def shrink_image(src_pth: Path, dst_pth: Path, max_side: int, quality: int):
+    dst_pth.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        img = Image.open(src_pth)
+        src_size = img.size
+        if max(src_size) <= max_side:
+            shutil.copyfile(src_pth, dst_pth)
+            return src_size, src_size
+
+        if img.format == "JPEG":
+            img.draft("RGB", (max_side, max_side))
+        img = img.convert("RGB")
+        img.thumbnail((max_side, max_side), Image.BICUBIC)
+        if dst_pth.suffix.lower() == ".png":
+            img.save(dst_pth)
+        else:
+            img.save(dst_pth, quality=quality)
+        return src_size, img.size
+    except Exception as e:
+        print(f"Image {src_pth} is corrupted: {e}")
+        return None
+
+
+def main(args):
+    from src.tools.files import json_dump, json_load
+
+    src_dir = args.image_dir.resolve()
+    dst_dir = args.save_dir
+    max_side = args.max_side or 2 * args.image_size
+    dst_dir.mkdir(parents=True, exist_ok=True)
+
+    manifest_pth = dst_dir / "manifest.json"
+    manifest = {"source": str(src_dir), "max_side": max_side, "images": {}}
+    if manifest_pth.exists():
+        manifest = json_load(manifest_pth)
+        assert manifest["source"] == str(src_dir), f"{dst_dir} mirrors another dir"
+        assert manifest["max_side"] == max_side, f"{dst_dir} uses another max_side"
+
+    src_pths = [
+        pth
+        for pth in src_dir.rglob("*")
+        if pth.suffix.lower() in EXTENSIONS
+        and str(pth.relative_to(src_dir)) not in manifest["images"]
+    ]
+    src_pths.sort()
+    print(f"Shrinking {len(src_pths)} images from {src_dir} to {dst_dir}")
+
+    with ProcessPoolExecutor(args.num_workers) as executor:
+        futures = [
+            executor.submit(
+                shrink_image,
+                pth,
+                dst_dir / pth.relative_to(src_dir),
+                max_side,
+                args.quality,
+            )
+            for pth in src_pths
+        ]
+        for pth, future in zip(tqdm(src_pths), futures):
+            sizes = future.result()
+            if sizes is None:
+                continue
+            rel_pth = str(pth.relative_to(src_dir))
+            manifest["images"][rel_pth] = {
+                "source": str(pth),
+                "source_size": list(sizes[0]),
+                "size": list(sizes[1]),
+            }
+
+    json_dump(manifest, manifest_pth)
+    print(f"Manifest saved in {manifest_pth}")
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+    import sys
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(os.path.abspath(os.path.join(script_dir, "..", "..")))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--image_dir", type=Path, required=True, help="Path to image directory"
+    )
+    parser.add_argument(
+        "--save_dir", type=Path, required=True, help="Path to the mirror directory"
+    )
+    parser.add_argument("--image_size", type=int, default=384)
+    parser.add_argument(
+        "--max_side", type=int, default=None, help="Defaults to 2 * image_size"
+    )
+    parser.add_argument("--quality", type=int, default=95)
+    parser.add_argument("--num_workers", type=int, default=8)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,58 @@
+# Recall delta vs. speedup of the token merging settings of a test sweep.
+#
+# Run the evaluation once per setting, e.g.
+#   python test.py -m model.model.tome_r=0,4,8,12,16 test=webvid-covr
+#   python test.py -m model.model.tome_r=0,4,8,12,16 test=cirr-val
+# then point this script to the multirun directory. It reads the recalls_*.json
+# of every run (with the "speed" entry written by the evaluators) and compares
+# each setting to tome_r=0.
+
+import argparse
+import json
+from collections import defaultdict
+from pathlib import Path
+
+
+def load_runs(sweep_dir: Path):
+    runs = defaultdict(list)
+    for recalls_pth in sorted(sweep_dir.glob("**/recalls_*.json")):
+        with open(recalls_pth) as f:
+            recalls = json.load(f)
+        if "speed" not in recalls:
+            continue
+        runs[recalls_pth.stem].append(recalls)
+    return runs
+
+
+def main(args):
+    runs = load_runs(args.sweep_dir)
+    assert len(runs) > 0, f"No recalls with speed found in {args.sweep_dir}"
+
+    for name, results in runs.items():
+        baseline = [r for r in results if r["speed"]["tome_r"] == 0]
+        assert len(baseline) > 0, f"{name}: no tome_r=0 run to compare to"
+        baseline = baseline[0]
+        metrics = [k for k in args.metrics if k in baseline]
+
+        print(name)
+        header = ["tome_r", "tokens", "speedup"] + [f"d{k}" for k in metrics]
+        print("\t".join(header))
+        results = sorted(results, key=lambda r: r["speed"]["vit_tokens"], reverse=True)
+        for result in results:
+            speed = result["speed"]
+            speedup = speed["queries_per_s"] / baseline["speed"]["queries_per_s"]
+            row = [str(speed["tome_r"]), str(speed["vit_tokens"]), f"{speedup:.2f}x"]
+            row += [f"{result[k] - baseline[k]:+.2f}" for k in metrics]
+            print("\t".join(row))
+        print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sweep_dir", type=Path, help="Hydra multirun directory")
+    parser.add_argument(
+        "--metrics", type=str, nargs="+", default=["R1", "R5", "R10", "R50"]
+    )
+    args = parser.parse_args()
+
+    main(args)
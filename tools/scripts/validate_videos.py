@@ -0,0 +1,104 @@
+# Check every reference video (pth1) of an annotation file before training.
+#
+# Videos that do not exist, report no frames or whose middle frame cannot be
+# decoded are appended to the quarantine file, together with the target
+# embeddings (pth2) that cannot be loaded when --emb_dir is given. Pass the same
+# file as data.quarantine so the datasets drop these triplets when building
+# their index. vid_dir and emb_dir must be written as in the data config, since
+# the quarantine is keyed on the resulting paths.
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import cv2
+import pandas as pd
+from tqdm.auto import tqdm
+
+
+def probe_video(vid_pth: Path):
+    if not vid_pth.exists():
+        return "does not exist"
+    cap = cv2.VideoCapture(str(vid_pth))
+    try:
+        if not cap.isOpened():
+            return "could not be opened"
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        if total_frames <= 0:
+            return "no frames"
+        cap.set(cv2.CAP_PROP_POS_FRAMES, total_frames // 2)
+        ret, frame = cap.read()
+        if not ret or frame is None:
+            return "frame could not be decoded"
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+    finally:
+        cap.release()
+    return None
+
+
+def probe_embedding(emb_pth: Path):
+    import torch
+
+    if not emb_pth.exists():
+        return "does not exist"
+    try:
+        torch.load(emb_pth, weights_only=True)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+    return None
+
+
+def probe(pths, fn, quarantine, num_workers, desc):
+    pths = [pth for pth in pths if pth not in quarantine]
+    n_failed = 0
+    with ProcessPoolExecutor(num_workers) as executor:
+        for pth, reason in zip(
+            tqdm(pths, desc=desc), executor.map(fn, pths, chunksize=64)
+        ):
+            if reason is not None:
+                quarantine.add(pth, reason)
+                n_failed += 1
+    print(f"{n_failed}/{len(pths)} {desc} quarantined")
+
+
+def main(args):
+    from src.data.quarantine import Quarantine
+
+    quarantine = Quarantine(args.quarantine)
+    df = pd.read_csv(args.annotation)
+
+    vid_pths = sorted({args.vid_dir / f"{pth1}.mp4" for pth1 in df["pth1"]})
+    probe(vid_pths, probe_video, quarantine, args.num_workers, "videos")
+
+    if args.emb_dir is not None:
+        emb_pths = sorted({args.emb_dir / f"{pth2}.pth" for pth2 in df["pth2"]})
+        probe(emb_pths, probe_embedding, quarantine, args.num_workers, "embeddings")
+
+    print(f"{len(quarantine)} files in {args.quarantine}")
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+    import sys
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(os.path.abspath(os.path.join(script_dir, "..", "..")))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--annotation", type=Path, required=True, help="Path to annotation file"
+    )
+    parser.add_argument(
+        "--vid_dir", type=Path, required=True, help="Path to video directory"
+    )
+    parser.add_argument(
+        "--emb_dir", type=Path, default=None, help="Also check target embeddings"
+    )
+    parser.add_argument(
+        "--quarantine", type=Path, required=True, help="Path to the quarantine file"
+    )
+    parser.add_argument("--num_workers", type=int, default=8)
+    args = parser.parse_args()
+
+    main(args)
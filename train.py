@@ -5,10 +5,22 @@ from pathlib import Path
 
 import hydra
 import lightning as L
-from hydra.utils import instantiate
+from hydra.utils import instantiate, to_absolute_path
 from omegaconf import DictConfig, OmegaConf
 
+from src.data.samplers import set_epoch, skip_batches
+from src.tools.async_eval import AsyncEvaluator
+from src.tools.checkpoint import (
+    AsyncCheckpointer,
+    get_rng_state,
+    load_resume,
+    set_rng_state,
+)
 from src.tools.files import json_dump
+from src.tools.grad_cache import grad_cache_step
+from src.tools.profiler import build_profiler
+from src.tools.telemetry import TrainTelemetry
+from src.tools.test_harness import TestHarness
 from src.tools.utils import calculate_model_params
 
 
@@ -43,7 +55,14 @@ def main(cfg: DictConfig):
         json_dump(OmegaConf.to_container(cfg, resolve=True), "hydra.json")
 
     data = instantiate(cfg.data, _recursive_=False)
-    loader_train = fabric.setup_dataloaders(data.train_dataloader())
+    loader_train = data.train_dataloader()
+    # batch samplers that shard over the ranks themselves (e.g. ref_group_size)
+    loader_train = fabric.setup_dataloaders(
+        loader_train,
+        use_distributed_sampler=not getattr(
+            loader_train.batch_sampler, "distributed", False
+        ),
+    )
     if cfg.val:
         loader_val = fabric.setup_dataloaders(data.val_dataloader())
 
@@ -57,60 +76,119 @@ def main(cfg: DictConfig):
 
     scheduler = instantiate(cfg.model.scheduler)
 
-    fabric.print("Start training")
-    start_time = time.time()
+    # loss/耗时在device上累积, 每log_interval步才同步一次
+    telemetry = TrainTelemetry(fabric)
+    telemetry.watch(loader_train)
 
+    # 只保存可训练参数和优化器状态, 在后台线程写盘
+    checkpointer = AsyncCheckpointer(fabric, cfg.model.ckpt.path)
     best_R1 = 0
+    start_epoch = 0
+    resume = None
+    if cfg.trainer.resume_from:
+        resume_pth = to_absolute_path(cfg.trainer.resume_from)
+        resume = load_resume(resume_pth, model, optimizer, fabric)
+        start_epoch = resume["epoch"]
+        best_R1 = resume["best_R1"]
+        fabric.print(
+            f"Resuming from {cfg.trainer.resume_from}: "
+            f"epoch {start_epoch + 1}, batch {resume['step']}"
+        )
+
+    # 测试交给独立进程(trainer.eval_device), 只在rank 0
+    evaluator = None
+    test_harness = None
+    if cfg.trainer.async_eval:
+        if fabric.global_rank == 0:
+            evaluator = AsyncEvaluator(cfg, cfg.trainer.eval_device, best_R1)
+    else:
+        # 测试集(datamodule, loader, evaluator)只构建一次, 每个epoch只跑模型和打分
+        test_harness = TestHarness(
+            cfg,
+            fabric,
+            persistent=cfg.trainer.test_harness,
+            cache=cfg.trainer.test_cache,
+        )
 
-    for epoch in range(cfg.trainer.max_epochs):
+    fabric.print("Start training")
+    start_time = time.time()
+
+    for epoch in range(start_epoch, cfg.trainer.max_epochs):
         scheduler(optimizer, epoch)
+        # 显式设置sampler的epoch, 续训时不依赖Fabric的迭代计数
+        set_epoch(loader_train, epoch)
 
         columns = shutil.get_terminal_size().columns
         fabric.print("-" * columns)
         fabric.print(f"Epoch {epoch + 1}/{cfg.trainer.max_epochs}".center(columns))
 
-        train(model, loader_train, optimizer, fabric, epoch, cfg)
+        train(
+            model,
+            loader_train,
+            optimizer,
+            fabric,
+            epoch,
+            cfg,
+            checkpointer=checkpointer,
+            telemetry=telemetry,
+            best_R1=best_R1,
+            resume=resume if resume is not None and resume["epoch"] == epoch else None,
+        )
 
         # if cfg.val:
             # fabric.print("Evaluate")
             # instantiate(cfg.evaluate, model, loader_val, fabric=fabric)
 
-        state = {
-            "epoch": epoch,
-            "model": model,
-            "optimizer": optimizer,
-            "scheduler": scheduler,
-        }
         # if cfg.trainer.save_ckpt == "all":
         #     fabric.save(f"ckpt_{epoch}.ckpt", state)
         # elif cfg.trainer.save_ckpt == "last":
         #     fabric.save("ckpt_last.ckpt", state)
         # fabric.barrier()
 # 如果是cirr,先不test
-        for dataset_t in cfg.test:
-            columns = shutil.get_terminal_size().columns
-            fabric.print("-" * columns)
-            fabric.print(f"Testing on {cfg.test[dataset_t].dataname}".center(columns))
-
-            data_t = instantiate(cfg.test[dataset_t])
-            test_loader = fabric.setup_dataloaders(data_t.test_dataloader())
-
-            test_t = instantiate(cfg.test[dataset_t].test)
-            recalls = test_t(model, test_loader, fabric=fabric)
-
-            if cfg.trainer.save_ckpt == "best":
-                print("检查是否为最佳模型")
-                cur_R1 = recalls.get("R1")
-                if cur_R1 > best_R1:
-                    print("正在保存模型")
-                    best_R1 = cur_R1
-                    fabric.save("m2_web_16_normal_att_best.ckpt", state)
-                    print("保存模型成功")
-                else:
-                    print("本轮非最佳模型")
-            elif cfg.trainer.save_ckpt == "last":
-                fabric.save("ckpt_last.ckpt", state)
-            fabric.barrier()
+        if evaluator is not None:
+            # 只复制可训练参数到CPU, 测试在独立进程中进行, 训练继续
+            evaluator.submit(model, epoch)
+            best_R1 = log_async_eval(evaluator.poll(), fabric, best_R1)
+            if cfg.trainer.save_ckpt == "last":
+                checkpointer.save(
+                    "ckpt_last.ckpt", model, optimizer, epoch + 1, 0, best_R1=best_R1
+                )
+        elif not cfg.trainer.async_eval:
+            for dataset_t in cfg.test:
+                recalls = test_harness.run(model, dataset_t, f"epoch{epoch}")
+
+                if cfg.trainer.save_ckpt == "best":
+                    print("检查是否为最佳模型")
+                    cur_R1 = recalls.get("R1")
+                    if cur_R1 > best_R1:
+                        print("正在保存模型")
+                        best_R1 = cur_R1
+                        checkpointer.save(
+                            "m2_web_16_normal_att_best.ckpt",
+                            model,
+                            optimizer,
+                            epoch + 1,
+                            0,
+                            best_R1=best_R1,
+                        )
+                        print("保存模型成功")
+                    else:
+                        print("本轮非最佳模型")
+                elif cfg.trainer.save_ckpt == "last":
+                    checkpointer.save(
+                        "ckpt_last.ckpt",
+                        model,
+                        optimizer,
+                        epoch + 1,
+                        0,
+                        best_R1=best_R1,
+                    )
+                fabric.barrier()
+
+        # 每个epoch结束保存一次, 用于trainer.resume_from
+        checkpointer.save(
+            "ckpt_resume.ckpt", model, optimizer, epoch + 1, 0, best_R1=best_R1
+        )
 #-----
         # print("正在保存模型")
         # # fabric.save("ckpt_fashioniq_last.ckpt", state)
@@ -125,6 +203,10 @@ def main(cfg: DictConfig):
         #     fabric.save(name, state)
         #     fabric.barrier()
 
+    if evaluator is not None:
+        fabric.print("Waiting for the evaluation process")
+        best_R1 = log_async_eval(evaluator.close(), fabric, best_R1)
+    checkpointer.wait()
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     fabric.print(f"Training time {total_time_str}")
@@ -144,29 +226,98 @@ def main(cfg: DictConfig):
     fabric.print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 
 
-def train(model, train_loader, optimizer, fabric, epoch, cfg):
+def log_async_eval(results, fabric, best_R1):
+    """Log the results sent back by the evaluation process, return the best R1."""
+    for result in results:
+        metrics = {"epoch": result["epoch"]}
+        for dataset, recalls in result["recalls"].items():
+            metrics.update({f"{dataset}/{k}": v for k, v in recalls.items()})
+            fabric.print(f"Epoch {result['epoch'] + 1} {dataset}: {recalls}")
+        fabric.log_dict(metrics)
+        if result["is_best"]:
+            fabric.print(f"New best R1 {result['best_R1']}")
+        best_R1 = max(best_R1, result["best_R1"])
+    return best_R1
+
+
+def train(
+    model,
+    train_loader,
+    optimizer,
+    fabric,
+    epoch,
+    cfg,
+    checkpointer=None,
+    telemetry=None,
+    best_R1=0,
+    resume=None,
+):
     model.train()
+    if telemetry is None:
+        telemetry = TrainTelemetry(fabric)
+
+    n_batches = len(train_loader)
+    start_step = 0
+    undo_skip = None
+    if resume is not None:
+        # 回到epoch开始时的随机状态, sampler给出相同的顺序, 已训练的batch在sampler里跳过
+        set_rng_state(resume.get("epoch_rng", resume["rng"]))
+        start_step = resume["step"]
+        undo_skip = skip_batches(train_loader, start_step)
+    epoch_rng = get_rng_state()
+
+    profiler = build_profiler(cfg.profiler, f"train_epoch{epoch}", "train", epoch)
+    with profiler:
+        telemetry.wait_start()
+        for batch_idx, batch in enumerate(train_loader, start_step):
+            telemetry.step_start(batch)
+            if resume is not None:
+                # 迭代器(和sampler的顺序)已经创建, 恢复保存时的随机状态
+                set_rng_state(resume["rng"])
+                resume = None
+            if batch == None:
+                profiler.step()
+                telemetry.wait_start()
+                continue
+            optimizer.zero_grad()
+            if cfg.trainer.grad_cache > 0:
+                # 大batch的对比损失: 特征分micro-batch计算, 梯度与整个batch一次计算相同
+                loss = grad_cache_step(model, batch, fabric, cfg.trainer.grad_cache)
+                telemetry.mark("forward_backward")
+            else:
+                loss = model(batch, fabric)
+                telemetry.mark("forward")
+                fabric.backward(loss)
+                telemetry.mark("backward")
+            optimizer.step()
+            telemetry.mark("optimizer")
+            telemetry.step_end(loss, optimizer.param_groups[0]["lr"])
+
+            if checkpointer is not None and cfg.trainer.ckpt_every > 0:
+                if (batch_idx + 1) % cfg.trainer.ckpt_every == 0:
+                    checkpointer.save(
+                        "ckpt_resume.ckpt",
+                        model,
+                        optimizer,
+                        epoch,
+                        batch_idx + 1,
+                        epoch_rng=epoch_rng,
+                        best_R1=best_R1,
+                    )
+
+            do_print = batch_idx % cfg.trainer.print_interval == 0
+            if do_print or telemetry.global_step % cfg.trainer.log_interval == 0:
+                metrics = telemetry.flush(epoch=epoch)
+                if do_print:
+                    fabric.print(
+                        f"[{100.0 * batch_idx / n_batches:.0f}%]\t"
+                        + telemetry.summary(metrics)
+                    )
+            profiler.step()
+            telemetry.wait_start()
 
-    for batch_idx, batch in enumerate(train_loader):
-        if batch == None:
-            continue
-        optimizer.zero_grad()
-        loss = model(batch, fabric)
-        fabric.backward(loss)
-        optimizer.step()
-
-        if batch_idx % cfg.trainer.print_interval == 0:
-            fabric.print(
-                f"[{100.0 * batch_idx / len(train_loader):.0f}%]\tLoss: {loss.item():.6f}"
-            )
-        if batch_idx % cfg.trainer.log_interval == 0:
-            fabric.log_dict(
-                {
-                    "loss": loss.item(),
-                    "lr": optimizer.param_groups[0]["lr"],
-                    "epoch": epoch,
-                }
-            )
+    if undo_skip is not None:
+        undo_skip()
 
 
 if __name__ == "__main__":